@@ -3,6 +3,9 @@ ASGI config for api project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Set API_ASYNC_VIEWS=true to route the domain endpoints to the async views in
+domain/async_views.py when serving through this module.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -0,0 +1,40 @@
+"""
+File: solr_sync.py
+Description: Consumer of the SOLR sync notifications, python manage.py solr_sync [domain ...].  Starts the sync queue of
+            every domain (or the ones named) with SOLR_SYNC=notify and indexes the json payloads published on their
+            DB_CHANNEL until it is stopped.  Run it in a single process, the api workers never consume notifications,
+            so each change is indexed once.
+
+            SOLR_SYNC_STATS_INTERVAL    seconds between the queue stats written to the log (default 60)
+"""
+import time
+from django.core.management.base import BaseCommand, CommandError
+from manage import logger
+from domain.conf import DOMAINS, domain_setting, get_domain
+from domain.solr_sync import start_notify_consumer
+
+class Command(BaseCommand):
+    help = "Index the documents published on DB_CHANNEL into SOLR, for the domains with SOLR_SYNC=notify."
+
+    def add_arguments(self, parser):
+        parser.add_argument("domains", nargs="*", help="Domains to consume, default all with SOLR_SYNC=notify.")
+
+    def handle(self, *args, **options):
+        try:
+            domains = [get_domain(slug) for slug in options["domains"]] or list(DOMAINS.values())
+        except KeyError as e:
+            raise CommandError(f"Unknown domain {str(e)}")
+
+        queues = {domain.slug: queue for domain in domains if (queue := start_notify_consumer(domain)) is not None}
+        if not queues:
+            raise CommandError("No domain to consume, set SOLR_SYNC=notify")
+        logger.info(f"Consuming SOLR sync notifications of {', '.join(queues)}")
+
+        interval = float(domain_setting("SOLR_SYNC_STATS_INTERVAL", 60))
+        try:
+            while True:
+                time.sleep(interval)
+                for slug, queue in queues.items():
+                    logger.info(f"SOLR sync of {slug}: {queue.stats()}")
+        except KeyboardInterrupt:
+            logger.info("Stopped consuming SOLR sync notifications")
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import copy
 import os
 import sys
 from pathlib import Path
@@ -53,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'domain.metrics.MetricsMiddleware',  # Stage timings of METRICS_SAMPLE_RATE of the requests, served on /metrics
+    'domain.compression.CompressionMiddleware',  # zstd, br or gzip per Accept-Encoding, before anything else reads the body
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -99,6 +102,48 @@ DATABASES = {
     }
 }
 
+def config_flag(name, default=False):
+    value = getattr(configs, name, default)
+    return value.strip().lower() in ('1', 'true', 'yes', 'on') if isinstance(value, str) else bool(value)
+
+# Pooled connections (psycopg 3).  Connections are checked on checkout, so a connection dropped by the server is
+# replaced instead of failing the request.  search_path is applied once per pooled connection, not per request.
+if config_flag('DATABASE_POOL'):
+    from psycopg_pool import ConnectionPool
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(getattr(configs, 'DATABASE_POOL_MIN_SIZE', 2)),
+        'max_size': int(getattr(configs, 'DATABASE_POOL_MAX_SIZE', 10)),
+        'timeout': float(getattr(configs, 'DATABASE_POOL_TIMEOUT', 10)),
+        'check': ConnectionPool.check_connection,
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(getattr(configs, 'DATABASE_CONN_MAX_AGE', 0))
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Server side prepared statements for the domain functions (psycopg 3), see domain/db.py.  Leave disabled behind a
+# transaction pooler that does not support prepared statements.
+DATABASE_PREPARED_STATEMENTS = config_flag('DATABASE_PREPARED_STATEMENTS')
+if DATABASE_PREPARED_STATEMENTS:
+    DATABASES['default']['OPTIONS']['server_side_binding'] = True
+
+# Read replicas (hot standbys) for the DomainDb reads, see domain/routing.py.  DATABASE_REPLICAS is a comma separated
+# list of 'host[:port]', each replica gets the database, credentials and options of default.
+_replicas = getattr(configs, 'DATABASE_REPLICAS', None) or []
+if isinstance(_replicas, str):
+    _replicas = _replicas.split(',')
+for _index, _replica in enumerate([replica.strip() for replica in _replicas if replica.strip()], start=1):
+    _host, _, _port = _replica.partition(':')
+    DATABASES[f'replica_{_index}'] = {**copy.deepcopy(DATABASES['default']), 'HOST': _host, 'PORT': _port or DATABASES['default']['PORT']}
+
+DATABASE_ROUTERS = ['domain.routing.ReplicaRouter']
+DATABASE_REPLICA_MAX_LAG = float(getattr(configs, 'DATABASE_REPLICA_MAX_LAG', 5))
+DATABASE_REPLICA_LAG_INTERVAL = float(getattr(configs, 'DATABASE_REPLICA_LAG_INTERVAL', 5))
+DATABASE_STICKY_SECONDS = float(getattr(configs, 'DATABASE_STICKY_SECONDS', 5))
+# ORM apps whose reads may go to the replicas.  Sessions and auth are read right after they are written, so none by default.
+DATABASE_REPLICA_APPS = getattr(configs, 'DATABASE_REPLICA_APPS', None) or []
+if isinstance(DATABASE_REPLICA_APPS, str):
+    DATABASE_REPLICA_APPS = [app.strip() for app in DATABASE_REPLICA_APPS.split(',') if app.strip()]
+
 
 
 # Password validation
@@ -149,6 +194,10 @@ TEST_RUNNER = 'api.test_runner.NoDbTestRunner'
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,  # Sets pagination to 10 items per page
+    'DEFAULT_RENDERER_CLASSES': [
+        'domain.renderers.FastJSONRenderer',  # orjson when installed, same output as the DRF JSONRenderer
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     # 'DEFAULT_AUTHENTICATION_CLASSES': [
     #     'rest_framework.authentication.BasicAuthentication',
     #     'rest_framework.authentication.SessionAuthentication',  # Optional for Browsable API
@@ -158,7 +207,7 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
         # 'rest_framework.authentication.BasicAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',  # Enable JWT auth
+        'domain.authentication.CachedJWTAuthentication',  # Enable JWT auth, with optional cache of verified tokens
         'rest_framework.authentication.SessionAuthentication',  # Optional for Browsable API
     ),
 }
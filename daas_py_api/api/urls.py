@@ -17,10 +17,12 @@ Including another URLconf
 from django.shortcuts import redirect
 from django.contrib import admin
 from django.urls import path, include
+from domain.metrics import metrics_view
 
 urlpatterns = [
     path('', lambda request: redirect('/api-auth/login/', permanent=True)),
     path('admin/', admin.site.urls),
     path('api/', include('domain.urls')),
     path('api-auth/', include('rest_framework.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
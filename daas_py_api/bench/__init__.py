@@ -0,0 +1,6 @@
+"""
+File: __init__.py
+Description: Benchmark harness for the domain endpoints.  The DBMS and SOLR are replaced by in-process stand-ins with
+            configurable latency and result sizes, so runs need no network and measure the cost of the API itself.
+            Run from the project directory with: python -m bench --help
+"""
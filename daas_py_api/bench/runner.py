@@ -0,0 +1,221 @@
+"""
+File: runner.py
+Description: Drives the domain views with APIRequestFactory at a fixed concurrency and reports latency percentiles,
+            throughput and peak RSS per endpoint.  Every endpoint runs in its own subprocess, so the peak RSS of one
+            endpoint is not inflated by the others, and the results are saved as json that --compare can diff.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMPARED_METRICS = ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "peak_rss_mb")
+
+class Scenario:
+    """One endpoint of a domain: the view class, the HTTP method and how to build the request."""
+
+    def __init__(self, view, method, path, params=None, body=None):
+        self.view = view
+        self.method = method
+        self.path = path
+        self.params = params or {}
+        self.body = body
+
+    def build_request(self, factory, slug, options):
+        path = f"/api/{slug}/{self.path}"
+        params = {**self.params, "facility": options.facilities[0]}
+        if self.method == "get":
+            return factory.get(path, params)
+        return factory.post(f"{path}?facility={params['facility']}", self.body(options), format="json")
+
+
+def upsert_body(options):
+    return [{"id": index + 1, options.facility_key: options.facilities[0], "name": f"object {index + 1}", "status": "active"}
+            for index in range(options.upsert_rows)]
+
+def query_body(options):
+    return {"q": "*:*", "rows": options.query_rows}
+
+def batch_body(options):
+    facility = {"facility": options.facilities[0]}
+    lookups = [{"endpoint": "db", "method": "POST", "params": facility, "body": [index + 1]} for index in range(5)]
+    searches = [{"endpoint": "cache-query", "params": facility, "body": query_body(options)} for index in range(3)]
+    return lookups + searches
+
+SCENARIOS = {
+    "db": Scenario("DomainDb", "get", "db/"),
+    "db-cursor": Scenario("DomainDb", "get", "db/", params={"paging": "cursor"}),
+    "db-upsert": Scenario("DomainDbUpsert", "post", "db/upsert/", body=upsert_body),
+    "cache": Scenario("DomainCache", "get", "cache"),
+    "cache-query": Scenario("DomainCacheQuery", "post", "cache/query", body=query_body),
+    "batch": Scenario("DomainBatch", "post", "batch", body=batch_body),
+}
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def setup_django():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
+    import django
+    django.setup()
+
+    from django.conf import settings
+    if "*" not in settings.ALLOWED_HOSTS and "testserver" not in settings.ALLOWED_HOSTS:
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "testserver"]
+
+def run_scenario(name, options):
+    """Run one endpoint in this process and return its metrics."""
+    setup_django()
+    from django.contrib.auth.models import User
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from domain import views
+    from domain.conf import DEFAULT_DOMAIN, get_domain
+    from . import stubs
+
+    scenario = SCENARIOS[name]
+    domain = get_domain(options.domain) if options.domain else DEFAULT_DOMAIN
+    options.facility_key = domain.setting("API_AUTH_FACILITY_KEY")
+    factory = APIRequestFactory()
+    user = User(id=1, username="bench")
+    claims = {"user_id": 1, "facility": options.facilities}
+
+    with stubs.installed(domain, options.facility_key, options.facilities, options.db_rows, options.db_latency_ms / 1000,
+                         options.solr_docs, options.solr_latency_ms / 1000):
+        view = getattr(views, scenario.view).as_view(domain_name=domain.slug)
+
+        def call():
+            request = scenario.build_request(factory, domain.slug, options)
+            force_authenticate(request, user=user, token=claims)
+            started = time.perf_counter()
+            response = view(request)
+            if hasattr(response, "render"):
+                response.render()
+            return time.perf_counter() - started, response.status_code
+
+        for _ in range(options.warmup):
+            call()
+
+        with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+            started = time.perf_counter()
+            outcomes = list(executor.map(lambda _: call(), range(options.requests)))
+            wall = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, status_code in outcomes)
+    return {
+        "domain": domain.slug,
+        "requests": len(outcomes),
+        "errors": sum(1 for latency, status_code in outcomes if status_code >= 400),
+        "concurrency": options.concurrency,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "max_ms": round(latencies[-1], 3),
+        "throughput_rps": round(len(outcomes) / wall, 1),
+        "wall_seconds": round(wall, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_child(name, argv):
+    """Run one endpoint in a fresh interpreter and return its metrics."""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as result_file:
+        result_path = result_file.name
+    try:
+        subprocess.run([sys.executable, "-m", "bench", *argv, "--child", name, "--result-file", result_path],
+                       cwd=PROJECT_DIR, check=True)
+        with open(result_path) as result_file:
+            return json.load(result_file)
+    finally:
+        os.unlink(result_path)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    header = f"{'endpoint':<12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'rss MB':>8} {'errors':>7}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(f"{name:<12} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['p99_ms']:>9} "
+              f"{result['throughput_rps']:>9} {result['peak_rss_mb']:>8} {result['errors']:>7}")
+        previous = (baseline or {}).get(name)
+        if previous:
+            deltas = []
+            for metric in COMPARED_METRICS:
+                if previous.get(metric):
+                    deltas.append(f"{metric} {100 * (result[metric] - previous[metric]) / previous[metric]:+.1f}%")
+            print(f"{'':<12} vs baseline: {', '.join(deltas)}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the domain endpoints against local DB and SOLR stand-ins.")
+    parser.add_argument("--endpoints", default=",".join(SCENARIOS), help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--domain", help="domain to drive, defaults to the first registered domain")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=500, help="timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests per endpoint")
+    parser.add_argument("--db-rows", type=int, default=1000, help="rows returned by the DB_FUNC_GET stand-in")
+    parser.add_argument("--db-latency-ms", type=float, default=2.0, help="latency of each DB function call")
+    parser.add_argument("--solr-docs", type=int, default=1000, help="documents in the SOLR stand-in")
+    parser.add_argument("--solr-latency-ms", type=float, default=2.0, help="latency of each SOLR request")
+    parser.add_argument("--upsert-rows", type=int, default=100, help="documents per db-upsert request")
+    parser.add_argument("--query-rows", type=int, default=100, help="rows asked for by cache-query requests")
+    parser.add_argument("--facilities", default="BENCH1,BENCH2", help="facilities in the token, the first is requested")
+    parser.add_argument("--output", help="where to save the results, defaults to bench-<timestamp>.json")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    options.facilities = [facility.strip() for facility in options.facilities.split(",") if facility.strip()]
+    return options
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    options = parse_args(argv)
+
+    if options.child:
+        result = run_scenario(options.child, options)
+        with open(options.result_file, "w") as result_file:
+            json.dump(result, result_file)
+        return
+
+    names = [name.strip() for name in options.endpoints.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown endpoints {unknown}, expected some of {list(SCENARIOS)}")
+
+    results = {name: run_child(name, argv) for name in names}
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+    print_results(results, baseline)
+
+    timestamp = datetime.datetime.now(datetime.timezone.utc)
+    output = options.output or f"bench-{timestamp.strftime('%Y%m%dT%H%M%SZ')}.json"
+    meta = {key: value for key, value in vars(options).items() if key not in ("child", "result_file", "output", "compare")}
+    meta.update({"timestamp": timestamp.isoformat(), "revision": git_revision(), "python": platform.python_version()})
+    with open(output, "w") as output_file:
+        json.dump({"meta": meta, "results": results}, output_file, indent=2)
+    print(f"Saved results to {os.path.abspath(output)}")
@@ -0,0 +1,216 @@
+"""
+File: stubs.py
+Description: In-process stand-ins for the DB_FUNC_* functions and the SOLR select/update handlers.  The views are
+            left untouched: the DB connection of domain.views is replaced by StubConnection, and SOLR sessions get a
+            requests adapter that answers locally, so pysolr still builds and parses real HTTP payloads.
+"""
+import collections
+import contextlib
+import datetime
+import json
+import re
+import time
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+import requests
+from requests.adapters import BaseAdapter
+
+WHERE_PATTERN = re.compile(r"WHERE t\.\w+ ([<>]) %s")
+ORDER_PATTERN = re.compile(r"ORDER BY t\.\w+ (ASC|DESC) LIMIT %s")
+FUNCTION_PATTERN = re.compile(r"FROM\s+([\w.]+)\(")
+PROJECTION_PATTERN = re.compile(r't\."(\w+)"')
+
+def make_rows(count, key, facility_key, facilities):
+    """Deterministic domain rows, with the value types the real functions return."""
+    columns = [key, facility_key, "name", "status", "amount", "update_ts"]
+    start = datetime.datetime(2025, 1, 1)
+    rows = [(index + 1, facilities[index % len(facilities)], f"object {index + 1}", "active" if index % 3 else "inactive",
+             Decimal(index) / 100, start + datetime.timedelta(minutes=index)) for index in range(count)]
+    return columns, rows
+
+
+class StubDatabase:
+    """Answers the SQL the views send for the functions of one domain, after sleeping for latency seconds."""
+
+    def __init__(self, domain, rows, latency, facility_key, facilities):
+        self.domain = domain
+        self.latency = latency
+        self.columns, self.rows = make_rows(rows, domain.db_key, facility_key, facilities)
+        self.functions = {
+            domain.db_func_get: self.get,
+            domain.db_func_get_by_id: self.get_by_id,
+            domain.db_func_upsert: self.upsert,
+        }
+        if domain.db_func_get_page:
+            self.functions[domain.db_func_get_page] = self.get_page
+
+    def run(self, sql, params):
+        match = FUNCTION_PATTERN.search(sql)
+        if match is None or match.group(1) not in self.functions:
+            raise ValueError(f"Stub database has no function for: {sql}")
+        if self.latency:
+            time.sleep(self.latency)
+        rows = self.functions[match.group(1)](params)
+        order = ORDER_PATTERN.search(sql)
+        if order:
+            # Keyset query wrapped around the generic function.
+            where = WHERE_PATTERN.search(sql)
+            if where:
+                position = params[1]
+                rows = [row for row in rows if (row[0] > position if where.group(1) == ">" else row[0] < position)]
+            rows = sorted(rows, key=lambda row: row[0], reverse=order.group(1) == "DESC")[:params[-1]]
+        selected = PROJECTION_PATTERN.findall(sql[:match.start()])
+        if selected:
+            indexes = [self.columns.index(column) for column in selected]
+            return selected, [tuple(row[index] for index in indexes) for row in rows]
+        return self.columns, rows
+
+    def get(self, params):
+        return self.rows
+
+    def get_page(self, params):
+        user_id, position, limit, reverse = params
+        rows = [row for row in self.rows if position is None or (row[0] < position if reverse else row[0] > position)]
+        return sorted(rows, key=lambda row: row[0], reverse=bool(reverse))[:limit]
+
+    def get_by_id(self, params):
+        ids = json.loads(params[0])
+        ids = ids if isinstance(ids, list) else [ids]
+        return self.rows[:len(ids)]
+
+    def upsert(self, params):
+        items = json.loads(params[0])
+        items = items if isinstance(items, list) else [items]
+        return [tuple(item.get(column, default) for column, default in zip(self.columns, self.rows[0])) for item in items]
+
+
+class StubCursor:
+
+    def __init__(self, database):
+        self.database = database
+        self.description = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def execute(self, sql, params=None):
+        columns, self._rows = self.database.run(sql, params or [])
+        self.description = [(column,) for column in columns]
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return list(rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return list(rows)
+
+    def close(self):
+        self._rows = []
+
+
+class StubConnection:
+    """Stands in for django.db.connection in the views."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return StubCursor(self.database)
+
+
+class StubSolrAdapter(BaseAdapter):
+    """requests transport answering SOLR select, update and Luke index version requests from a fixed set of documents."""
+
+    def __init__(self, documents, latency):
+        super().__init__()
+        self.documents = documents
+        self.latency = latency
+        self.version = 1
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlsplit(request.url)
+        if url.path.rstrip("/").endswith("/select"):
+            params = parse_qs(url.query)
+            if request.body:
+                body = request.body.decode("utf-8") if isinstance(request.body, bytes) else request.body
+                params.update(parse_qs(body))
+            payload = self.select(params)
+        elif url.path.rstrip("/").endswith("/admin/luke"):
+            payload = {"responseHeader": {"status": 0, "QTime": 1}, "index": {"version": self.version}}
+        else:
+            # Updates open a new searcher, as a commit would.
+            self.version += 1
+            payload = {"responseHeader": {"status": 0, "QTime": 1}}
+        return self.build_response(request, payload)
+
+    def select(self, params):
+        rows = int(params.get("rows", ["10"])[0])
+        cursor_mark = params.get("cursorMark", [None])[0]
+        start = int(params.get("start", ["0"])[0]) if cursor_mark is None else (0 if cursor_mark == "*" else int(cursor_mark))
+        documents = self.documents[start:start + rows]
+        if params.get("fl"):
+            fields = params["fl"][0].split(",")
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        payload = {
+            "responseHeader": {"status": 0, "QTime": 1},
+            "response": {"numFound": len(self.documents), "start": start, "docs": documents},
+        }
+        if cursor_mark is not None:
+            payload["nextCursorMark"] = str(start + len(documents))
+        return payload
+
+    def build_response(self, request, payload):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(payload).encode("utf-8")
+        response.headers["Content-Type"] = "application/json; charset=utf-8"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def make_documents(count, key, facility_key, facilities):
+    columns, rows = make_rows(count, key, facility_key, facilities)
+    return [{column: value if isinstance(value, (int, str)) else str(value) for column, value in zip(columns, row)}
+            for row in rows]
+
+
+@contextlib.contextmanager
+def installed(domain, facility_key, facilities, db_rows, db_latency, solr_docs, solr_latency):
+    """Route the DB and SOLR calls of the domain views to the stand-ins for the duration of the block."""
+    from domain import db, notify, solr, views
+
+    database = StubDatabase(domain, db_rows, db_latency, facility_key, facilities)
+    documents = make_documents(solr_docs, domain.setting("SOLR_UNIQUE_KEY", "id"), facility_key, facilities)
+    adapter = StubSolrAdapter(documents, solr_latency)
+
+    def stub_session(pool_size, max_retries):
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    with contextlib.ExitStack() as stack:
+        connection = StubConnection(database)
+        stack.enter_context(mock.patch.object(views, "connection", connection))
+        # Reads go through the alias picked by the replica routing, the stand-in serves every alias.
+        stack.enter_context(mock.patch.object(views, "connections", collections.defaultdict(lambda: connection)))
+        # Server-side prepared statements need a real psycopg cursor.
+        stack.enter_context(mock.patch.object(db, "PREPARE", False))
+        stack.enter_context(mock.patch.object(solr, "_get_session", stub_session))
+        stack.enter_context(mock.patch.dict(solr._clients, clear=True))
+        # Cache invalidation and SOLR sync would otherwise LISTEN on the real DBMS.
+        stack.enter_context(mock.patch.object(notify, "subscribe", lambda channel, callback: None))
+        yield database, adapter
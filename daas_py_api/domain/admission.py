@@ -0,0 +1,292 @@
+"""
+File: admission.py
+Description: Admission control in front of the DBMS and SOLR.  A request takes a slot of up to three concurrency
+            limiters before its backend work runs, and gives them back when the response is returned (or, for the
+            streamed export, when the stream ends):
+
+            tenant    API_LIMIT_TENANT concurrent requests per user_id, or per facility set with
+                      API_LIMIT_TENANT_KEY=facility.  Over the limit the request is refused with 429 at once.
+            endpoint  API_LIMIT_ENDPOINT_<ENDPOINT> concurrent requests of an endpoint of the domain, i.e.
+                      API_LIMIT_ENDPOINT_CACHE_QUERY or API_LIMIT_ENDPOINT_DB_UPSERT_ASSET.
+            backend   API_LIMIT_BACKEND_DB / API_LIMIT_BACKEND_SOLR concurrent requests of the process on the
+                      backend, across domains.
+
+            Endpoint and backend limiters queue up to API_LIMIT_QUEUE requests for at most API_LIMIT_QUEUE_TIMEOUT
+            seconds (default 1), past that the request is refused with 503.  Refusals carry Retry-After
+            (API_LIMIT_RETRY_AFTER seconds, default 1).  A limit of 0 (the default) turns a limiter off.  The tenant
+            limits and the queue settings can also be set per endpoint, i.e. API_LIMIT_TENANT_CACHE_QUERY, and like
+            every setting per domain.  Requests served by the response cache or a shared read only take a tenant slot.
+"""
+import asyncio
+import collections
+import functools
+import threading
+from asgiref.sync import iscoroutinefunction
+from rest_framework import status
+from rest_framework.exceptions import APIException, Throttled
+from manage import logger
+from .authentication import get_claims
+from .conf import domain_setting
+from . import metrics
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Service overloaded, try again later."
+    default_code = "overloaded"
+
+    def __init__(self, detail=None, wait=None):
+        super().__init__(detail)
+        # Sent as Retry-After by the DRF exception handler.
+        self.wait = wait
+
+
+class Rejected(Exception):
+    """Raised by Limiter.acquire when the limiter is full."""
+
+
+class _Waiter:
+    __slots__ = ("granted", "event", "loop", "future")
+
+    def __init__(self, loop=None):
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class Limiter:
+    """
+    Counting semaphore with a bounded FIFO wait queue, shared by threads and event loops.  A released slot is handed
+    to the oldest waiter directly, so late arrivals cannot overtake the queue.
+    """
+
+    def __init__(self, name, limit, queue_size=0, timeout=0.0):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.users = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def _enter(self, loop=None):
+        """Take a free slot and return None, or return the waiter to wait on.  Called with the lock held."""
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= self.queue_size:
+            raise Rejected(self.name)
+        waiter = _Waiter(loop)
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter):
+        """Leave the queue after a timeout.  Return True when the slot was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def acquire(self):
+        with self._lock:
+            waiter = self._enter()
+        if waiter is None:
+            return
+        if not waiter.event.wait(self.timeout) and not self._give_up(waiter):
+            raise Rejected(self.name)
+
+    async def acquire_async(self):
+        with self._lock:
+            waiter = self._enter(asyncio.get_running_loop())
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except asyncio.TimeoutError:
+            if not self._give_up(waiter):
+                raise Rejected(self.name)
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the oldest waiter, active stays the same.
+                self._waiters.popleft().grant()
+            else:
+                self.active -= 1
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _check_out(key, limit, queue_size, timeout):
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = Limiter(":".join(str(part) for part in key), limit, queue_size, timeout)
+        limiter.users += 1
+    return limiter
+
+def _check_in(key, limiter):
+    """Limiters are dropped once no request holds or waits for them, tenant limiters come and go with the users."""
+    with _limiters_lock:
+        limiter.users -= 1
+        if limiter.users == 0:
+            del _limiters[key]
+
+def _setting(domain, name, endpoint, default):
+    value = domain.setting(f"{name}_{endpoint.upper().replace('-', '_')}")
+    if value is None:
+        value = domain.setting(name, default)
+    return value
+
+def _tenant(domain, request):
+    claims = get_claims(request)
+    if str(domain.setting("API_LIMIT_TENANT_KEY", "user")).lower() == "facility":
+        return ",".join(sorted(claims.facility_set))
+    return str(claims.user_id)
+
+
+class Admission:
+    """The limiter slots of one request, taken in order (tenant, endpoint, backend) and given back in reverse."""
+
+    def __init__(self, domain, endpoint, backend, request, tenant=True):
+        self.held = []
+        self.plan = []
+        self.retry_after = int(domain.setting("API_LIMIT_RETRY_AFTER", 1))
+        queue_size = int(_setting(domain, "API_LIMIT_QUEUE", endpoint, 100))
+        timeout = float(_setting(domain, "API_LIMIT_QUEUE_TIMEOUT", endpoint, 1))
+
+        tenant_limit = int(_setting(domain, "API_LIMIT_TENANT", endpoint, 0)) if tenant else 0
+        if tenant_limit > 0:
+            key = ("tenant", domain.slug, endpoint, _tenant(domain, request))
+            self.plan.append((key, tenant_limit, int(_setting(domain, "API_LIMIT_TENANT_QUEUE", endpoint, 0)), timeout, True))
+        if backend is None:
+            return
+        endpoint_limit = int(_setting(domain, "API_LIMIT_ENDPOINT", endpoint, 0))
+        if endpoint_limit > 0:
+            self.plan.append((("endpoint", domain.slug, endpoint), endpoint_limit, queue_size, timeout, False))
+        # Backend slots bound process wide resources (DB pool, SOLR sessions), see domain_setting.
+        backend_limit = int(domain_setting(f"API_LIMIT_BACKEND_{backend.upper()}", 0))
+        if backend_limit > 0:
+            self.plan.append(((backend,), backend_limit, int(domain_setting("API_LIMIT_QUEUE", 100)),
+                              float(domain_setting("API_LIMIT_QUEUE_TIMEOUT", 1)), False))
+
+    def refuse(self, key, limiter, tenant):
+        _check_in(key, limiter)
+        self.release()
+        logger.warning(f"Admission refused by limiter {limiter.name}, active:{limiter.active}")
+        if tenant:
+            raise Throttled(wait=self.retry_after, detail="Too many concurrent requests, try again later.")
+        raise Overloaded(wait=self.retry_after)
+
+    def __enter__(self):
+        with metrics.stage("admission"):
+            for key, limit, queue_size, timeout, tenant in self.plan:
+                limiter = _check_out(key, limit, queue_size, timeout)
+                try:
+                    limiter.acquire()
+                except Rejected:
+                    self.refuse(key, limiter, tenant)
+                self.held.append((key, limiter))
+        return self
+
+    async def __aenter__(self):
+        with metrics.stage("admission"):
+            for key, limit, queue_size, timeout, tenant in self.plan:
+                limiter = _check_out(key, limit, queue_size, timeout)
+                try:
+                    await limiter.acquire_async()
+                except Rejected:
+                    self.refuse(key, limiter, tenant)
+                except asyncio.CancelledError:
+                    _check_in(key, limiter)
+                    self.release()
+                    raise
+                self.held.append((key, limiter))
+        return self
+
+    def release(self):
+        while self.held:
+            key, limiter = self.held.pop()
+            limiter.release()
+            _check_in(key, limiter)
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def release_after(self, response):
+        """Keep the slots until a streaming response is consumed or closed, release them now otherwise."""
+        if not getattr(response, "streaming", False):
+            self.release()
+            return response
+        if response.is_async:
+            response.streaming_content = self._release_at_end_async(response.streaming_content)
+        else:
+            response.streaming_content = self._release_at_end(response.streaming_content)
+        return response
+
+    def _release_at_end(self, chunks):
+        try:
+            yield from chunks
+        finally:
+            self.release()
+
+    async def _release_at_end_async(self, chunks):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.release()
+
+
+def admitted(endpoint, backend=None, tenant=True):
+    """
+    Run a view method inside the admission slots of its tenant, endpoint and backend (db or solr), or of the tenant
+    only without a backend.  Cached reads take the tenant slot above cached_response and the others below it with
+    tenant=False, so cache hits and shared reads hold no backend slot, and a 429 of one user is never shared with the
+    others waiting for the same read.  Works for sync and async methods.
+    """
+    def decorator(method):
+        if iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                admission = await Admission(view.domain, endpoint, backend, request, tenant).__aenter__()
+                try:
+                    response = await method(view, request, *args, **kwargs)
+                except BaseException:
+                    admission.release()
+                    raise
+                return admission.release_after(response)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            admission = Admission(view.domain, endpoint, backend, request, tenant).__enter__()
+            try:
+                response = method(view, request, *args, **kwargs)
+            except BaseException:
+                admission.release()
+                raise
+            return admission.release_after(response)
+        return wrapper
+    return decorator
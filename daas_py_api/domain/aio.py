@@ -0,0 +1,133 @@
+"""
+File: aio.py
+Description: Async clients for the DBMS (psycopg connection pool) and SOLR (httpx) used by the async views.  Both are
+            created on first use inside the worker's event loop and shared by every request and domain it serves.
+"""
+import asyncio
+import json
+import uuid
+import httpx
+from psycopg_pool import AsyncConnectionPool
+from rest_framework.utils.encoders import JSONEncoder
+from manage import logger
+from .conf import domain_setting
+from .db import PREPARE, db_connection_kwargs
+from .solr import SOLR_AUTH, LUKE_INDEX_PARAMS
+from . import metrics
+
+_db_pools = {}
+_db_pool_lock = asyncio.Lock()
+_solr_client = None
+
+async def get_db_pool(alias="default"):
+    """Return the async connection pool of a Django database (default or a replica), opening it on first use."""
+    pool = _db_pools.get(alias)
+    if pool is None:
+        async with _db_pool_lock:
+            pool = _db_pools.get(alias)
+            if pool is None:
+                pool = AsyncConnectionPool(kwargs={**db_connection_kwargs(alias), "autocommit": True},
+                                           min_size=int(domain_setting("DATABASE_POOL_MIN_SIZE", 2)),
+                                           max_size=int(domain_setting("DATABASE_POOL_MAX_SIZE", 10)),
+                                           check=AsyncConnectionPool.check_connection,
+                                           open=False)
+                await pool.open()
+                _db_pools[alias] = pool
+                logger.info(f"Opened async DB pool {alias} min_size={pool.min_size} max_size={pool.max_size}")
+    return pool
+
+async def fetch(sql, params, alias="default"):
+    """Execute a query on a pooled connection of the database alias and return (columns, rows)."""
+    pool = await get_db_pool(alias)
+    async with pool.connection() as conn:
+        with metrics.stage("db_execute"):
+            cursor = await conn.execute(sql, params, prepare=PREPARE or None)
+        if cursor.description is None:
+            return [], []
+        columns = [col.name for col in cursor.description]
+        with metrics.stage("db_fetch"):
+            rows = await cursor.fetchall()
+    return columns, rows
+
+async def stream_query(sql, params, itersize, alias="default"):
+    """
+    Async counterpart of db.stream_query: a server-side cursor on a pooled connection of the database alias.  Yields
+    the column names first, then batches of at most itersize rows.
+    """
+    pool = await get_db_pool(alias)
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor(name=f"daas_stream_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = itersize
+                await cursor.execute(sql, params)
+                rows = await cursor.fetchmany(itersize)
+                yield [col.name for col in cursor.description]
+                while rows:
+                    yield rows
+                    rows = await cursor.fetchmany(itersize)
+
+async def start_stream(batches):
+    """Async counterpart of db.start_stream."""
+    columns = await anext(batches)
+    return _resume(columns, batches)
+
+async def _resume(columns, batches):
+    try:
+        yield columns
+        async for rows in batches:
+            yield rows
+    finally:
+        await batches.aclose()
+
+def get_solr_client():
+    """Return the async SOLR http client.  It keeps up to SOLR_ASYNC_POOL_SIZE connections open to SOLR."""
+    global _solr_client
+    if _solr_client is None:
+        pool_size = int(domain_setting("SOLR_ASYNC_POOL_SIZE", 100))
+        _solr_client = httpx.AsyncClient(auth=SOLR_AUTH,
+                                         limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                                         timeout=httpx.Timeout(float(domain_setting("SOLR_TIMEOUT", 60)),
+                                                               connect=float(domain_setting("SOLR_CONNECT_TIMEOUT", 5))))
+    return _solr_client
+
+async def solr_search(domain, solr_params, url=None, timeout=None):
+    """
+    Run a SOLR select on the collection of the domain, or one replica url of it, and return the decoded json response.
+    timeout overrides the read timeout of the client.  The views search through solr_replicas.asearch, which times the
+    hedged searches as one stage.
+    """
+    client = get_solr_client()
+    timeout = httpx.Timeout(timeout, connect=client.timeout.connect) if timeout else httpx.USE_CLIENT_DEFAULT
+    response = await client.post(f"{url or domain.solr_url}/select", data={**solr_params, "wt": "json"}, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+async def solr_index(domain, documents, policy):
+    """Async counterpart of solr.index_documents, sending chunks of SOLR_BATCH_SIZE and committing per the policy."""
+    if not documents:
+        return
+
+    client = get_solr_client()
+    headers = {"Content-Type": "application/json"}
+    url = domain.solr_url
+    batch_size = int(domain.setting("SOLR_BATCH_SIZE", 1000))
+    params = {"commitWithin": int(domain.setting("SOLR_COMMIT_WITHIN_MS", 1000))} if policy == "within" else {}
+
+    with metrics.stage("solr"):
+        for start in range(0, len(documents), batch_size):
+            body = json.dumps(documents[start:start + batch_size], cls=JSONEncoder)
+            response = await client.post(f"{url}/update", params=params, content=body, headers=headers)
+            response.raise_for_status()
+
+        if policy in ("soft", "explicit"):
+            commit = {"softCommit": "true"} if policy == "soft" else {"commit": "true"}
+            response = await client.post(f"{url}/update", params=commit, content="[]", headers=headers)
+            response.raise_for_status()
+
+async def solr_index_version(domain, url=None, timeout=None):
+    """Async counterpart of solr.index_version."""
+    with metrics.stage("solr"):
+        response = await get_solr_client().get(f"{url or domain.solr_url}/admin/luke", params=LUKE_INDEX_PARAMS,
+                                               timeout=timeout or httpx.USE_CLIENT_DEFAULT)
+        response.raise_for_status()
+        return response.json()["index"]["version"]
@@ -0,0 +1,353 @@
+"""
+File: async_views.py
+Description: Async versions of the generic domain views for ASGI deployments.  The DBMS is reached through an async
+            psycopg pool and SOLR through httpx, so a single worker can keep many slow requests in flight.  Routes,
+            authentication and facility authorization are the same as the sync views in views.py.
+"""
+import functools
+import json
+import pysolr
+from adrf.views import APIView
+from django.http import StreamingHttpResponse
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
+from manage import logger
+from . import aio, metrics
+from .authentication import CachedJWTAuthentication
+from .bulk import bulk_requested, get_bulk_options, split, arun_chunks, bulk_response
+from .projection import requested_fields, select_list, field_errors
+from .facets import get_facet_params, get_facet_results
+from .batch import parse_batch, arun_batch, batch_response
+from .pagination import (KeysetPagination, SolrCursorPagination, WatermarkPagination, cursor_pagination_requested,
+                         keyset_query, changes_query)
+from .permissions import FacilityPermission
+from .response_cache import cached_response, invalidate_response_cache
+from .conditional import conditional_response
+from .admission import admitted
+from .routing import areplica_read, sticky_writes
+from .solr import resolve_commit_policy
+from .solr_replicas import FALLBACK_HEADER, SolrUnavailable, asearch, fallback_allowed
+from .renderers import RowSet, FastJSONRenderer, CompactJSONRenderer, NDJSONRenderer, CSVRenderer, COLUMNAR_RENDERERS
+from .solr_sync import sync_upserted
+from .views import (configs, DomainMixin, get_jwt_hashed_values, get_cache_search_params, add_facility_filter,
+                    add_field_list, limit_rows, get_cache_documents)
+
+class DomainDb(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, CompactJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @conditional_response("db", "db")
+    @admitted("db")
+    @cached_response("db", "db")
+    @admitted("db", "db", tenant=False)
+    async def get(self, request):
+        """Retrieve all domain objects using a stored procedure"""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+
+        if cursor_pagination_requested(request, self.domain.setting("PAGINATION_MODE_DB", "page")):
+            return await self.get_keyset_page(request, user_id, fields)
+
+        with field_errors():
+            columns, rows = await areplica_read(request, functools.partial(aio.fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;", [user_id]))
+
+        # Apply pagination to the raw rows, only the rows of the page are rendered
+        paginator = PageNumberPagination()
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_DB"))
+        with metrics.stage("paginate"):
+            paginated_rows = paginator.paginate_queryset(rows, request)
+        metrics.record_rows(len(paginated_rows))
+
+        return paginator.get_paginated_response(RowSet(columns, paginated_rows))
+
+    async def get_keyset_page(self, request, user_id, fields=None):
+        """Retrieve one page of domain objects, pushing the last seen key and the limit down to the DB."""
+        paginator = KeysetPagination(key=self.domain.db_key, page_size=int(self.domain.setting("PAGINATION_SIZE_DB")))
+        position, reverse = paginator.decode_cursor(request)
+
+        sql, params = keyset_query(self.domain.db_func_get, self.domain.db_func_get_page, user_id, self.domain.db_key, position, reverse, paginator.page_size + 1, fields)
+        with field_errors():
+            columns, rows = await areplica_read(request, functools.partial(aio.fetch, sql, params))
+        with metrics.stage("paginate"):
+            rows = paginator.paginate_rows(request, columns, rows, position, reverse)
+        metrics.record_rows(len(rows))
+
+        return paginator.get_paginated_response(RowSet(columns, rows))
+
+    @admitted("db", "db")
+    async def post(self, request):
+        """Retrieve multiple domain objects using a stored procedure with JSON list of IDs"""
+        fields = requested_fields(request, self.domain.db_key)
+        try:
+            user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+            with field_errors():
+                columns, rows = await areplica_read(request, functools.partial(aio.fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get_by_id}(%s, %s) AS t;", [json.dumps(request.data), user_id]))
+            if rows:
+                metrics.record_rows(len(rows))
+                return Response(RowSet(columns, rows))
+
+            return Response({"error": f"No {self.domain.slug} found"}, status=status.HTTP_204_NO_CONTENT)
+
+        except ParseError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌Error retrieving {self.domain.slug}: {str(e)}")
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class DomainDbChanges(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, CompactJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @admitted("db-changes", "db")
+    async def get(self, request):
+        """Retrieve one page of the domain objects changed after ?since=, with the watermark to resume from."""
+        if not self.domain.db_func_get_changes:
+            raise NotFound(f"Changes are not configured for {self.domain.slug}, set DB_FUNC_GET_CHANGES_{self.domain.name}")
+
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+        if fields and self.domain.db_watermark not in fields:
+            fields.append(self.domain.db_watermark)
+
+        paginator = WatermarkPagination(self.domain.db_watermark, self.domain.db_key, int(self.domain.setting("PAGINATION_SIZE_DB")))
+        since = paginator.decode_since(request)
+
+        sql, params = changes_query(self.domain.db_func_get_changes, user_id, *since, paginator.page_size + 1, fields)
+        with field_errors():
+            columns, rows = await aio.fetch(sql, params)
+        with metrics.stage("paginate"):
+            rows = paginator.paginate_rows(request, columns, rows, since)
+        metrics.record_rows(len(rows))
+
+        return paginator.get_paginated_response(RowSet(columns, rows))
+
+# Class for streaming a full extract of the domain, in the formats of views.DomainDbExport.
+class DomainDbExport(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [NDJSONRenderer, CSVRenderer] + COLUMNAR_RENDERERS
+
+    @admitted("db-export", "db")
+    async def get(self, request):
+        """Stream all domain objects from an async server-side cursor, one batch in memory at a time."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+
+        renderer = request.accepted_renderer
+        sql = f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;"
+        itersize = int(self.domain.setting("DB_EXPORT_ITERSIZE", 2000))
+        with field_errors():
+            batches = await areplica_read(request, lambda alias: aio.start_stream(aio.stream_query(sql, [user_id], itersize, alias)))
+
+        content_type = f"{renderer.media_type}; charset={renderer.charset}" if renderer.charset else renderer.media_type
+        response = StreamingHttpResponse(renderer.render_stream_async(batches), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{self.domain.slug}.{renderer.format}"'
+        return response
+
+class DomainDbUpsert(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+
+    @admitted("db-upsert", "db")
+    @sticky_writes
+    async def post(self, request):
+        """Upsert domain objects using a stored procedure.  Pass ?bulk=true to upsert large payloads in chunks."""
+        if bulk_requested(request):
+            return await self.post_bulk(request)
+
+        json_data = json.dumps(request.data)
+
+        try:
+            user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+            columns, rows = await aio.fetch(f"SELECT * FROM {self.domain.db_func_upsert}(%s, %s, %s, %s);",
+                                            [json_data, self.domain.db_channel, user_id, self.domain.db_channel_parent])
+            invalidate_response_cache(self.domain)
+            if rows:
+                response = Response([dict(zip(columns, row)) for row in rows])
+
+                # Never wait for room in the SOLR sync queue on the event loop.
+                sync_status = sync_upserted(self.domain, columns, rows, timeout=0)
+                if sync_status:
+                    response["X-Solr-Sync"] = sync_status
+                return response
+
+            return Response({"error": f"No {self.domain.slug} found"}, status=status.HTTP_204_NO_CONTENT)
+        except Exception as e:
+            logger.exception(f"❌Error retrieving {self.domain.slug}: {str(e)}")
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def post_bulk(self, request):
+        """Upsert the payload in chunks of ?chunk_size=, ?return=counts (default), keys or rows."""
+        try:
+            chunk_size, returning = get_bulk_options(request, self.domain)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        async def run_chunk(chunk):
+            columns, rows = await aio.fetch(f"SELECT * FROM {self.domain.db_func_upsert}(%s, %s, %s, %s);",
+                                            [json.dumps(chunk), self.domain.db_channel, user_id, self.domain.db_channel_parent])
+            sync_upserted(self.domain, columns, rows, timeout=0)
+            return columns, rows
+
+        results = await arun_chunks(split(request.data, chunk_size), run_chunk, self.domain.db_key, returning)
+        invalidate_response_cache(self.domain)
+
+        return bulk_response(results)
+
+class DomainCache(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @conditional_response("cache", "solr")
+    @admitted("cache")
+    @cached_response("cache", "solr")
+    @admitted("cache", "solr", tenant=False)
+    async def get(self, request):
+        """Retrieve ALL domain objects from SOLR."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        solr_params = get_cache_search_params(request)
+        add_facility_filter(solr_params, facilities)
+        add_field_list(solr_params, request, self.domain.setting("SOLR_UNIQUE_KEY", "id"))
+
+        if cursor_pagination_requested(request, self.domain.setting("PAGINATION_MODE_SOLR", "page")):
+            paginator = SolrCursorPagination(unique_key=self.domain.setting("SOLR_UNIQUE_KEY", "id"), page_size=int(self.domain.setting("PAGINATION_SIZE_SOLR")))
+            paginator.apply(request, solr_params)
+
+            logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
+
+            results = pysolr.Results(await asearch(self.domain, solr_params))
+            documents = paginator.paginate_results(request, solr_params, results)
+            metrics.record_rows(len(documents))
+            return paginator.get_paginated_response(documents)
+
+        logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
+
+        try:
+            results = pysolr.Results(await asearch(self.domain, solr_params))
+        except SolrUnavailable:
+            if not fallback_allowed(self.domain, request):
+                raise
+            return await self.get_db_fallback(request, user_id)
+
+        # Apply pagination
+        paginator = PageNumberPagination()
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_SOLR"))
+        with metrics.stage("paginate"):
+            paginated_results = paginator.paginate_queryset(list(results.docs), request)
+        metrics.record_rows(len(paginated_results))
+
+        return paginator.get_paginated_response(paginated_results)
+
+    async def get_db_fallback(self, request, user_id):
+        """Serve the lookup from DB_FUNC_GET while no SOLR replica can answer (SOLR_DB_FALLBACK), see solr_replicas.py."""
+        logger.warning(f"Serving {self.domain.slug} cache lookup of user_id:{user_id} from the DB, SOLR is unavailable")
+        fields = requested_fields(request, self.domain.db_key)
+
+        with field_errors():
+            columns, rows = await areplica_read(request, functools.partial(aio.fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;", [user_id]))
+
+        paginator = PageNumberPagination()
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_SOLR"))
+        with metrics.stage("paginate"):
+            paginated_rows = paginator.paginate_queryset(rows, request)
+        metrics.record_rows(len(paginated_rows))
+
+        response = paginator.get_paginated_response(RowSet(columns, paginated_rows))
+        response[FALLBACK_HEADER] = "db"
+        return response
+
+    @admitted("cache", "solr")
+    async def post(self, request):
+        """Upsert new domain objects to SOLR.  Pass ?commit=true (soft) or ?commit=explicit to make them visible on return."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        try:
+            commit_policy = resolve_commit_policy(self.domain, request.query_params.get("commit"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        documents, error = get_cache_documents(request.data)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        #### AUTHORIZATION - remove document updates where users doesn't have access  ####
+        filtered_documents = [doc for doc in documents if doc[configs.API_AUTH_FACILITY_KEY] in facilities]
+
+        await aio.solr_index(self.domain, filtered_documents, commit_policy)
+        invalidate_response_cache(self.domain)
+
+        return Response(documents, status=status.HTTP_201_CREATED)
+
+class DomainCacheQuery(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @admitted("cache-query", "solr")
+    async def post(self, request):
+        """Post api to query SOLR with input body of request."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        solr_params = request.data
+        add_facility_filter(solr_params, facilities)
+        add_field_list(solr_params, request, self.domain.setting("SOLR_UNIQUE_KEY", "id"))
+        limit_rows(solr_params)
+
+        logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
+
+        return Response(await asearch(self.domain, solr_params), status=status.HTTP_200_OK)
+
+class DomainCacheFacet(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    @admitted("cache-facet", "solr")
+    async def post(self, request):
+        """Post api to aggregate SOLR documents with the JSON Facet API, i.e. {"q": ..., "fq": [...], "facet": {...}}."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        solr_params = get_facet_params(request.data, int(self.domain.setting("SOLR_MAX_FACET_BUCKETS", 1000)))
+        add_facility_filter(solr_params, facilities)
+
+        logger.debug(f"user_id:{user_id}, Aggregating SOLR with payload: {solr_params}")
+
+        return Response(get_facet_results(await asearch(self.domain, solr_params)), status=status.HTTP_200_OK)
+
+class DomainBatch(DomainMixin, APIView):
+    # Require authentication.  Facility authorization applies to every sub-request.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    batch_views = {"db": DomainDb, "db-changes": DomainDbChanges, "cache": DomainCache, "cache-query": DomainCacheQuery,
+                   "cache-facet": DomainCacheFacet}
+
+    def get_view(self, endpoint):
+        return self.batch_views[endpoint].as_view(domain_name=self.domain_name)
+
+    async def post(self, request):
+        """Run a list of read sub-requests concurrently and return their results in order, see batch.py."""
+        sub_requests = parse_batch(request.data, int(self.domain.setting("API_BATCH_MAX_REQUESTS", 20)))
+        return batch_response(await arun_batch(request, self.domain, sub_requests, self.get_view))
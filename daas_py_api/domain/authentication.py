@@ -1,6 +1,11 @@
+import hashlib
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
 from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from .conf import domain_setting
+from .lru import LruCache
+from . import metrics
 
 class CustomBackend(BaseBackend):
     """Custom authentication backend to use hardcoded credentials from settings.py"""
@@ -19,3 +24,47 @@ class CustomBackend(BaseBackend):
             return User.objects.get(pk=user_id)
         except User.DoesNotExist:
             return None
+
+
+# Verified tokens keyed by the hash of the raw token, disabled when JWT_CACHE_SIZE is 0.
+_jwt_cache_size = int(domain_setting("JWT_CACHE_SIZE", 0))
+_validated_tokens = LruCache(_jwt_cache_size) if _jwt_cache_size > 0 else None
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that remembers tokens it has already verified until the token's exp, so hot clients skip
+    the signature verification entirely.
+    """
+
+    def authenticate(self, request):
+        with metrics.stage("auth"):
+            return super().authenticate(request)
+
+    def get_validated_token(self, raw_token):
+        if _validated_tokens is None:
+            return super().get_validated_token(raw_token)
+
+        key = hashlib.sha256(raw_token).hexdigest()
+        validated_token = _validated_tokens.get(key)
+        if validated_token is None:
+            validated_token = super().get_validated_token(raw_token)
+            _validated_tokens.set(key, validated_token, expires_at=validated_token.get("exp"))
+        return validated_token
+
+
+class JwtClaims:
+    """The claims of the authenticated JWT that the permissions and views rely on."""
+    __slots__ = ("user_id", "facilities", "facility_set")
+
+    def __init__(self, token):
+        self.user_id = token.get("user_id", [])
+        self.facilities = list(token.get("facility", []))
+        self.facility_set = frozenset(self.facilities)
+
+def get_claims(request):
+    """Return the claims of the token the request was authenticated with, parsed once per request."""
+    claims = getattr(request, "_jwt_claims", None)
+    if claims is None and request.auth is not None:
+        claims = JwtClaims(request.auth)
+        request._jwt_claims = claims
+    return claims
@@ -0,0 +1,154 @@
+"""
+File: batch.py
+Description: Batches of read sub-requests on POST <domain>/batch, i.e.
+            [{"endpoint": "db", "method": "POST", "params": {"facility": "F1"}, "body": [1, 2]},
+             {"endpoint": "cache-query", "params": {"facility": "F1"}, "body": {"q": "status:active"}}]
+            The batch is authenticated once, and every sub-request runs through the regular domain view of its
+            endpoint with the verified token, so facility authorization, projection, caching and admission control
+            apply to it as to a request of its own.  Results come back in the order of the sub-requests, each with
+            its own status.
+
+            API_BATCH_MAX_REQUESTS  sub-requests per batch (default 20)
+            API_BATCH_WORKERS       threads running sub-requests, shared by the batches of the process (default 8).
+                                    The async view runs at most this many sub-requests of a batch at once.
+"""
+import asyncio
+import io
+import json
+from django.http import HttpRequest, QueryDict
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from manage import logger
+from .authentication import get_claims
+from .conf import domain_setting
+from .workers import get_executor, submit, with_db_connections
+
+# Read endpoints that can be batched, with their methods.  The first method is the default.
+BATCH_ENDPOINTS = {
+    "db": ("GET", "POST"),
+    "db-changes": ("GET",),
+    "cache": ("GET",),
+    "cache-query": ("POST",),
+    "cache-facet": ("POST",),
+}
+# Conditional and encoding headers of the batch do not apply to its sub-requests.
+DROPPED_HEADERS = ("HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE", "HTTP_ACCEPT_ENCODING", "CONTENT_TYPE",
+                   "CONTENT_LENGTH", "QUERY_STRING", "wsgi.input")
+
+class SubRequest:
+    __slots__ = ("index", "endpoint", "method", "params", "body")
+
+    def __init__(self, index, endpoint, method, params, body):
+        self.index = index
+        self.endpoint = endpoint
+        self.method = method
+        self.params = params
+        self.body = body
+
+
+def parse_batch(data, max_requests):
+    """Return the SubRequests of a batch body, a list or {"requests": [...]}, raising ParseError when it is invalid."""
+    items = data.get("requests") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise ParseError("Expected a list of sub-requests.")
+    if len(items) > max_requests:
+        raise ParseError(f"At most {max_requests} sub-requests per batch, got {len(items)}.")
+
+    sub_requests = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or item.get("endpoint") not in BATCH_ENDPOINTS:
+            raise ParseError(f"Sub-request {index}: endpoint must be one of {', '.join(BATCH_ENDPOINTS)}.")
+        methods = BATCH_ENDPOINTS[item["endpoint"]]
+        method = str(item.get("method", methods[0])).upper()
+        if method not in methods:
+            raise ParseError(f"Sub-request {index}: {item['endpoint']} accepts {', '.join(methods)}.")
+        params = item.get("params", {})
+        if not isinstance(params, dict):
+            raise ParseError(f"Sub-request {index}: params must be an object.")
+        sub_requests.append(SubRequest(index, item["endpoint"], method, params, item.get("body")))
+    return sub_requests
+
+def build_request(request, domain, sub_request):
+    """A Django request for the sub-request, authenticated with the token the batch was verified with."""
+    http_request = HttpRequest()
+    http_request.method = sub_request.method
+    http_request.path = http_request.path_info = reverse(f"{domain.slug}-{sub_request.endpoint}")
+    http_request.META = {name: value for name, value in request.META.items() if name not in DROPPED_HEADERS}
+    http_request.META["REQUEST_METHOD"] = sub_request.method
+    http_request.META["HTTP_ACCEPT"] = "application/json"
+
+    query = QueryDict(mutable=True)
+    for name, value in sub_request.params.items():
+        query.setlist(name, [str(item) for item in value] if isinstance(value, list) else [str(value)])
+    http_request.GET = query
+    http_request.META["QUERY_STRING"] = query.urlencode()
+
+    if sub_request.method == "POST":
+        body = json.dumps(sub_request.body).encode("utf-8")
+        http_request._body = body
+        http_request._stream = io.BytesIO(body)
+        http_request._read_started = False
+        http_request.META["CONTENT_TYPE"] = "application/json"
+        http_request.META["CONTENT_LENGTH"] = str(len(body))
+
+    # DRF authenticates requests carrying these with the given user and token, without verifying the JWT again.
+    http_request._force_auth_user = request.user
+    http_request._force_auth_token = request.auth
+    http_request._jwt_claims = get_claims(request)
+    return http_request
+
+def sub_result(sub_request, response):
+    return {
+        "index": sub_request.index,
+        "endpoint": sub_request.endpoint,
+        "status": response.status_code,
+        "data": getattr(response, "data", None),
+    }
+
+def error_result(sub_request, e):
+    logger.exception(f"❌Error running batch sub-request {sub_request.index} ({sub_request.endpoint}): {str(e)}")
+    return {"index": sub_request.index, "endpoint": sub_request.endpoint,
+            "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "data": {"error": str(e)}}
+
+def run_batch(request, domain, sub_requests, get_view):
+    """
+    Run the sub-requests on the pool of API_BATCH_WORKERS threads, each with its own DB connection, with the view
+    get_view(endpoint) and collect the results in order.
+    """
+    @with_db_connections
+    def run(sub_request):
+        try:
+            return sub_result(sub_request, get_view(sub_request.endpoint)(build_request(request, domain, sub_request)))
+        except Exception as e:
+            return error_result(sub_request, e)
+
+    executor = get_executor("batch", "API_BATCH_WORKERS", 8)
+    futures = [submit(executor, run, sub_request) for sub_request in sub_requests]
+    return [future.result() for future in futures]
+
+async def arun_batch(request, domain, sub_requests, get_view):
+    """Async counterpart of run_batch, at most API_BATCH_WORKERS sub-requests are in flight at once."""
+    semaphore = asyncio.Semaphore(int(domain_setting("API_BATCH_WORKERS", 8)))
+
+    async def run(sub_request):
+        async with semaphore:
+            try:
+                response = get_view(sub_request.endpoint)(build_request(request, domain, sub_request))
+                if asyncio.iscoroutine(response):
+                    response = await response
+                return sub_result(sub_request, response)
+            except Exception as e:
+                return error_result(sub_request, e)
+
+    return await asyncio.gather(*[run(sub_request) for sub_request in sub_requests])
+
+def batch_response(results):
+    """200 when every sub-request succeeded, 207 otherwise, the status of each is in its result."""
+    failed = sum(1 for result in results if result["status"] >= 400)
+    return Response({
+        "count": len(results),
+        "failed": failed,
+        "results": results,
+    }, status=status.HTTP_200_OK if failed == 0 else status.HTTP_207_MULTI_STATUS)
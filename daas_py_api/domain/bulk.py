@@ -0,0 +1,97 @@
+"""
+File: bulk.py
+Description: Bulk mode for DB upserts.  The payload is split into chunks that are upserted independently on a bounded
+            pool of workers (and so a bounded number of DB connections).  The response reports the outcome of every
+            chunk and, by default, only counts instead of echoing every upserted row.
+"""
+import asyncio
+from rest_framework import status
+from rest_framework.response import Response
+from manage import logger
+from .conf import domain_setting
+from .workers import get_executor, submit, with_db_connections
+
+RETURN_MODES = ("counts", "keys", "rows")
+
+def bulk_requested(request):
+    return str(request.query_params.get("bulk", "false")).lower() in ("1", "true", "yes")
+
+def get_bulk_options(request, domain):
+    """Return (chunk_size, returning) for the request, chunk_size is capped at DB_UPSERT_CHUNK_SIZE."""
+    max_chunk_size = int(domain.setting("DB_UPSERT_CHUNK_SIZE", 1000))
+    try:
+        chunk_size = min(int(request.query_params.get("chunk_size", max_chunk_size)), max_chunk_size)
+    except ValueError:
+        raise ValueError("chunk_size must be an integer")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be greater than 0")
+
+    returning = request.query_params.get("return", "counts").lower()
+    if returning not in RETURN_MODES:
+        raise ValueError(f"Invalid return '{returning}', expected one of {RETURN_MODES}")
+    return chunk_size, returning
+
+def split(documents, chunk_size):
+    documents = documents if isinstance(documents, list) else [documents]
+    return [documents[start:start + chunk_size] for start in range(0, len(documents), chunk_size)]
+
+def chunk_result(index, columns, rows, key, returning):
+    result = {"chunk": index, "status": "ok", "count": len(rows)}
+    if returning == "keys" and key in columns:
+        key_index = columns.index(key)
+        result["keys"] = [row[key_index] for row in rows]
+    elif returning == "rows":
+        result["rows"] = [dict(zip(columns, row)) for row in rows]
+    return result
+
+def error_result(index, e):
+    logger.exception(f"❌Error upserting chunk {index}: {str(e)}")
+    return {"chunk": index, "status": "error", "error": str(e)}
+
+def run_chunks(chunks, run_chunk, key, returning):
+    """
+    Run run_chunk(chunk) -> (columns, rows) for every chunk on the pool of DB_UPSERT_WORKERS threads, each with its own
+    DB connection, and collect the results in order.
+    """
+    @with_db_connections
+    def run(index, chunk):
+        try:
+            columns, rows = run_chunk(chunk)
+            return chunk_result(index, columns, rows, key, returning)
+        except Exception as e:
+            return error_result(index, e)
+
+    executor = get_executor("upsert", "DB_UPSERT_WORKERS", 4)
+    futures = [submit(executor, run, index, chunk) for index, chunk in enumerate(chunks)]
+    return [future.result() for future in futures]
+
+async def arun_chunks(chunks, run_chunk, key, returning):
+    """Async counterpart of run_chunks, at most DB_UPSERT_WORKERS chunks are in flight at once."""
+    semaphore = asyncio.Semaphore(int(domain_setting("DB_UPSERT_WORKERS", 4)))
+
+    async def run(index, chunk):
+        async with semaphore:
+            try:
+                columns, rows = await run_chunk(chunk)
+                return chunk_result(index, columns, rows, key, returning)
+            except Exception as e:
+                return error_result(index, e)
+
+    return await asyncio.gather(*[run(index, chunk) for index, chunk in enumerate(chunks)])
+
+def bulk_response(results):
+    """200 when every chunk succeeded, 207 when some failed and 500 when all of them failed."""
+    failed = sum(1 for result in results if result["status"] != "ok")
+    if failed == 0:
+        response_status = status.HTTP_200_OK
+    elif failed < len(results):
+        response_status = status.HTTP_207_MULTI_STATUS
+    else:
+        response_status = status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    return Response({
+        "chunks": len(results),
+        "failed": failed,
+        "count": sum(result.get("count", 0) for result in results),
+        "results": results,
+    }, status=response_status)
@@ -0,0 +1,181 @@
+"""
+File: compression.py
+Description: Response compression negotiated from Accept-Encoding.  zstd, br and gzip are preferred in that order among
+            the codings the client accepts (q-values honoured) and the optional packages installed (zstandard,
+            brotli), gzip is always available.  Streaming responses, i.e. the export, are compressed and flushed chunk
+            by chunk, so the rows keep going out while the query runs.  Bodies that are already encoded, small or of
+            types that do not compress (parquet) are sent as is, and so are HTML pages: the browsable API embeds the
+            CSRF token next to reflected request data, which compression would expose to BREACH.
+
+            API_COMPRESS_MIN_SIZE    bytes below which a body is sent as is (default 1024)
+            API_COMPRESS_LEVEL_GZIP  default 6
+            API_COMPRESS_LEVEL_BR    default 4
+            API_COMPRESS_LEVEL_ZSTD  default 3
+"""
+import zlib
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.cache import patch_vary_headers
+from .conf import domain_setting
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/vnd.apache.arrow.stream",
+                      "application/javascript", "application/xml")
+
+class GzipCoder:
+    name = "gzip"
+
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCoder:
+    name = "br"
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCoder:
+    name = "zstd"
+
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# In order of preference.
+CODERS = {}
+if zstandard is not None:
+    CODERS["zstd"] = (ZstdCoder, "API_COMPRESS_LEVEL_ZSTD", 3)
+if brotli is not None:
+    CODERS["br"] = (BrotliCoder, "API_COMPRESS_LEVEL_BR", 4)
+CODERS["gzip"] = (GzipCoder, "API_COMPRESS_LEVEL_GZIP", 6)
+
+def accepted_codings(header):
+    """Map of coding to q-value from an Accept-Encoding header."""
+    codings = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            codings[name.strip().lower()] = quality
+    return codings
+
+def choose_coding(header):
+    """The preferred coding the client accepts, or None for identity."""
+    if not header:
+        return None
+    codings = accepted_codings(header)
+    wildcard = codings.get("*", 0.0)
+    candidates = [(codings.get(name, wildcard), -index, name) for index, name in enumerate(CODERS)]
+    quality, _, name = max(candidates)
+    return name if quality > 0 else None
+
+def is_compressible(content_type):
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type == "text/html":
+        return False
+    return media_type.startswith("text/") or media_type.endswith("+json") or media_type in COMPRESSIBLE_TYPES
+
+
+class CompressionMiddleware:
+    """
+    Compresses response bodies with the coding negotiated from Accept-Encoding.  Sync and async, like GZipMiddleware, so
+    the async views are not moved to a thread under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = int(domain_setting("API_COMPRESS_MIN_SIZE", 1024))
+        self.levels = {name: int(domain_setting(setting, default)) for name, (coder, setting, default) in CODERS.items()}
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if response.has_header("Content-Encoding") or not is_compressible(response.get("Content-Type", "")):
+            return response
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+
+        # The body depends on Accept-Encoding from here on, even when it is sent as is.
+        patch_vary_headers(response, ("Accept-Encoding",))
+        name = choose_coding(request.headers.get("Accept-Encoding", ""))
+        if name is None:
+            return response
+        coder = CODERS[name][0](self.levels[name])
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self.compress_async(coder, response.streaming_content)
+            else:
+                response.streaming_content = self.compress_stream(coder, response.streaming_content)
+            del response["Content-Length"]
+        else:
+            response.content = coder.compress(response.content) + coder.finish()
+            response["Content-Length"] = str(len(response.content))
+
+        # A compressed body is a different representation, a strong ETag of the identity body no longer holds.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = f"W/{etag}"
+        response["Content-Encoding"] = name
+        return response
+
+    @staticmethod
+    def compress_stream(coder, chunks):
+        for chunk in chunks:
+            data = coder.compress(chunk)
+            if data:
+                yield data
+        yield coder.finish()
+
+    @staticmethod
+    async def compress_async(coder, chunks):
+        async for chunk in chunks:
+            data = coder.compress(chunk)
+            if data:
+                yield data
+        yield coder.finish()
@@ -0,0 +1,193 @@
+"""
+File: conditional.py
+Description: Conditional GET for the list endpoints.  Responses carry a weak ETag built from a version marker of the
+            data source and the request (query parameters, facility set, negotiated format), so a poll that sends the
+            ETag back in If-None-Match gets a 304 before the DB function or the SOLR search runs.
+
+            db    token of the domain in the Django cache API_ETAG_CACHE_ALIAS (default "default"), replaced by a
+                  new random one on every notification on DB_CHANNEL / DB_CHANNEL_PARENT and every write made
+                  through this api.  With a shared cache (memcached, redis) all workers issue the same ETags, so a
+                  poll gets its 304 from any of them.  ETags are only issued while the listener is LISTENing on the
+                  channels, because notifications sent while it is disconnected are lost.
+            solr  version of the index reader of the SOLR collection (Luke handler), which changes with every
+                  commit that opens a new searcher, joined over the replicas of SOLR_URLS.  It is cached for
+                  API_ETAG_SOLR_TTL seconds (default 1), and each replica has SOLR_VERSION_TIMEOUT to tell it.
+                  Responses served from the DB in SOLR's place carry no ETag.
+
+            API_ETAG  true (default) or false, per domain like every setting.
+"""
+import functools
+import hashlib
+import json
+import threading
+import time
+import uuid
+from asgiref.sync import iscoroutinefunction
+from django.core.cache import caches
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.response import Response
+from manage import logger
+from .authentication import get_claims
+from .routing import after_replay
+from .solr_replicas import FALLBACK_HEADER, index_marker, aindex_marker
+from . import notify
+
+_subscribed = set()
+_solr_versions = {}
+_refreshing = set()
+_lock = threading.Lock()
+
+def _db_version_key(domain):
+    return f"daas:{domain.slug}:db_version"
+
+def _new_token():
+    return uuid.uuid4().hex[:16]
+
+def _bump(domain):
+    # A new random token rather than a counter: a counter evicted from the cache, or kept in a cache local to the
+    # process, would start over and hand out the versions of older data again.
+    try:
+        caches[domain.setting("API_ETAG_CACHE_ALIAS", "default")].set(_db_version_key(domain), _new_token(), timeout=None)
+    except Exception as e:
+        logger.error(f"❌Error changing the DB version of {domain.slug}, its ETags may match changed data: {str(e)}")
+
+def bump_db_version(domain, channel=None, payload=None):
+    """
+    Mark the DB data of the domain as changed, ETags issued before no longer match.  With read replicas it is marked
+    again once they have replayed the change, ETags of reads served before from a replica no longer match either.
+    """
+    _bump(domain)
+    after_replay(("db_version", domain.slug), functools.partial(_bump, domain))
+
+def db_version(domain):
+    """Version marker of the DB data of the domain, or None while notifications could be missed."""
+    if domain.slug not in _subscribed:
+        with _lock:
+            if domain.slug not in _subscribed:
+                callback = functools.partial(bump_db_version, domain)
+                notify.subscribe(domain.db_channel, callback)
+                notify.subscribe(domain.db_channel_parent, callback)
+                _subscribed.add(domain.slug)
+
+    channels = [channel for channel in (domain.db_channel, domain.db_channel_parent) if channel]
+    if not all(notify.is_listening(channel) for channel in channels):
+        return None
+    try:
+        cache = caches[domain.setting("API_ETAG_CACHE_ALIAS", "default")]
+        version = cache.get(_db_version_key(domain))
+        if version is None:
+            cache.add(_db_version_key(domain), _new_token(), timeout=None)
+            version = cache.get(_db_version_key(domain))
+    except Exception as e:
+        logger.warning(f"❌Error reading the DB version of {domain.slug}, responding without ETag: {str(e)}")
+        return None
+    return version
+
+def _current_solr_version(domain):
+    """
+    (version, refresh): the cached version marker, or refresh=True when this request has to read it.  Once it expires,
+    one request per domain reads it again while the others keep the previous one, so a slow replica is not asked by
+    every request in flight.
+    """
+    entry = _solr_versions.get(domain.slug)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1], False
+    with _lock:
+        if entry is not None and domain.slug in _refreshing:
+            return entry[1], False
+        _refreshing.add(domain.slug)
+    return None, True
+
+def _store_solr_version(domain, version):
+    # Unknown versions are kept as well, so SOLR is not asked again by every request while it cannot tell.
+    _solr_versions[domain.slug] = (time.monotonic() + float(domain.setting("API_ETAG_SOLR_TTL", 1)), version)
+    _refreshing.discard(domain.slug)
+    return version
+
+def expire_solr_version(domain):
+    """Read the SOLR version again on the next request, after a write through this api."""
+    _solr_versions.pop(domain.slug, None)
+
+def solr_version(domain):
+    """Version marker of the SOLR collection of the domain, or None when SOLR could not tell."""
+    version, refresh = _current_solr_version(domain)
+    if refresh:
+        try:
+            version = index_marker(domain)
+        except Exception as e:
+            logger.warning(f"❌Error reading the SOLR index version of {domain.slug}, responding without ETag: {str(e)}")
+        finally:
+            _store_solr_version(domain, version)
+    return version
+
+async def asolr_version(domain):
+    """Async counterpart of solr_version."""
+    version, refresh = _current_solr_version(domain)
+    if refresh:
+        try:
+            version = await aindex_marker(domain)
+        except Exception as e:
+            logger.warning(f"❌Error reading the SOLR index version of {domain.slug}, responding without ETag: {str(e)}")
+        finally:
+            _store_solr_version(domain, version)
+    return version
+
+def make_etag(domain, endpoint, request, version):
+    """Weak ETag of a read at the given version.  Users with the same facility set share it, like the response cache."""
+    params = sorted((name, sorted(values)) for name, values in request.query_params.lists())
+    raw = json.dumps([domain.slug, endpoint, str(version), request.get_host(), params,
+                      sorted(get_claims(request).facility_set), request.accepted_media_type])
+    return f'W/"{hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]}"'
+
+def etag_matches(request, etag):
+    """Weak comparison of the ETag with the If-None-Match header of the request."""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def _with_etag(response, etag):
+    if etag is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED) and not response.has_header(FALLBACK_HEADER):
+        response["ETag"] = etag
+        # Revalidate every time, and never share between users through intermediate caches.
+        response["Cache-Control"] = "private, no-cache"
+        patch_vary_headers(response, ("Accept", "Authorization"))
+    return response
+
+def conditional_response(endpoint, source):
+    """
+    Answer If-None-Match with 304 while the version of the source (db or solr) is unchanged, and tag successful
+    responses with their ETag.  Works for sync and async methods, and goes above cached_response.
+    """
+    def decorator(method):
+        def get_etag(view, request, version):
+            if version is None:
+                return None
+            return make_etag(view.domain, endpoint, request, version)
+
+        if iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                if not view.domain.flag("API_ETAG", True):
+                    return await method(view, request, *args, **kwargs)
+                # The version is read before the data, so an ETag can be older than its data but never newer.
+                version = await asolr_version(view.domain) if source == "solr" else db_version(view.domain)
+                etag = get_etag(view, request, version)
+                if etag is not None and etag_matches(request, etag):
+                    return _with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+                return _with_etag(await method(view, request, *args, **kwargs), etag)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            if not view.domain.flag("API_ETAG", True):
+                return method(view, request, *args, **kwargs)
+            version = solr_version(view.domain) if source == "solr" else db_version(view.domain)
+            etag = get_etag(view, request, version)
+            if etag is not None and etag_matches(request, etag):
+                return _with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+            return _with_etag(method(view, request, *args, **kwargs), etag)
+        return wrapper
+    return decorator
@@ -0,0 +1,79 @@
+"""
+File: conf.py
+Description: Registry of the domains served by this process.  DOMAINS (environment or API_DOMAINS configuration) is a
+            comma separated list, i.e. 'asset,facility', and falls back to the single DOMAIN.  Every domain reads its
+            functions, channels and SOLR collection from the DOMAIN suffixed configurations, and any other configuration
+            can be overridden for a single domain the same way, i.e. PAGINATION_MODE_DB_ASSET over PAGINATION_MODE_DB.
+"""
+import os
+from manage import logger, config
+
+configs = config.get_configs()
+
+def _clean(name):
+    return name.strip().replace("'", "")
+
+class DomainConfig:
+    """Configuration of one domain."""
+
+    def __init__(self, name):
+        self.name = _clean(name).upper()
+        self.slug = self.name.lower()
+        self.solr_collection = getattr(configs, f"SOLR_COLLECTION_{self.name}")
+        # SOLR nodes serving the collection (SOLR_URLS, comma separated), searched as replicas, see solr_replicas.py.
+        # Writes and single node clients use the first.
+        self.solr_urls = [f"{_clean(url).rstrip('/')}/{self.solr_collection}" for url in str(self.setting("SOLR_URLS") or configs.SOLR_URL).split(",") if _clean(url)]
+        self.solr_url = self.solr_urls[0]
+        self.db_channel = getattr(configs, f"DB_CHANNEL_{self.name}")
+        self.db_channel_parent = getattr(configs, f"DB_CHANNEL_PARENT_{self.name}", None)
+        self.db_func_get_by_id = getattr(configs, f"DB_FUNC_GET_BY_ID_{self.name}")
+        self.db_func_get = getattr(configs, f"DB_FUNC_GET_{self.name}")
+        self.db_func_upsert = getattr(configs, f"DB_FUNC_UPSERT_{self.name}")
+        self.db_func_get_page = getattr(configs, f"DB_FUNC_GET_PAGE_{self.name}", None)
+        self.db_func_get_changes = getattr(configs, f"DB_FUNC_GET_CHANGES_{self.name}", None)
+        self.db_key = self.setting("DB_KEY", "id")
+        self.db_watermark = self.setting("DB_WATERMARK", "update_ts")
+
+    def setting(self, name, default=None):
+        """Return the domain specific configuration, falling back to the global configuration and then the default."""
+        value = getattr(configs, f"{name}_{self.name}", None)
+        if value is None:
+            value = getattr(configs, name, default)
+        return value
+
+    def flag(self, name, default=False):
+        """Return a boolean configuration, accepting the string forms that come from environment variables."""
+        value = self.setting(name, default)
+        if isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        return bool(value)
+
+    def __repr__(self):
+        return f"DomainConfig({self.slug})"
+
+
+def _domain_names():
+    names = os.getenv("DOMAINS") or getattr(configs, "API_DOMAINS", None) or os.getenv("DOMAIN")
+    if isinstance(names, str):
+        names = names.split(",")
+    return [_clean(name) for name in names if _clean(name)]
+
+DOMAINS = {}
+for _name in _domain_names():
+    _domain = DomainConfig(_name)
+    DOMAINS[_domain.slug] = _domain
+    logger.info(f"Registered domain {_domain.slug}, SOLR_URL: {_domain.solr_url}, DB_CHANNEL_NAME: {_domain.db_channel}")
+
+# Process wide resources (pools, executors) are configured from the first domain, so single domain deployments keep
+# honouring their DOMAIN suffixed overrides.
+DEFAULT_DOMAIN = next(iter(DOMAINS.values()))
+
+def get_domain(slug):
+    return DOMAINS[slug.lower()]
+
+def domain_setting(name, default=None):
+    """Configuration of process wide resources, see DEFAULT_DOMAIN."""
+    return DEFAULT_DOMAIN.setting(name, default)
+
+def domain_flag(name, default=False):
+    return DEFAULT_DOMAIN.flag(name, default)
@@ -0,0 +1,78 @@
+"""
+File: db.py
+Description: Helpers for calling the domain functions in the DBMS.
+"""
+import uuid
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.backends.postgresql.psycopg_any import is_psycopg3
+from . import metrics
+
+# Prepared statements need psycopg 3 with server side binding, which settings enables with DATABASE_PREPARED_STATEMENTS.
+PREPARE = is_psycopg3 and getattr(settings, "DATABASE_PREPARED_STATEMENTS", False)
+
+def db_connection_kwargs(alias="default"):
+    """Connection arguments for psycopg connections opened outside of Django, built from a Django database."""
+    database = settings.DATABASES[alias]
+    return {
+        "dbname": database["NAME"],
+        "user": database["USER"],
+        "password": database["PASSWORD"],
+        "host": database["HOST"],
+        "port": database["PORT"],
+        "options": database.get("OPTIONS", {}).get("options"),
+    }
+
+def execute(cursor, sql, params):
+    """
+    Execute one of the domain function calls.  With PREPARE the statement is prepared on the server the first time a
+    connection runs it and reused afterwards, so it is not planned again on every call.
+    """
+    with metrics.stage("db_execute"):
+        if not PREPARE:
+            return cursor.execute(sql, params)
+        with cursor.db.wrap_database_errors:
+            return cursor.cursor.execute(sql, params, prepare=True)
+
+def fetch(sql, params, alias="default"):
+    """Execute one of the domain function calls on the database alias and return (columns, rows)."""
+    with connections[alias].cursor() as cursor:
+        execute(cursor, sql, params)
+        columns = [col[0] for col in cursor.description] if cursor.description else []
+        with metrics.stage("db_fetch"):
+            rows = cursor.fetchall() if cursor.description else []
+    return columns, rows
+
+def start_stream(batches):
+    """
+    Run the query of a stream_query now and return the stream, so connection errors are raised to the view and not
+    once the response is streaming.
+    """
+    columns = next(batches)
+    return _resume(columns, batches)
+
+def _resume(columns, batches):
+    try:
+        yield columns
+        yield from batches
+    finally:
+        batches.close()
+
+def stream_query(sql, params, itersize, alias="default"):
+    """
+    Run a query on a named (server-side) cursor.  Yields the column names first, then batches of at most itersize
+    rows, so memory stays flat no matter how many rows the query returns.
+    """
+    # Named cursors only live inside a transaction, and the transaction has to be opened by the generator itself
+    # because the rows are consumed after the view has returned.
+    connection = connections[alias]
+    with transaction.atomic(using=alias):
+        connection.ensure_connection()
+        with connection.connection.cursor(name=f"daas_stream_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(itersize)
+            yield [col[0] for col in cursor.description]
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(itersize)
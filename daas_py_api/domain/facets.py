@@ -0,0 +1,62 @@
+"""
+File: facets.py
+Description: Aggregations over the SOLR collection with the JSON Facet API.  The request body carries the facets
+            (terms, range, query and stat functions) with an optional q and fq, and the search runs with rows=0, so
+            only the aggregates leave SOLR.  The facility filter is added like for the searches, and facets may not
+            change their domain in ways that would escape it (query, excludeTags, join, graph, block joins); a
+            domain filter only narrows it and is allowed.  Terms facets are capped at SOLR_MAX_FACET_BUCKETS
+            (default 1000) buckets, a limit of -1 included.
+"""
+import json
+from rest_framework.exceptions import ParseError
+
+FACET_REQUEST_KEYS = {"q", "fq", "facet"}
+ALLOWED_DOMAIN_KEYS = {"filter"}
+
+def _check_facet(facet, facet_type, max_buckets, path):
+    domain = facet.get("domain")
+    if domain is not None and (not isinstance(domain, dict) or not set(domain) <= ALLOWED_DOMAIN_KEYS):
+        raise ParseError(f"{path}.domain may only narrow the results with filter")
+    if facet_type == "terms":
+        limit = facet.get("limit", 10)
+        if not isinstance(limit, int) or limit < 0 or limit > max_buckets:
+            facet["limit"] = max_buckets
+    if isinstance(facet.get("facet"), dict):
+        _check_facets(facet["facet"], max_buckets, f"{path}.facet")
+
+def _check_facets(facets, max_buckets, path="facet"):
+    """Validate the facet tree in place and cap the buckets of terms facets."""
+    for name, facet in facets.items():
+        # Stat functions, i.e. "avg(price)", and query facet shorthands are strings.
+        if not isinstance(facet, dict):
+            continue
+        _check_facet(facet, facet.get("type"), max_buckets, f"{path}.{name}")
+        if "type" not in facet:
+            # Long forms, i.e. {"terms": {"field": "status", "facet": {...}}}.
+            for facet_type, definition in facet.items():
+                if facet_type not in ("domain", "facet") and isinstance(definition, dict):
+                    _check_facet(definition, facet_type, max_buckets, f"{path}.{name}.{facet_type}")
+    return facets
+
+def get_facet_params(data, max_buckets):
+    """Build the SOLR parameters of an aggregation from the request body, raising ParseError when it is invalid."""
+    if not isinstance(data, dict):
+        raise ParseError("Invalid input format. Expected a dictionary with facet.")
+    unknown = set(data) - FACET_REQUEST_KEYS
+    if unknown:
+        raise ParseError(f"Unsupported keys: {', '.join(sorted(unknown))}, expected some of {', '.join(sorted(FACET_REQUEST_KEYS))}")
+    facets = data.get("facet")
+    if not isinstance(facets, dict) or not facets:
+        raise ParseError("facet must be a JSON Facet API object.")
+
+    solr_params = {
+        "q": data.get("q", "*:*"),
+        "fq": data.get("fq", []),
+        "rows": 0,
+        "json.facet": json.dumps(_check_facets(facets, max_buckets)),
+    }
+    return solr_params
+
+def get_facet_results(raw_response):
+    """Only the aggregates of a SOLR response; count is the number of matching documents."""
+    return raw_response.get("facets") or {"count": raw_response.get("response", {}).get("numFound", 0)}
@@ -0,0 +1,201 @@
+"""
+File: metrics.py
+Description: Stage level request timings exported in the Prometheus text format on /metrics.  MetricsMiddleware
+            samples METRICS_SAMPLE_RATE (0 to 1, default 0) of the requests; for a sampled request the hooks in the
+            views, renderers, authentication and backend calls add their time to a per request record kept in a
+            context variable.  Unsampled requests only pay for one context variable lookup per hook.
+
+            Stages: auth, permission, admission (wait for a slot), db_execute, db_fetch, rows (row/document build),
+            paginate, solr, render.
+
+            Metrics are kept per process, scrape every worker (or run one worker per container).
+"""
+import contextvars
+import random
+import threading
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpResponse
+from .conf import domain_setting
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+
+_current = contextvars.ContextVar("daas_request_timings", default=None)
+
+class Histogram:
+    """Thread safe Prometheus histogram with a fixed set of label names."""
+
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            prefix = f"{label_text}," if label_text else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+            lines.append(f"{self.name}_count{{{label_text}}} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+REQUEST_DURATION = Histogram("daas_request_duration_seconds", "Duration of sampled requests.",
+                             ("domain", "endpoint", "method", "status"), DURATION_BUCKETS)
+STAGE_DURATION = Histogram("daas_stage_duration_seconds", "Time spent per stage of sampled requests.",
+                           ("domain", "endpoint", "stage"), DURATION_BUCKETS)
+RESPONSE_ROWS = Histogram("daas_response_rows", "Rows or documents returned by sampled requests.",
+                          ("domain", "endpoint"), COUNT_BUCKETS)
+RESPONSE_BYTES = Histogram("daas_response_bytes", "Payload size of sampled requests as sent, after compression.",
+                           ("domain", "endpoint"), SIZE_BUCKETS)
+HISTOGRAMS = [REQUEST_DURATION, STAGE_DURATION, RESPONSE_ROWS, RESPONSE_BYTES]
+
+
+class RequestTimings:
+    """Stage timings of one sampled request."""
+    __slots__ = ("stages", "rows")
+
+    def __init__(self):
+        self.stages = {}
+        self.rows = None
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+class _Stage:
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.started)
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+_NO_STAGE = _NoStage()
+
+def stage(name):
+    """Context manager timing a stage of the current request, a shared no-op when the request is not sampled."""
+    timings = _current.get()
+    if timings is None:
+        return _NO_STAGE
+    return _Stage(timings, name)
+
+def record_rows(count):
+    """Record the number of rows or documents the current request returns."""
+    timings = _current.get()
+    if timings is not None:
+        timings.rows = (timings.rows or 0) + count
+
+
+class MetricsMiddleware:
+    """
+    Samples requests and records their timings once the response is rendered.  Sync and async, like the Django
+    middleware, so the async views are not moved to a thread under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = float(domain_setting("METRICS_SAMPLE_RATE", 0))
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, timings, time.perf_counter() - started)
+        return response
+
+    def observe(self, request, response, timings, seconds):
+        # The view is read from the resolver match rather than in process_view, which Django would run in a thread for
+        # the async views.
+        match = getattr(request, "resolver_match", None)
+        view_class = getattr(match.func, "cls", None) or getattr(match.func, "view_class", None) if match else None
+        if view_class is None:
+            # Not one of the API views, i.e. /metrics itself or the admin.
+            return
+        initkwargs = getattr(match.func, "view_initkwargs", None) or {}
+        labels = (initkwargs.get("domain_name", ""), view_class.__name__)
+        REQUEST_DURATION.observe((*labels, request.method, str(response.status_code)), seconds)
+        for name, stage_seconds in timings.stages.items():
+            STAGE_DURATION.observe((*labels, name), stage_seconds)
+        if timings.rows is not None:
+            RESPONSE_ROWS.observe(labels, timings.rows)
+        if not response.streaming:
+            RESPONSE_BYTES.observe(labels, len(response.content))
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.expose())
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
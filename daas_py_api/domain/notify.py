@@ -0,0 +1,58 @@
+"""
+File: notify.py
+Description: Background LISTEN on the DB channels the upsert functions publish to.  Subscribers are called with
+            (channel, payload) for every notification, and with a payload of None after (re)connecting, because
+            notifications sent while the listener was disconnected are lost.
+"""
+import threading
+import time
+import psycopg
+from psycopg import sql
+from manage import logger
+from .db import db_connection_kwargs
+
+_subscribers = {}
+_listening = set()
+_lock = threading.Lock()
+_thread = None
+
+def subscribe(channel, callback):
+    """Call callback(channel, payload) for notifications on channel, starting the listener if needed."""
+    global _thread
+    if not channel:
+        return
+    with _lock:
+        _subscribers.setdefault(channel, []).append(callback)
+        if _thread is None:
+            _thread = threading.Thread(target=_listen, name="daas-db-listener", daemon=True)
+            _thread.start()
+
+def is_listening(channel):
+    """True while the listener is connected and LISTENing on channel, so no notification on it can be missed."""
+    return channel in _listening
+
+def _publish(channel, payload):
+    for callback in list(_subscribers.get(channel, [])):
+        try:
+            callback(channel, payload)
+        except Exception as e:
+            logger.exception(f"❌Error handling notification on {channel}: {str(e)}")
+
+def _listen():
+    while True:
+        try:
+            with psycopg.connect(**db_connection_kwargs(), autocommit=True) as conn:
+                while True:
+                    # Pick up channels subscribed after the listener started.
+                    for channel in set(_subscribers) - _listening:
+                        conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                        _listening.add(channel)
+                        logger.info(f"Listening for notifications on {channel}")
+                        _publish(channel, None)
+
+                    for notify in conn.notifies(timeout=1.0):
+                        _publish(notify.channel, notify.payload)
+        except Exception as e:
+            _listening.clear()
+            logger.exception(f"❌DB listener disconnected, retrying: {str(e)}")
+            time.sleep(5)
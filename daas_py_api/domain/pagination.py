@@ -0,0 +1,218 @@
+"""
+File: pagination.py
+Description: Pagination that is pushed down into the backend instead of slicing a fully materialized result in python.
+"""
+import base64
+import json
+from collections import OrderedDict
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from .projection import select_list
+
+CURSOR_QUERY_PARAM = "cursor"
+PAGING_QUERY_PARAM = "paging"
+SINCE_QUERY_PARAM = "since"
+
+def cursor_pagination_requested(request, default_mode):
+    """True when the request asks for cursor paging, either explicitly or by carrying a cursor."""
+    if CURSOR_QUERY_PARAM in request.query_params:
+        return True
+    return str(request.query_params.get(PAGING_QUERY_PARAM, default_mode)).lower() == "cursor"
+
+
+class KeysetPagination:
+    """
+    Keyset (seek) pagination over the result of a DB function.  The last seen key and the page size are passed down
+    to the query, so the cost of a page depends on the page size and not on the size of the domain.  Cursors are
+    opaque to the client and carry the boundary key and the direction of travel.
+    """
+
+    def __init__(self, key, page_size):
+        self.key = key
+        self.page_size = page_size
+        self.base_url = None
+        self.next_position = None
+        self.previous_position = None
+
+    def decode_cursor(self, request):
+        """Return (position, reverse) from the cursor in the request, (None, False) for the first page."""
+        encoded = request.query_params.get(CURSOR_QUERY_PARAM)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")).decode("utf-8"))
+            return cursor["p"], bool(cursor.get("r", False))
+        except (ValueError, KeyError, TypeError):
+            raise NotFound("Invalid cursor")
+
+    def encode_cursor(self, position, reverse):
+        cursor = {"p": position, "r": 1} if reverse else {"p": position}
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor, default=str).encode("utf-8")).decode("ascii")
+        return replace_query_param(self.base_url, CURSOR_QUERY_PARAM, encoded)
+
+    def paginate_rows(self, request, columns, rows, position, reverse):
+        """
+        Trim the page_size + 1 rows returned by the query down to one page, in ascending key order, and work out
+        the cursors for the neighbouring pages.
+        """
+        self.base_url = remove_query_param(request.build_absolute_uri(), "page")
+        key_index = columns.index(self.key)
+
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows = rows[::-1]
+            has_next, has_previous = position is not None, has_more
+        else:
+            has_next, has_previous = has_more, position is not None
+
+        self.next_position = rows[-1][key_index] if rows and has_next else None
+        self.previous_position = rows[0][key_index] if rows and has_previous else None
+        return rows
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, reverse=False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+
+def keyset_query(func_get, func_page, user_id, key, position, reverse, limit, fields=None):
+    """
+    Build the SQL for one page of a DB function.  When the domain has a dedicated paging function it receives the
+    boundary key and the limit itself; otherwise the predicate and LIMIT wrap the generic function so at most one
+    page of rows crosses the wire.  fields (see projection) limits the columns selected.
+    """
+    if func_page:
+        return f"SELECT {select_list(fields)} FROM {func_page}(%s, %s, %s, %s) AS t;", [user_id, position, limit, reverse]
+
+    direction = "DESC" if reverse else "ASC"
+    sql = f"SELECT {select_list(fields)} FROM {func_get}(%s) AS t"
+    params = [user_id]
+    if position is not None:
+        sql += f" WHERE t.{key} {'<' if reverse else '>'} %s"
+        params.append(position)
+    sql += f" ORDER BY t.{key} {direction} LIMIT %s;"
+    params.append(limit)
+    return sql, params
+
+
+class WatermarkPagination:
+    """
+    Pages of the rows changed after a watermark, for incremental sync.  Rows are ordered by (watermark, key), the key
+    breaks ties between rows changed at the same time.  ?since= takes the watermark token of an earlier response or a
+    raw watermark (timestamp or sequence) to start from; without it the sync starts from the beginning.
+    """
+
+    def __init__(self, watermark, key, page_size):
+        self.watermark = watermark
+        self.key = key
+        self.page_size = page_size
+        self.base_url = None
+        self.position = (None, None)
+        self.has_more = False
+
+    def decode_since(self, request):
+        """Return (watermark, key) to resume after."""
+        since = request.query_params.get(SINCE_QUERY_PARAM)
+        if not since:
+            return None, None
+        try:
+            token = json.loads(base64.urlsafe_b64decode(since.encode("ascii")).decode("utf-8"))
+            if isinstance(token, dict) and "w" in token:
+                return token["w"], token.get("k")
+        except (ValueError, TypeError):
+            pass
+        return since, None
+
+    def encode_token(self, position):
+        watermark, key = position
+        if watermark is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps({"w": watermark, "k": key}, default=str).encode("utf-8")).decode("ascii")
+
+    def paginate_rows(self, request, columns, rows, since):
+        """Trim the page_size + 1 rows returned by the query to one page and remember the new watermark."""
+        self.base_url = remove_query_param(request.build_absolute_uri(), "page")
+        self.has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if rows:
+            self.position = (rows[-1][columns.index(self.watermark)], rows[-1][columns.index(self.key)])
+        else:
+            self.position = since
+        return rows
+
+    def get_next_link(self):
+        if not self.has_more:
+            return None
+        return replace_query_param(self.base_url, SINCE_QUERY_PARAM, self.encode_token(self.position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("watermark", self.encode_token(self.position)),
+            ("results", data),
+        ]))
+
+
+def changes_query(func_changes, user_id, watermark, key, limit, fields=None):
+    """SQL for the rows changed after (watermark, key), the function applies the order and the limit."""
+    return f"SELECT {select_list(fields)} FROM {func_changes}(%s, %s, %s, %s) AS t;", [user_id, watermark, key, limit]
+
+
+class SolrCursorPagination:
+    """
+    Deep paging through SOLR with cursorMark.  Only rows=page_size documents are requested per page and SOLR resumes
+    from the cursor, so a deep page costs the same as the first page.  The sort always ends on the unique key, which
+    SOLR requires for cursors.
+    """
+
+    def __init__(self, unique_key, page_size):
+        self.unique_key = unique_key
+        self.page_size = page_size
+        self.base_url = None
+        self.next_cursor_mark = None
+
+    def apply(self, request, solr_params):
+        """Add rows, sort and cursorMark for the requested page to the SOLR parameters."""
+        sort = solr_params.get("sort") or ""
+        if not any(clause.split()[0] == self.unique_key for clause in sort.split(",") if clause.strip()):
+            sort = f"{sort}, {self.unique_key} asc" if sort else f"{self.unique_key} asc"
+
+        solr_params["sort"] = sort
+        solr_params["rows"] = self.page_size
+        solr_params["cursorMark"] = request.query_params.get(CURSOR_QUERY_PARAM) or "*"
+        return solr_params
+
+    def paginate_results(self, request, solr_params, results):
+        """Return the documents of the page and remember the cursor of the next page, if there is one."""
+        self.base_url = remove_query_param(request.build_absolute_uri(), "page")
+        # Read docs directly, iterating pysolr results with a cursorMark would fetch every remaining page.
+        documents = list(results.docs)
+        if results.nextCursorMark and results.nextCursorMark != solr_params["cursorMark"] and len(documents) == self.page_size:
+            self.next_cursor_mark = results.nextCursorMark
+        return documents
+
+    def get_next_link(self):
+        if self.next_cursor_mark is None:
+            return None
+        return replace_query_param(self.base_url, CURSOR_QUERY_PARAM, self.next_cursor_mark)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("cursor", self.next_cursor_mark),
+            ("results", data),
+        ]))
@@ -1,28 +1,26 @@
-from rest_framework.permissions import BasePermission
-from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.exceptions import PermissionDenied
-from manage import logger, config
 from rest_framework.permissions import BasePermission, SAFE_METHODS
+from .authentication import get_claims
+from . import metrics
 
 class FacilityPermission(BasePermission):
     """
     Grants access only if the user has permission for the requested facility.
+    Relies on the token already verified by the view's authentication classes.
     """
 
     def has_permission(self, request, view):
-        auth = JWTAuthentication()
-        user, token = auth.authenticate(request) or (None, None)
-
-        if not user or not token:
+        if not request.user or request.auth is None:
             return False
 
-        # Extract facilities from JWT
-        user_facilities = token.get("facility", [])
-        # Get requested facility (from query params, headers, or body)
-        requested_facility = request.query_params.get("facility")
+        with metrics.stage("permission"):
+            # Extract facilities from JWT
+            user_facilities = get_claims(request).facility_set
+            # Get requested facility (from query params, headers, or body)
+            requested_facility = request.query_params.get("facility")
 
-        if requested_facility not in user_facilities:
-            raise PermissionDenied("You do not have access to this facility.")
+            if requested_facility not in user_facilities:
+                raise PermissionDenied("You do not have access to this facility.")
 
         return True
 
@@ -35,4 +33,4 @@ class ReadOnlyOrAuthenticatedPermission(BasePermission):
     def has_permission(self, request, view):
         if request.method in SAFE_METHODS:  # Allow GET, HEAD, OPTIONS without authentication
             return True
-        return request.user and request.user.is_authenticated
\ No newline at end of file
+        return request.user and request.user.is_authenticated
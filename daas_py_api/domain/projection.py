@@ -0,0 +1,44 @@
+"""
+File: projection.py
+Description: Field projection with ?fields=a,b,c.  DB reads select only those columns from the domain function, so
+            the other columns never leave the DBMS, and SOLR reads pass them on as fl.  The key is always returned,
+            the cursors and the SOLR sort depend on it.
+"""
+import contextlib
+import re
+from rest_framework.exceptions import ParseError
+
+FIELDS_QUERY_PARAM = "fields"
+FIELD_PATTERN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+UNDEFINED_COLUMN = "42703"
+
+def requested_fields(request, key):
+    """Return the fields asked for with the key first, or None for all fields."""
+    values = request.query_params.getlist(FIELDS_QUERY_PARAM)
+    fields = [field.strip() for value in values for field in value.split(",") if field.strip()]
+    if not fields:
+        return None
+    invalid = [field for field in fields if not FIELD_PATTERN.match(field)]
+    if invalid:
+        raise ParseError(f"Invalid field names: {', '.join(invalid)}")
+    return list(dict.fromkeys([key] + fields))
+
+def select_list(fields):
+    """SQL select list for the fields, the function result is aliased as t.  Names are validated and quoted."""
+    if not fields:
+        return "*"
+    return ", ".join(f't."{field}"' for field in fields)
+
+def solr_field_list(fields):
+    return ",".join(fields)
+
+@contextlib.contextmanager
+def field_errors():
+    """Report a field the domain function does not return as a bad request instead of a server error."""
+    try:
+        yield
+    except Exception as e:
+        cause = e.__cause__ or e
+        if UNDEFINED_COLUMN in (getattr(cause, "sqlstate", None), getattr(cause, "pgcode", None)):
+            raise ParseError(f"Unknown field: {str(cause).splitlines()[0]}")
+        raise
@@ -0,0 +1,376 @@
+"""
+File: renderers.py
+Description: Renderers for formats other than the DRF defaults.  The streaming renderers expose render_stream, which
+            takes the output of db.stream_query and produces chunks for a StreamingHttpResponse, and
+            render_stream_async, its counterpart for aio.stream_query.
+
+            DB reads return a RowSet (column names once, rows as tuples) instead of a dict per row.  FastJSONRenderer
+            turns it into the usual list of objects, with orjson when it is installed, and CompactJSONRenderer
+            (?format=compact or Accept: application/vnd.daas.compact+json) returns {"columns": [...], "rows": [[...]]}.
+
+            ArrowStreamRenderer (Accept: application/vnd.apache.arrow.stream) and ParquetRenderer return DB rows or
+            SOLR documents as columnar data.  They need the optional pyarrow package, COLUMNAR_RENDERERS is empty
+            without it, so those media types are answered with 406.
+"""
+import csv
+import io
+import json
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from . import metrics
+
+try:
+    import orjson
+except ImportError:  # Optional, the DRF encoder is used without it.
+    orjson = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Optional, only needed for the columnar renderers.
+    pa = None
+
+class RowSet:
+    """Rows of a DB result with their column names.  Per row dicts are only built by renderers that need them."""
+    __slots__ = ("columns", "rows")
+
+    def __init__(self, columns, rows):
+        self.columns = list(columns)
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        columns = self.columns
+        return (dict(zip(columns, row)) for row in self.rows)
+
+    def as_objects(self):
+        return list(self)
+
+    def as_compact(self):
+        return {"columns": self.columns, "rows": self.rows}
+
+    def __getstate__(self):
+        return self.columns, self.rows
+
+    def __setstate__(self, state):
+        self.columns, self.rows = state
+
+
+class RowSetEncoder(JSONEncoder):
+    """DRF encoder that also knows RowSet, used when orjson is not installed or for indented output."""
+    compact = False
+
+    def default(self, obj):
+        if isinstance(obj, RowSet):
+            return obj.as_compact() if self.compact else obj.as_objects()
+        return super().default(obj)
+
+
+class CompactRowSetEncoder(RowSetEncoder):
+    compact = True
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer backed by orjson.  datetime, date, UUID and tuples are encoded natively, UTC datetimes with the "Z"
+    suffix of JSONRenderer; Decimal and the remaining types go through the DRF encoder.  Unlike JSONRenderer, times keep
+    their microseconds and NaN or infinite floats are written as null instead of failing the response.
+    """
+    encoder_class = RowSetEncoder
+    _fallback = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        with metrics.stage("render"):
+            if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}):
+                return super().render(data, accepted_media_type, renderer_context)
+            return orjson.dumps(data, default=self._default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z)
+
+    def _default(self, obj):
+        if isinstance(obj, RowSet):
+            return self.encode_rowset(obj)
+        return self._fallback.default(obj)
+
+    def encode_rowset(self, rowset):
+        return rowset.as_objects()
+
+
+class CompactJSONRenderer(FastJSONRenderer):
+    """Result rows as {"columns": [...], "rows": [[...], ...]}, without repeating the column names in every row."""
+    media_type = "application/vnd.daas.compact+json"
+    format = "compact"
+    encoder_class = CompactRowSetEncoder
+
+    def encode_rowset(self, rowset):
+        return rowset.as_compact()
+
+
+class StreamRenderer(BaseRenderer):
+    """
+    Base of the renderers that stream a query: the column names first, then batches of rows.  Subclasses return an
+    encoder from stream_encoder(columns), whose start(), encode(rows) and end() give the chunks, so the sync and the
+    async stream share it.
+    """
+
+    def render_stream(self, batches):
+        encoder = self.stream_encoder(next(batches))
+        chunk = encoder.start()
+        if chunk:
+            yield chunk
+        for rows in batches:
+            chunk = encoder.encode(rows)
+            if chunk:
+                yield chunk
+        chunk = encoder.end()
+        if chunk:
+            yield chunk
+
+    async def render_stream_async(self, batches):
+        encoder = self.stream_encoder(await anext(batches))
+        chunk = encoder.start()
+        if chunk:
+            yield chunk
+        async for rows in batches:
+            chunk = encoder.encode(rows)
+            if chunk:
+                yield chunk
+        chunk = encoder.end()
+        if chunk:
+            yield chunk
+
+    def stream_encoder(self, columns):
+        raise NotImplementedError
+
+
+class _NDJSONEncoder:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def start(self):
+        return ""
+
+    def encode(self, rows):
+        return "".join(json.dumps(dict(zip(self.columns, row)), cls=JSONEncoder) + "\n" for row in rows)
+
+    def end(self):
+        return ""
+
+
+class NDJSONRenderer(StreamRenderer):
+    """Newline delimited JSON, one object per line."""
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        items = data if isinstance(data, list) else [data]
+        with metrics.stage("render"):
+            return "".join(json.dumps(item, cls=JSONEncoder) + "\n" for item in items).encode(self.charset)
+
+    def stream_encoder(self, columns):
+        return _NDJSONEncoder(columns)
+
+
+def _csv_value(value):
+    # jsonb objects and arrays are written as JSON, not as their Python repr.
+    return json.dumps(value, cls=JSONEncoder) if isinstance(value, (dict, list)) else value
+
+def _write_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_csv_value(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+class _CSVEncoder:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def start(self):
+        return _write_csv([self.columns])
+
+    def encode(self, rows):
+        return _write_csv(rows)
+
+    def end(self):
+        return ""
+
+
+class CSVRenderer(StreamRenderer):
+    """Comma separated values with a header row."""
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        items = data if isinstance(data, list) else [data]
+        if not items:
+            return b""
+        columns = list(items[0].keys())
+        with metrics.stage("render"):
+            return _write_csv([columns] + [[item.get(col) for col in columns] for item in items]).encode(self.charset)
+
+    def stream_encoder(self, columns):
+        return _CSVEncoder(columns)
+
+
+class _DrainingSink(io.RawIOBase):
+    """
+    Write-only file for pyarrow writers that hands the written bytes to the caller as they come.  The position keeps
+    counting after a drain, because the Parquet writer records file offsets in the footer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _as_strings(values):
+    return pa.array([None if value is None else value if isinstance(value, str) else
+                     json.dumps(value, cls=JSONEncoder) if isinstance(value, (dict, list)) else str(value)
+                     for value in values], type=pa.string())
+
+
+def _to_array(values, type=None):
+    """Arrow array of a column, values that arrow cannot infer (UUID, json, mixed types) are sent as strings."""
+    try:
+        return pa.array(values, type=type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if type is None or pa.types.is_string(type):
+            return _as_strings(values)
+        raise
+
+
+def _rows_to_batch(columns, rows, schema=None):
+    arrays = [_to_array(list(values), schema.field(index).type if schema is not None else None)
+              for index, values in enumerate(zip(*rows))] if rows else [pa.array([], type=pa.null()) for _ in columns]
+    return pa.RecordBatch.from_arrays(arrays, names=columns)
+
+
+def _columns_and_rows(data):
+    """
+    Return (columns, rows, metadata) for the response data of the domain views: a RowSet, a list of DB rows or SOLR
+    documents, a paginated response (the other keys go to the schema metadata) or a SOLR response.
+    """
+    metadata = {}
+    if isinstance(data, dict) and isinstance(data.get("results"), (RowSet, list)):
+        metadata = {key: value for key, value in data.items() if key != "results"}
+        data = data["results"]
+    elif isinstance(data, dict) and isinstance(data.get("response"), dict):
+        metadata = {key: value for key, value in data["response"].items() if key != "docs"}
+        metadata.update({key: value for key, value in data.items() if key not in ("response", "responseHeader")})
+        data = data["response"].get("docs", [])
+    elif isinstance(data, dict):
+        data = [data]
+
+    if isinstance(data, RowSet):
+        return data.columns, data.rows, metadata
+
+    columns = list(dict.fromkeys(key for item in data for key in item))
+    return columns, [tuple(item.get(column) for column in columns) for item in data], metadata
+
+
+class _ColumnarEncoder:
+    """Writes a record batch per batch of rows, typed from the first batch, so an export never holds more than itersize rows."""
+
+    def __init__(self, renderer, columns):
+        self.renderer = renderer
+        self.columns = columns
+        self.sink = _DrainingSink()
+        self.writer = None
+        self.schema = None
+
+    def start(self):
+        return b""
+
+    def encode(self, rows):
+        batch = _rows_to_batch(self.columns, rows, self.schema)
+        if self.writer is None:
+            # Columns that are all null in the first batch are typed as strings, the schema of a stream is fixed.
+            self.schema = pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                                     for field in batch.schema])
+            batch = _rows_to_batch(self.columns, rows, self.schema)
+            self.writer = self.renderer.open_writer(self.sink, self.schema)
+        self.writer.write_batch(batch)
+        return self.sink.drain()
+
+    def end(self):
+        if self.writer is None:
+            self.writer = self.renderer.open_writer(self.sink, _rows_to_batch(self.columns, []).schema)
+        self.writer.close()
+        return self.sink.drain()
+
+
+class ColumnarRenderer(StreamRenderer):
+    """
+    Base of the pyarrow renderers.  render builds one table from the response data, render_stream writes a record
+    batch per batch of db.stream_query.
+    """
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        with metrics.stage("render"):
+            columns, rows, metadata = _columns_and_rows(data)
+            batch = _rows_to_batch(columns, rows)
+            if metadata:
+                batch = batch.replace_schema_metadata({key: json.dumps(value, cls=JSONEncoder) for key, value in metadata.items()})
+            sink = _DrainingSink()
+            writer = self.open_writer(sink, batch.schema)
+            writer.write_batch(batch)
+            writer.close()
+            return sink.drain()
+
+    def stream_encoder(self, columns):
+        return _ColumnarEncoder(self, columns)
+
+    def open_writer(self, sink, schema):
+        raise NotImplementedError
+
+
+class ArrowStreamRenderer(ColumnarRenderer):
+    """Arrow IPC stream, read with pyarrow.ipc.open_stream."""
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+
+    def open_writer(self, sink, schema):
+        return pa.ipc.new_stream(sink, schema)
+
+
+class ParquetRenderer(ColumnarRenderer):
+    """Parquet file, one row group per batch."""
+    media_type = "application/vnd.apache.parquet"
+    format = "parquet"
+
+    def open_writer(self, sink, schema):
+        return pa.parquet.ParquetWriter(sink, schema)
+
+
+COLUMNAR_RENDERERS = [ArrowStreamRenderer, ParquetRenderer] if pa is not None else []
@@ -0,0 +1,250 @@
+"""
+File: response_cache.py
+Description: Read cache for the DB and SOLR list endpoints.  Entries are keyed on the domain, the endpoint, the query
+            parameters and the user's authorized facility set.  DB entries are invalidated when the upsert functions
+            publish on DB_CHANNEL / DB_CHANNEL_PARENT, so staleness stays near zero without short TTLs.  SOLR entries
+            are keyed on the index version of the collection (see conditional.py) instead, since SOLR shows a change
+            only once it is committed, well after the DB notification or the write.  Without a version no SOLR entry
+            is read or stored.  All settings can be overridden per domain.
+
+            API_CACHE_BACKEND  none (default), lru (in-process) or django (the cache named by API_CACHE_ALIAS)
+            API_CACHE_SIZE     maximum entries of the lru backend, the django backend is bounded by its own settings
+            API_CACHE_TTL      seconds before an entry expires regardless of notifications
+
+            Misses are coalesced: identical requests that arrive while the same read is in flight wait for it and
+            share its response instead of repeating the DB function call or SOLR search.
+
+            API_SINGLE_FLIGHT          true (default) or false
+            API_SINGLE_FLIGHT_TIMEOUT  seconds a request waits for the read in flight before running its own
+"""
+import functools
+import hashlib
+import json
+import threading
+from asgiref.sync import iscoroutinefunction
+from django.core.cache import caches
+from rest_framework.response import Response
+from manage import logger
+from .authentication import get_claims
+from .conditional import asolr_version, bump_db_version, expire_solr_version, solr_version
+from .routing import after_replay, primary_requested
+from .lru import LruCache
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .solr_replicas import FALLBACK_HEADER
+from . import notify
+
+def request_key(domain, endpoint, request, facilities, generation=0):
+    """Key of a read.  Facilities are sorted, so users with the same facility set share it."""
+    params = sorted((name, sorted(values)) for name, values in request.query_params.lists())
+    raw = json.dumps([domain.slug, generation, endpoint, request.scheme, request.get_host(), params, sorted(facilities)])
+    return f"daas:{domain.slug}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+class LruBackend:
+    """In-process backend, bounded to maxsize entries."""
+
+    def __init__(self, maxsize, ttl):
+        self.entries = LruCache(maxsize, ttl=ttl)
+        self.generations = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value):
+        self.entries.set(key, value)
+
+    def get_generation(self, slug):
+        return self.generations.get(slug, 0)
+
+    def bump_generation(self, slug):
+        self.generations[slug] = self.generations.get(slug, 0) + 1
+        return self.generations[slug]
+
+
+class DjangoCacheBackend:
+    """Backend on a Django cache, shared between workers when the cache is.  Stale entries age out with the TTL."""
+
+    def __init__(self, alias, ttl):
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+    # The generation lives in the cache itself, so every worker sharing the cache agrees on it.
+    def get_generation(self, slug):
+        return self.cache.get(f"daas:{slug}:generation", 0)
+
+    def bump_generation(self, slug):
+        key = f"daas:{slug}:generation"
+        self.cache.add(key, 0, timeout=None)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, timeout=None)
+            return 1
+
+
+class ResponseCache:
+    """Cache of one domain.  Domains configured alike share the backend, each keeps its own generation."""
+
+    def __init__(self, domain, backend):
+        self.domain = domain
+        self.backend = backend
+
+    def key(self, endpoint, request, facilities, version=None):
+        """Cache key for the request, carrying the SOLR index version or else the current generation of the domain."""
+        generation = self.backend.get_generation(self.domain.slug) if version is None else f"solr:{version}"
+        return request_key(self.domain, endpoint, request, facilities, generation)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, channel=None, payload=None):
+        """
+        Drop every entry of the domain.  Used as the notification callback and after local writes.  Keys carry the
+        generation, so entries of older generations are never read again and age out of the backend.  With read
+        replicas the entries are dropped again once they have replayed the change, see routing.py.
+        """
+        generation = self.backend.bump_generation(self.domain.slug)
+        logger.debug(f"Response cache of {self.domain.slug} invalidated, channel:{channel}, generation:{generation}")
+        after_replay(("response_cache", self.domain.slug), self.invalidate_replayed)
+
+    def invalidate_replayed(self):
+        generation = self.backend.bump_generation(self.domain.slug)
+        logger.debug(f"Response cache of {self.domain.slug} invalidated after replica replay, generation:{generation}")
+
+
+_response_caches = {}
+_backends = {}
+_lock = threading.Lock()
+_flights = SingleFlight()
+_async_flights = AsyncSingleFlight()
+
+def _get_backend(domain):
+    backend_name = str(domain.setting("API_CACHE_BACKEND", "none")).lower()
+    ttl = int(domain.setting("API_CACHE_TTL", 300))
+    if backend_name == "lru":
+        options = (backend_name, ttl, int(domain.setting("API_CACHE_SIZE", 1000)))
+    elif backend_name == "django":
+        options = (backend_name, ttl, domain.setting("API_CACHE_ALIAS", "default"))
+    else:
+        return None
+
+    backend = _backends.get(options)
+    if backend is None:
+        backend = LruBackend(options[2], ttl) if backend_name == "lru" else DjangoCacheBackend(options[2], ttl)
+        _backends[options] = backend
+        logger.info(f"Response cache backend {backend_name} created, ttl {ttl}s")
+    return backend
+
+def get_response_cache(domain):
+    """Return the response cache of the domain, or None when its API_CACHE_BACKEND is none."""
+    if domain.slug not in _response_caches:
+        with _lock:
+            if domain.slug not in _response_caches:
+                backend = _get_backend(domain)
+                cache = ResponseCache(domain, backend) if backend is not None else None
+                if cache is not None:
+                    notify.subscribe(domain.db_channel, cache.invalidate)
+                    notify.subscribe(domain.db_channel_parent, cache.invalidate)
+                _response_caches[domain.slug] = cache
+    return _response_caches[domain.slug]
+
+def invalidate_response_cache(domain):
+    """Invalidate the response cache of the domain after a write made through this api."""
+    cache = get_response_cache(domain)
+    if cache is not None:
+        cache.invalidate()
+    # The writer's next poll must not be answered 304 before the notification of its write comes back, and its next
+    # SOLR read must look up the index version again, a commit of the write may have changed it.
+    bump_db_version(domain)
+    expire_solr_version(domain)
+    # Reads arriving after the write must not join a read that started before it.
+    _flights.forget(domain.slug)
+    _async_flights.forget(domain.slug)
+
+def _single_flight_timeout(domain):
+    """Seconds to wait for a read in flight, or None when single-flight is off for the domain."""
+    if not domain.flag("API_SINGLE_FLIGHT", True):
+        return None
+    return float(domain.setting("API_SINGLE_FLIGHT_TIMEOUT", 30))
+
+def _is_fallback(response):
+    """Responses served from the DB in SOLR's place are neither cached nor shared, they would outlive the outage."""
+    return response.has_header(FALLBACK_HEADER)
+
+def _shared(response):
+    """A response of its own for a caller that shared another request's read, the data is not copied."""
+    return Response(response.data, status=response.status_code)
+
+def cached_response(endpoint, source):
+    """
+    Serve successful responses of a view method reading the source (db or solr) from the response cache, and coalesce
+    identical concurrent misses.  Works for sync and async methods.
+    """
+    def decorator(method):
+        def lookup(view, request, cache, version):
+            domain = view.domain
+            facilities = get_claims(request).facility_set
+            if cache is None or (source == "solr" and version is None):
+                return None, request_key(domain, endpoint, request, facilities), None
+            key = cache.key(endpoint, request, facilities, version)
+            return cache, key, cache.get(key)
+
+        def store(cache, key, response):
+            if cache is not None and response.status_code == 200 and not _is_fallback(response):
+                cache.set(key, response.data)
+            return response
+
+        if iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(view, request, *args, **kwargs):
+                if primary_requested(request):
+                    return await method(view, request, *args, **kwargs)
+                cache = get_response_cache(view.domain)
+                version = await asolr_version(view.domain) if cache is not None and source == "solr" else None
+                cache, key, data = lookup(view, request, cache, version)
+                if data is not None:
+                    return Response(data)
+
+                async def read():
+                    return store(cache, key, await method(view, request, *args, **kwargs))
+
+                timeout = _single_flight_timeout(view.domain)
+                if timeout is None:
+                    return await read()
+                response, shared = await _async_flights.do(view.domain.slug, key, read, timeout)
+                if shared and _is_fallback(response):
+                    return await method(view, request, *args, **kwargs)
+                return _shared(response) if shared else response
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            # Reads pinned to the primary after a write must not get an entry or a shared read served by a replica.
+            if primary_requested(request):
+                return method(view, request, *args, **kwargs)
+            cache = get_response_cache(view.domain)
+            version = solr_version(view.domain) if cache is not None and source == "solr" else None
+            cache, key, data = lookup(view, request, cache, version)
+            if data is not None:
+                return Response(data)
+
+            def read():
+                return store(cache, key, method(view, request, *args, **kwargs))
+
+            timeout = _single_flight_timeout(view.domain)
+            if timeout is None:
+                return read()
+            response, shared = _flights.do(view.domain.slug, key, read, timeout)
+            if shared and _is_fallback(response):
+                return method(view, request, *args, **kwargs)
+            return _shared(response) if shared else response
+        return wrapper
+    return decorator
@@ -0,0 +1,241 @@
+"""
+File: routing.py
+Description: Read replica routing.  DATABASE_REPLICAS lists hot standbys ('host[:port],...') that settings adds as
+            replica_1..n next to default, with the same database, credentials and options.  DomainDb reads and the
+            export go round robin to the replicas whose replay lag is at most DATABASE_REPLICA_MAX_LAG seconds
+            (default 5), measured every DATABASE_REPLICA_LAG_INTERVAL seconds (default 5), and to the primary when no
+            replica qualifies or a replica cannot be reached.  A read that loses its replica connection (replica_read)
+            takes the replica out of rotation until its next lag check and runs once more on the primary.  Writes
+            always go to the primary.
+
+            Read-your-writes: for DATABASE_STICKY_SECONDS (default 5) after a write, the reads of the same user go to
+            the primary.  Write responses carry X-Read-Primary-Until (unix time); a client sending it back on its
+            reads is pinned by every worker, without it only by the worker that took the write.  ?read=primary
+            pins a single read.
+
+            Invalidation: a change is notified when the primary commits it, so a read right after may still get the old
+            rows from a replica and tag or cache them as new.  With replicas, the response cache and the DB version of
+            the ETags are invalidated once more DATABASE_REPLICA_MAX_LAG + DATABASE_REPLICA_LAG_INTERVAL seconds after
+            a change, so cached reads and ETags trail the primary by at most about that long.
+
+            ReplicaRouter makes the same choice for ORM reads of the DATABASE_REPLICA_APPS, other ORM reads (sessions,
+            auth) stay on the primary since they are read right after they are written.
+"""
+import functools
+import itertools
+import threading
+import time
+import psycopg
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connections, InterfaceError, OperationalError
+from manage import logger
+from .authentication import get_claims
+from .lru import LruCache
+from . import aio
+
+PRIMARY = "default"
+REPLICA_PREFIX = "replica_"
+STICKY_HEADER = "X-Read-Primary-Until"
+READ_QUERY_PARAM = "read"
+# Errors of the connection rather than of the query: the server went away, refused or timed out (pool included).
+CONNECTION_ERRORS = (OperationalError, InterfaceError, psycopg.OperationalError, psycopg.InterfaceError)
+# Zero on a standby that has replayed everything it received, so an idle primary does not look like lag.
+LAG_SQL = ("SELECT CASE WHEN pg_last_wal_receive_lsn() IS NULL OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+           "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END;")
+
+class ReplicaSet:
+    """The replicas with their last measured lag (None when the check failed), and the round robin over them."""
+
+    def __init__(self, aliases, max_lag, interval):
+        self.aliases = aliases
+        self.max_lag = max_lag
+        self.interval = interval
+        self._lags = {alias: None for alias in aliases}
+        self._checked = {alias: 0.0 for alias in aliases}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def due(self):
+        """Replicas to check now.  They are claimed, so one request per interval runs the check."""
+        now = time.monotonic()
+        with self._lock:
+            aliases = [alias for alias in self.aliases if now - self._checked[alias] >= self.interval]
+            for alias in aliases:
+                self._checked[alias] = now
+        return aliases
+
+    def record(self, alias, lag):
+        if lag is None or lag > self.max_lag:
+            logger.warning(f"Replica {alias} skipped for reads, lag:{lag}")
+        self._lags[alias] = lag
+
+    def failed(self, alias, error):
+        """Take a replica that failed a read out of rotation until its next lag check."""
+        logger.warning(f"❌Error reading from replica {alias}, reading from the primary: {str(error)}")
+        with self._lock:
+            self._lags[alias] = None
+            self._checked[alias] = time.monotonic()
+
+    def pick(self):
+        eligible = [alias for alias in self.aliases if self._lags[alias] is not None and self._lags[alias] <= self.max_lag]
+        if not eligible:
+            return PRIMARY
+        return eligible[next(self._turn) % len(eligible)]
+
+
+replicas = ReplicaSet([alias for alias in settings.DATABASES if alias.startswith(REPLICA_PREFIX)],
+                      float(getattr(settings, "DATABASE_REPLICA_MAX_LAG", 5)),
+                      float(getattr(settings, "DATABASE_REPLICA_LAG_INTERVAL", 5)))
+_sticky_users = LruCache(10000)
+_replays = {}
+_replays_lock = threading.Lock()
+
+def _sticky_seconds():
+    return float(getattr(settings, "DATABASE_STICKY_SECONDS", 5))
+
+def primary_requested(request):
+    """True when the read has to see the writes of its user: ?read=primary or within the sticky window of a write."""
+    if not replicas.aliases:
+        return False
+    if request.query_params.get(READ_QUERY_PARAM) == "primary":
+        return True
+    now = time.time()
+    try:
+        if float(request.headers.get(STICKY_HEADER, 0)) > now:
+            return True
+    except ValueError:
+        pass
+    return _sticky_users.get(get_claims(request).user_id, 0) > now
+
+def stick_to_primary(request, response):
+    """Pin the reads of the user to the primary for DATABASE_STICKY_SECONDS after a write."""
+    if not replicas.aliases or response.status_code >= 400:
+        return response
+    until = time.time() + _sticky_seconds()
+    _sticky_users.set(get_claims(request).user_id, until, expires_at=until)
+    response[STICKY_HEADER] = f"{until:.3f}"
+    return response
+
+def _check_lag(alias):
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = float(cursor.fetchone()[0] or 0)
+    except Exception as e:
+        logger.warning(f"❌Error checking the lag of replica {alias}: {str(e)}")
+        lag = None
+    replicas.record(alias, lag)
+
+async def _acheck_lag(alias):
+    try:
+        columns, rows = await aio.fetch(LAG_SQL, [], alias)
+        lag = float(rows[0][0] or 0)
+    except Exception as e:
+        logger.warning(f"❌Error checking the lag of replica {alias}: {str(e)}")
+        lag = None
+    replicas.record(alias, lag)
+
+def read_alias(request=None):
+    """Database alias for a read: a replica within the lag threshold, or the primary."""
+    if not replicas.aliases or (request is not None and primary_requested(request)):
+        return PRIMARY
+    for alias in replicas.due():
+        _check_lag(alias)
+    return replicas.pick()
+
+async def aread_alias(request=None):
+    """Async counterpart of read_alias."""
+    if not replicas.aliases or (request is not None and primary_requested(request)):
+        return PRIMARY
+    for alias in replicas.due():
+        await _acheck_lag(alias)
+    return replicas.pick()
+
+def replica_read(request, read):
+    """
+    Return read(alias) on the database alias of read_alias.  When a replica connection fails, the replica is taken out
+    of rotation and the read runs once more on the primary.
+    """
+    alias = read_alias(request)
+    try:
+        return read(alias)
+    except CONNECTION_ERRORS as e:
+        if alias == PRIMARY:
+            raise
+        replicas.failed(alias, e)
+    return read(PRIMARY)
+
+async def areplica_read(request, read):
+    """Async counterpart of replica_read, read is a coroutine function."""
+    alias = await aread_alias(request)
+    try:
+        return await read(alias)
+    except CONNECTION_ERRORS as e:
+        if alias == PRIMARY:
+            raise
+        replicas.failed(alias, e)
+    return await read(PRIMARY)
+
+def after_replay(key, callback):
+    """
+    Run callback again once the replicas have had time to replay a change the primary committed now, see the module
+    description.  Changes of the same key while a run is pending move it later, but it runs at least once per delay.
+    """
+    if not replicas.aliases:
+        return
+    delay = replicas.max_lag + replicas.interval
+    with _replays_lock:
+        pending = key in _replays
+        _replays[key] = time.monotonic() + delay
+    if not pending:
+        _schedule_replay(key, callback, delay)
+
+def _schedule_replay(key, callback, delay):
+    timer = threading.Timer(delay, _replay, (key, callback))
+    timer.daemon = True
+    timer.start()
+
+def _replay(key, callback):
+    try:
+        callback()
+    except Exception as e:
+        logger.warning(f"❌Error invalidating {key} after replica replay: {str(e)}")
+    with _replays_lock:
+        remaining = _replays[key] - time.monotonic()
+        if remaining <= 0:
+            del _replays[key]
+            return
+    _schedule_replay(key, callback, remaining)
+
+def sticky_writes(method):
+    """Pin the user's reads to the primary after a successful write of the view method, sync or async."""
+    if iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def async_wrapper(view, request, *args, **kwargs):
+            return stick_to_primary(request, await method(view, request, *args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        return stick_to_primary(request, method(view, request, *args, **kwargs))
+    return wrapper
+
+
+class ReplicaRouter:
+    """Django database router: ORM reads of DATABASE_REPLICA_APPS follow read_alias, everything else stays on the primary."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in getattr(settings, "DATABASE_REPLICA_APPS", ()):
+            return read_alias()
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
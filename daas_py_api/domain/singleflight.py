@@ -0,0 +1,115 @@
+"""
+File: singleflight.py
+Description: Single-flight deduplication of identical concurrent calls.  The first caller of a key runs the call, the
+            callers that arrive while it is in flight wait for it and share its outcome instead of repeating it.
+            Calls are grouped (by domain), so a write can make later callers start a fresh call with forget().
+"""
+import asyncio
+import threading
+import weakref
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Deduplicates calls between the threads of a process."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, group, key, fn, timeout=None):
+        """
+        Return (result, shared).  shared is True when the result came from another caller's call.  A caller that waits
+        longer than timeout seconds gives up on the call in flight and runs its own.
+        """
+        with self._lock:
+            call = self._calls.get((group, key))
+            leader = call is None
+            if leader:
+                call = self._calls[(group, key)] = _Call()
+
+        if not leader:
+            if call.done.wait(timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            return fn(), False
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._release(group, key, call)
+            call.done.set()
+
+    def _release(self, group, key, call):
+        with self._lock:
+            if self._calls.get((group, key)) is call:
+                del self._calls[(group, key)]
+
+    def forget(self, group):
+        """Callers arriving from now on start a new call, the ones already waiting still share the call in flight."""
+        with self._lock:
+            for group_key in [group_key for group_key in self._calls if group_key[0] == group]:
+                del self._calls[group_key]
+
+
+class AsyncSingleFlight:
+    """Deduplicates coroutine calls between the tasks of an event loop."""
+
+    def __init__(self):
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _calls(self):
+        loop = asyncio.get_running_loop()
+        calls = self._loops.get(loop)
+        if calls is None:
+            calls = self._loops[loop] = {}
+        return calls
+
+    async def do(self, group, key, fn, timeout=None):
+        """Async counterpart of SingleFlight.do, fn is a coroutine function."""
+        calls = self._calls()
+        call = calls.get((group, key))
+        if call is not None:
+            try:
+                return await asyncio.wait_for(asyncio.shield(call), timeout), True
+            except asyncio.TimeoutError:
+                return await fn(), False
+            except asyncio.CancelledError:
+                # The leader was cancelled (client gone), not this caller.
+                if call.cancelled():
+                    return await fn(), False
+                raise
+
+        call = calls[(group, key)] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            call.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as e:
+            call.set_exception(e)
+            # Mark the exception as retrieved, there may be no other caller waiting for it.
+            call.exception()
+            raise
+        finally:
+            if calls.get((group, key)) is call:
+                del calls[(group, key)]
+
+    def forget(self, group):
+        for calls in list(self._loops.values()):
+            for group_key in [group_key for group_key in calls if group_key[0] == group]:
+                del calls[group_key]
@@ -0,0 +1,111 @@
+"""
+File: solr.py
+Description: Process wide SOLR clients.  Each domain gets one pysolr client backed by a pooled requests session,
+            so connections are kept alive between requests and shared by all worker threads.
+"""
+import copy
+import threading
+import pysolr
+import requests
+from requests.adapters import HTTPAdapter
+from manage import logger, config
+from . import metrics
+
+# Resolve credentials once at startup instead of on every request.
+SOLR_AUTH = (config.get_secret('SOLR_USER'), config.get_secret('SOLR_PASSWORD'))
+
+# none: leave visibility to the SOLR autoCommit settings, within: commitWithin SOLR_COMMIT_WITHIN_MS,
+# soft: soft commit after the request, explicit: hard commit after the request.
+COMMIT_POLICIES = ("none", "within", "soft", "explicit")
+LUKE_INDEX_PARAMS = {"numTerms": 0, "show": "index", "wt": "json"}
+
+_clients = {}
+_sessions = {}
+_clients_lock = threading.Lock()
+
+def _get_session(pool_size, max_retries):
+    """
+    Requests session with a connection pool sized for the number of concurrent worker threads.  Domains with the same
+    pool settings share one session, and so the kept-alive connections to SOLR.
+    """
+    session = _sessions.get((pool_size, max_retries))
+    if session is None:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+        session = requests.Session()
+        session.stream = False
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions[(pool_size, max_retries)] = session
+    return session
+
+def get_solr(domain, url=None):
+    """Return the shared client for the SOLR collection of a domain, or one replica url of it, creating it on first use."""
+    url = url or domain.solr_url
+    client = _clients.get((domain.slug, url))
+    if client is None:
+        with _clients_lock:
+            client = _clients.get((domain.slug, url))
+            if client is None:
+                timeout = (float(domain.setting("SOLR_CONNECT_TIMEOUT", 5)), float(domain.setting("SOLR_TIMEOUT", 60)))
+                session = _get_session(int(domain.setting("SOLR_POOL_SIZE", 10)), int(domain.setting("SOLR_MAX_RETRIES", 0)))
+                client = pysolr.Solr(url, auth=SOLR_AUTH, timeout=timeout, session=session)
+                _clients[(domain.slug, url)] = client
+                logger.info(f"Created SOLR client for {url} with timeout {timeout}")
+    return client
+
+def select(domain, solr_params, url=None, timeout=None):
+    """
+    Run a select on the collection of a domain, or one replica url of it, and return the pysolr Results.  timeout
+    overrides the read timeout of the client for this search.
+    """
+    solr = get_solr(domain, url)
+    if timeout is not None:
+        # The copy shares the session, and so the kept-alive connections, only its timeouts differ.
+        solr = copy.copy(solr)
+        solr.timeout = (solr.timeout[0], timeout)
+    return solr.search(**solr_params)
+
+def resolve_commit_policy(domain, requested=None):
+    """Return the commit policy for a write.  A caller may ask for an immediate commit (commit=true) for read-your-writes."""
+    policy = str(requested or domain.setting("SOLR_COMMIT_POLICY", "within")).lower()
+    if policy == "true":
+        policy = "soft"
+    elif policy == "false":
+        policy = "none"
+    if policy not in COMMIT_POLICIES:
+        raise ValueError(f"Invalid commit policy '{policy}', expected one of {COMMIT_POLICIES}")
+    return policy
+
+def index_documents(domain, documents, policy):
+    """
+    Add documents to SOLR in chunks of SOLR_BATCH_SIZE and commit once at the end according to the policy, so the
+    commit rate no longer follows the request rate.
+    """
+    if not documents:
+        return
+
+    solr = get_solr(domain)
+    batch_size = int(domain.setting("SOLR_BATCH_SIZE", 1000))
+    commit_within = int(domain.setting("SOLR_COMMIT_WITHIN_MS", 1000)) if policy == "within" else None
+
+    with metrics.stage("solr"):
+        for start in range(0, len(documents), batch_size):
+            solr.add(documents[start:start + batch_size], commit=False, commitWithin=commit_within)
+
+        if policy == "soft":
+            solr.commit(softCommit=True)
+        elif policy == "explicit":
+            solr.commit()
+
+def index_version(domain, url=None, timeout=None):
+    """
+    Version of the index reader the collection (or one replica url of it) currently searches, from the Luke handler.
+    It changes with every commit that opens a new searcher, soft commits included, so it marks when search results may
+    have changed.  timeout overrides the SOLR timeouts of the client.
+    """
+    solr = get_solr(domain, url)
+    with metrics.stage("solr"):
+        response = solr.session.get(f"{solr.url}/admin/luke", params=LUKE_INDEX_PARAMS, auth=SOLR_AUTH,
+                                    timeout=timeout or solr.timeout)
+        response.raise_for_status()
+    return response.json()["index"]["version"]
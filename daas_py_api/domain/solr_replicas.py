@@ -0,0 +1,428 @@
+"""
+File: solr_replicas.py
+Description: Hedged and failover-aware SOLR searches.  SOLR_URLS lists the SOLR nodes serving the collections
+            ('http://solr1:8983/solr,http://solr2:8983/solr', default SOLR_URL), and searches go to them round robin.
+            When the first replica has not answered after the SOLR_HEDGE_PERCENTILE of the recent search latencies of
+            the domain, the same search is sent to the next replica and the first answer wins.  A replica that fails
+            or times out is replaced by the next one at once.  Hedged attempts time out after SOLR_HEDGE_BUDGET_MS,
+            and time outs or answers slower than that count against the replica, so a stalled replica is taken out
+            even when another one wins.  A sync search only uses a free thread of the pool, when every thread is busy
+            it searches the replicas one after the other in the request thread rather than queue behind stalled ones.  Writes keep going to the first node, which routes them
+            in SolrCloud.
+
+            Every replica has a circuit breaker: SOLR_BREAKER_FAILURES consecutive failures open it and the replica is
+            skipped for SOLR_BREAKER_RESET seconds, then a single trial search (half-open) closes or re-opens it.  Errors
+            of the query itself (HTTP 4xx) are passed on to the caller and do not count against the replica.  When no
+            replica can answer, SolrUnavailable is raised (503 with Retry-After), or with SOLR_DB_FALLBACK the simple
+            lookups of DomainCache.get (no q, fq, sort or cursor) are served from DB_FUNC_GET, marked X-Served-From: db.
+
+            SOLR_HEDGE             true (default) or false, hedging needs two replicas or more
+            SOLR_HEDGE_PERCENTILE  latency percentile after which the duplicate search is sent (default 95)
+            SOLR_HEDGE_DELAY_MS    lower bound of the hedge delay, used alone until enough latencies are known (default 50)
+            SOLR_HEDGE_SAMPLES     recent latencies kept per domain (default 200)
+            SOLR_HEDGE_WORKERS     threads running the hedged searches of the sync views, shared by the domains (default 32)
+            SOLR_HEDGE_BUDGET_MS   time a replica has to answer a hedged search, the read timeout of each attempt (default 5000)
+            SOLR_BREAKER_FAILURES  default 5
+            SOLR_BREAKER_RESET     default 30
+            SOLR_VERSION_TIMEOUT   seconds a replica has to tell its index version for the ETags and cache keys (default 0.5)
+            SOLR_DB_FALLBACK       true or false (default)
+"""
+import asyncio
+import collections
+import itertools
+import math
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+import httpx
+import pysolr
+import requests
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from manage import logger
+from .solr import index_version, select
+from .workers import reserve, submit_reserved, unreserve
+from . import aio, metrics
+
+FALLBACK_HEADER = "X-Served-From"
+# Percentiles of fewer latencies than this are noise, SOLR_HEDGE_DELAY_MS is used until then.
+MIN_SAMPLES = 20
+HTTP_STATUS_PATTERN = re.compile(r"\(HTTP (\d{3})\)")
+# Statuses of the replica rather than of the query: timeout and throttling.
+RETRYABLE_STATUSES = (408, 429)
+
+class SolrUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Search is unavailable, try again later."
+    default_code = "solr_unavailable"
+
+    def __init__(self, detail=None, wait=None):
+        super().__init__(detail)
+        # Sent as Retry-After by the DRF exception handler.
+        self.wait = wait
+
+
+def is_query_error(e):
+    """True when SOLR rejected the query itself (HTTP 4xx), which any other replica would reject as well."""
+    if isinstance(e, (httpx.HTTPStatusError, requests.HTTPError)) and e.response is not None:
+        code = e.response.status_code
+    elif isinstance(e, pysolr.SolrError):
+        match = HTTP_STATUS_PATTERN.search(str(e))
+        if match is None:
+            return False
+        code = int(match.group(1))
+    else:
+        return False
+    return 400 <= code < 500 and code not in RETRYABLE_STATUSES
+
+
+class CircuitBreaker:
+    """Closed, open after `failures` consecutive failures, and half-open (one trial) `reset` seconds later."""
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, name, failures, reset):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.state = self.CLOSED
+        self.failed = 0
+        self.changed_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        May a search go to the replica now.  In half-open a trial is let through every `reset` seconds, so a trial that
+        never reports back (a cancelled hedge) does not keep the replica out for good.
+        """
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self.changed_at < self.reset:
+                return False
+            self.state = self.HALF_OPEN
+            self.changed_at = now
+            return True
+
+    def record_success(self):
+        if self.state == self.CLOSED and self.failed == 0:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"SOLR replica {self.name} closed its circuit breaker")
+            self.state = self.CLOSED
+            self.failed = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failed >= self.failures):
+                logger.warning(f"SOLR replica {self.name} opened its circuit breaker after {self.failed} failures")
+                self.state = self.OPEN
+                self.changed_at = time.monotonic()
+
+    def retry_after(self):
+        """Seconds until the replica gets its next trial, 0 while it is closed."""
+        if self.state == self.CLOSED:
+            return 0.0
+        return max(0.0, self.reset - (time.monotonic() - self.changed_at))
+
+
+class LatencyWindow:
+    """The most recent search latencies of a domain, with their percentiles recomputed every RECOMPUTE_EVERY samples."""
+    RECOMPUTE_EVERY = 10
+
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+        self.recorded = 0
+        self._percentiles = {}
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+            self.recorded += 1
+
+    def percentile(self, pct):
+        """Latency under which pct percent of the recent searches answered, or None while too few are known."""
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        # Sorting the window on every search is wasted work, the percentile barely moves in a few samples.
+        cached = self._percentiles.get(pct)
+        if cached is not None and self.recorded - cached[0] < self.RECOMPUTE_EVERY:
+            return cached[1]
+        with self._lock:
+            ordered = sorted(self.samples)
+            recorded = self.recorded
+        value = ordered[min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1)]
+        self._percentiles[pct] = (recorded, value)
+        return value
+
+
+_breakers = {}
+_replica_sets = {}
+_breakers_lock = threading.Lock()
+_registry_lock = threading.Lock()
+
+def get_breaker(domain, url):
+    """Breakers are per replica url, domains searching the same collection share them."""
+    breaker = _breakers.get(url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(url)
+            if breaker is None:
+                breaker = _breakers[url] = CircuitBreaker(url, int(domain.setting("SOLR_BREAKER_FAILURES", 5)),
+                                                          float(domain.setting("SOLR_BREAKER_RESET", 30)))
+    return breaker
+
+
+class SolrReplicas:
+    """The replicas of the SOLR collection of a domain, searched round robin with hedging and failover."""
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.replicas = [(url, get_breaker(domain, url)) for url in domain.solr_urls]
+        self.hedge = domain.flag("SOLR_HEDGE", True) and len(self.replicas) > 1
+        self.hedge_percentile = float(domain.setting("SOLR_HEDGE_PERCENTILE", 95))
+        self.hedge_min_delay = float(domain.setting("SOLR_HEDGE_DELAY_MS", 50)) / 1000
+        self.latencies = LatencyWindow(int(domain.setting("SOLR_HEDGE_SAMPLES", 200)))
+        self.version_timeout = float(domain.setting("SOLR_VERSION_TIMEOUT", 0.5))
+        # Read timeout of the hedged attempts, never longer than the timeout of the clients.
+        self.budget = min(float(domain.setting("SOLR_HEDGE_BUDGET_MS", 5000)) / 1000,
+                          float(domain.setting("SOLR_TIMEOUT", 60))) if self.hedge else None
+        self._turn = itertools.count()
+
+    def order(self):
+        """All replicas, starting from the next one in turn."""
+        start = next(self._turn) % len(self.replicas)
+        return self.replicas[start:] + self.replicas[:start]
+
+    def hedge_delay(self):
+        percentile = self.latencies.percentile(self.hedge_percentile)
+        return self.hedge_min_delay if percentile is None else max(self.hedge_min_delay, percentile)
+
+    def unavailable(self, error=None):
+        wait = min(breaker.retry_after() for url, breaker in self.replicas)
+        logger.error(f"❌Error searching SOLR for {self.domain.slug}, no replica could answer: {str(error) if error else 'all circuit breakers open'}")
+        return SolrUnavailable(wait=max(1, math.ceil(wait)))
+
+    def succeeded(self, url, breaker, started):
+        elapsed = time.perf_counter() - started
+        self.latencies.record(elapsed)
+        if self.budget is not None and elapsed > self.budget:
+            # The answer came too late to be of use, the replica is as good as stalled.
+            breaker.record_failure()
+            logger.warning(f"❌Error from SOLR replica {url} for {self.domain.slug}: answered after {elapsed:.3f}s, over the {self.budget}s budget")
+        else:
+            breaker.record_success()
+
+    def failed(self, url, breaker, e):
+        if is_query_error(e):
+            # The replica answered, the query is at fault.
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+            logger.warning(f"❌Error from SOLR replica {url} for {self.domain.slug}: {str(e)}")
+
+    def version(self, url, breaker):
+        """Index version of one replica, or None while its breaker keeps it out or it does not answer in time."""
+        if not breaker.allow():
+            return None
+        try:
+            version = index_version(self.domain, url, self.version_timeout)
+        except Exception as e:
+            self.failed(url, breaker, e)
+            return None
+        breaker.record_success()
+        return version
+
+    async def aversion(self, url, breaker):
+        if not breaker.allow():
+            return None
+        try:
+            version = await aio.solr_index_version(self.domain, url, self.version_timeout)
+        except Exception as e:
+            self.failed(url, breaker, e)
+            return None
+        breaker.record_success()
+        return version
+
+    def attempt(self, url, breaker, solr_params):
+        started = time.perf_counter()
+        try:
+            results = select(self.domain, solr_params, url, self.budget)
+        except Exception as e:
+            self.failed(url, breaker, e)
+            raise
+        self.succeeded(url, breaker, started)
+        return results
+
+    async def aattempt(self, url, breaker, solr_params):
+        started = time.perf_counter()
+        try:
+            results = await aio.solr_search(self.domain, solr_params, url, self.budget)
+        except Exception as e:
+            self.failed(url, breaker, e)
+            raise
+        self.succeeded(url, breaker, started)
+        return results
+
+    @staticmethod
+    def outcome(done):
+        """The result of the first successful search among the finished ones, or the errors of all of them."""
+        done = list(done)
+        errors = [task.exception() for task in done]
+        for task, error in zip(done, errors):
+            if error is None:
+                return task.result(), []
+        query_errors = [error for error in errors if is_query_error(error)]
+        if query_errors:
+            raise query_errors[0]
+        return None, errors
+
+    def failover(self, replicas, solr_params, last_error=None):
+        """Search the replicas one after the other in the request thread, until one answers."""
+        for url, breaker in replicas:
+            if breaker.allow():
+                try:
+                    return self.attempt(url, breaker, solr_params)
+                except Exception as e:
+                    if is_query_error(e):
+                        raise
+                    last_error = e
+        raise self.unavailable(last_error)
+
+    def search(self, solr_params):
+        """Run a select and return the pysolr Results, see the module description."""
+        replicas = iter(self.order())
+        if not self.hedge:
+            return self.failover(replicas, solr_params)
+
+        pending = set()
+
+        def launch():
+            """Search the next replica on a free thread of the pool.  None when no thread is free, False when no replica is left."""
+            if not reserve("solr", "SOLR_HEDGE_WORKERS", 32):
+                return None
+            for url, breaker in replicas:
+                if breaker.allow():
+                    # A losing search finishes on the pool unobserved, within the budget.
+                    pending.add(submit_reserved("solr", self.attempt, url, breaker, solr_params))
+                    return True
+            unreserve("solr")
+            return False
+
+        launched = launch()
+        if launched is None:
+            logger.debug(f"No free thread to hedge the SOLR search of {self.domain.slug}, searching in the request thread")
+            return self.failover(replicas, solr_params)
+        if not launched:
+            raise self.unavailable()
+        last_error = None
+        hedged = False
+        while pending:
+            delay = None if hedged else self.hedge_delay()
+            done, not_done = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if launch():
+                    logger.debug(f"Hedging SOLR search of {self.domain.slug} after {delay * 1000:.0f}ms")
+                continue
+            pending = not_done
+            result, errors = self.outcome(done)
+            if not errors:
+                return result
+            last_error = errors[-1]
+            if launch() is None and not pending:
+                return self.failover(replicas, solr_params, last_error)
+        raise self.unavailable(last_error)
+
+    async def asearch(self, solr_params):
+        """Async counterpart of search, returning the decoded json response.  Losing searches are cancelled."""
+        replicas = iter(self.order())
+        pending = set()
+
+        def launch():
+            for url, breaker in replicas:
+                if breaker.allow():
+                    pending.add(asyncio.ensure_future(self.aattempt(url, breaker, solr_params)))
+                    return True
+            return False
+
+        last_error = None
+        hedged = not self.hedge
+        try:
+            launch()
+            while pending:
+                delay = None if hedged else self.hedge_delay()
+                done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if launch():
+                        logger.debug(f"Hedging SOLR search of {self.domain.slug} after {delay * 1000:.0f}ms")
+                    continue
+                result, errors = self.outcome(done)
+                if not errors:
+                    return result
+                last_error = errors[-1]
+                launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise self.unavailable(last_error)
+
+
+def get_replicas(domain):
+    replica_set = _replica_sets.get(domain.slug)
+    if replica_set is None:
+        with _registry_lock:
+            replica_set = _replica_sets.get(domain.slug)
+            if replica_set is None:
+                replica_set = _replica_sets[domain.slug] = SolrReplicas(domain)
+    return replica_set
+
+def search(domain, solr_params):
+    """Search the SOLR collection of the domain on its replicas, returning pysolr Results."""
+    return get_replicas(domain).search(solr_params)
+
+async def asearch(domain, solr_params):
+    """Async counterpart of search, returning the decoded json response."""
+    with metrics.stage("solr"):
+        return await get_replicas(domain).asearch(solr_params)
+
+def fallback_allowed(domain, request):
+    """A DomainCache.get lookup that DB_FUNC_GET can answer in SOLR's place: no query, filter or sort of its own."""
+    if not domain.flag("SOLR_DB_FALLBACK", False):
+        return False
+    return request.GET.get("q", "*:*") == "*:*" and not request.GET.getlist("fq") and not request.GET.get("sort")
+
+def _marker(versions):
+    # Replicas out of rotation stand as '-', so the marker changes when they come back with another index.
+    return None if all(version is None for version in versions) else ",".join("-" if version is None else str(version) for version in versions)
+
+def index_marker(domain):
+    """
+    Version marker of the collection over all replicas.  A search may be answered by any of them, so the marker has
+    to change whenever the index of any replica does.  Replicas are asked concurrently, through their circuit breakers
+    and within SOLR_VERSION_TIMEOUT seconds (default 0.5), so a stalled replica cannot hold up the reads.
+    """
+    replica_set = get_replicas(domain)
+    started = time.monotonic()
+    probes = {}
+    for url, breaker in replica_set.replicas[1:]:
+        if reserve("solr", "SOLR_HEDGE_WORKERS", 32):
+            probes[url] = submit_reserved("solr", replica_set.version, url, breaker)
+    # The first replica, and the ones without a free thread, are asked in the request thread meanwhile.
+    versions = {url: replica_set.version(url, breaker) for url, breaker in replica_set.replicas if url not in probes}
+    done, not_done = wait(probes.values(), timeout=max(0.0, replica_set.version_timeout - (time.monotonic() - started)))
+    # Probes that have not answered in time stand as unknown, like a replica out of rotation.
+    versions.update({url: probe.result() if probe in done else None for url, probe in probes.items()})
+    return _marker([versions[url] for url, breaker in replica_set.replicas])
+
+async def aindex_marker(domain):
+    """Async counterpart of index_marker."""
+    replica_set = get_replicas(domain)
+    return _marker(await asyncio.gather(*[replica_set.aversion(url, breaker) for url, breaker in replica_set.replicas]))
@@ -0,0 +1,228 @@
+"""
+File: solr_sync.py
+Description: Write-behind sync of DB upserts to SOLR.  Upserted rows are queued and coalesced by the SOLR unique key,
+            so only the latest version of a document is sent, and a background thread flushes them in batches.  DB
+            writes return as soon as the DB commits instead of waiting on a second round trip to SOLR.
+
+            SOLR_SYNC                   off (default), upsert (rows returned by DomainDbUpsert in this process) or
+                                        notify (json payloads published on DB_CHANNEL, consumed by a single
+                                        process running python manage.py solr_sync)
+            SOLR_SYNC_BATCH_SIZE        flush as soon as this many documents are pending
+            SOLR_SYNC_MAX_LATENCY_MS    flush when the oldest pending document has waited this long
+            SOLR_SYNC_CAPACITY          maximum pending documents, writers wait for room beyond that
+            SOLR_SYNC_BLOCK_MS          how long a writer waits for room before the documents are rejected
+            SOLR_SYNC_MAX_RETRIES       failed flushes of a document before it is dropped (default 10, 0 = no limit)
+
+            Documents SOLR rejects (HTTP 4xx, i.e. a bad field value) are dropped at once: a rejected batch is split
+            until the rejected documents are found, and the others are indexed.  Dropped documents are logged with
+            their key and counted in the stats, so one bad row cannot block the queue.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from manage import logger
+from .solr import index_documents, resolve_commit_policy
+from .solr_replicas import is_query_error
+from . import notify
+
+class SolrSyncQueue:
+
+    def __init__(self, domain, unique_key, batch_size, max_latency, capacity, block_timeout, max_retries=10):
+        self.domain = domain
+        self.unique_key = unique_key
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.capacity = capacity
+        self.block_timeout = block_timeout
+        self.max_retries = max_retries
+        # key -> (document, enqueued_at), in the order the keys were first queued.
+        self._pending = OrderedDict()
+        # key -> failed flushes of the pending document.
+        self._attempts = {}
+        self._condition = threading.Condition()
+        self._counters = {"enqueued": 0, "coalesced": 0, "flushed": 0, "failed_batches": 0, "rejected": 0, "dropped": 0}
+        self._last_flush = None
+        self._thread = threading.Thread(target=self._run, name=f"daas-solr-sync-{domain.slug}", daemon=True)
+        self._thread.start()
+
+    def submit(self, documents, timeout=None):
+        """
+        Queue documents for indexing.  Returns False when the queue stayed full for the whole timeout (default
+        block_timeout), in which case the documents are not queued.
+        """
+        timeout = self.block_timeout if timeout is None else timeout
+        with self._condition:
+            deadline = time.monotonic() + timeout
+            while len(self._pending) + len(documents) > self.capacity and len(self._pending) > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["rejected"] += len(documents)
+                    return False
+                self._condition.wait(remaining)
+
+            now = time.monotonic()
+            for document in documents:
+                key = document.get(self.unique_key, id(document))
+                if key in self._pending:
+                    # Keep the original enqueue time, so the lag reflects how long the key has been waiting.
+                    self._pending[key] = (document, self._pending[key][1])
+                    self._counters["coalesced"] += 1
+                else:
+                    self._pending[key] = (document, now)
+                self._counters["enqueued"] += 1
+            self._condition.notify_all()
+        return True
+
+    def submit_notification(self, channel, payload):
+        """Notification callback, queues the json document(s) published by the upsert function."""
+        if payload is None:
+            return
+        try:
+            documents = json.loads(payload)
+        except ValueError:
+            logger.debug(f"Ignoring notification on {channel} that is not a json document")
+            return
+        documents = documents if isinstance(documents, list) else [documents]
+        self.submit([document for document in documents if isinstance(document, dict)])
+
+    def stats(self):
+        """Backpressure and lag metrics of the queue."""
+        with self._condition:
+            oldest = next(iter(self._pending.values()), None)
+            return {
+                "pending": len(self._pending),
+                "capacity": self.capacity,
+                "lag_seconds": round(time.monotonic() - oldest[1], 3) if oldest else 0.0,
+                "seconds_since_flush": round(time.monotonic() - self._last_flush, 3) if self._last_flush else None,
+                **self._counters,
+            }
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._pending:
+                    oldest_age = time.monotonic() - next(iter(self._pending.values()))[1]
+                    if len(self._pending) >= self.batch_size or oldest_age >= self.max_latency:
+                        break
+                    self._condition.wait(self.max_latency - oldest_age)
+                else:
+                    self._condition.wait()
+
+            batch = [self._pending.popitem(last=False) for _ in range(min(self.batch_size, len(self._pending)))]
+            self._condition.notify_all()
+            return batch
+
+    def _requeue(self, batch):
+        """
+        Put a failed batch back in front of the queue, unless a newer version of a document was queued meanwhile.
+        Documents that failed max_retries times are dropped.
+        """
+        dropped = []
+        with self._condition:
+            for key, entry in reversed(batch):
+                if key in self._pending:
+                    self._attempts.pop(key, None)
+                    continue
+                attempts = self._attempts.get(key, 0) + 1
+                if self.max_retries and attempts >= self.max_retries:
+                    self._attempts.pop(key, None)
+                    dropped.append(key)
+                    continue
+                self._attempts[key] = attempts
+                self._pending[key] = entry
+                self._pending.move_to_end(key, last=False)
+            self._counters["dropped"] += len(dropped)
+            self._condition.notify_all()
+        if dropped:
+            logger.error(f"❌Error syncing to SOLR, dropped {len(dropped)} documents after {self.max_retries} attempts: {dropped[:20]}")
+
+    def _flush(self, batch):
+        """
+        Index the batch and return the entries SOLR rejected.  A rejected batch is split in halves, each indexed on its
+        own, down to the rejected documents.  Other errors are raised for the whole batch.
+        """
+        try:
+            index_documents(self.domain, [document for key, (document, enqueued_at) in batch], resolve_commit_policy(self.domain))
+            return []
+        except Exception as e:
+            if not is_query_error(e):
+                raise
+            if len(batch) == 1:
+                logger.error(f"❌Error syncing document {batch[0][0]} to SOLR, dropped: {str(e)}")
+                return batch
+        middle = len(batch) // 2
+        return self._flush(batch[:middle]) + self._flush(batch[middle:])
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                rejected = self._flush(batch)
+                with self._condition:
+                    self._counters["flushed"] += len(batch) - len(rejected)
+                    self._counters["dropped"] += len(rejected)
+                    self._last_flush = time.monotonic()
+                    for key, entry in batch:
+                        self._attempts.pop(key, None)
+            except Exception as e:
+                logger.exception(f"❌Error syncing {len(batch)} documents to SOLR, retrying: {str(e)}")
+                with self._condition:
+                    self._counters["failed_batches"] += 1
+                self._requeue(batch)
+                time.sleep(min(self.max_latency * 10, 5))
+
+
+_sync_queues = {}
+_sync_queues_lock = threading.Lock()
+
+def sync_mode(domain):
+    return str(domain.setting("SOLR_SYNC", "off")).lower()
+
+def _create_queue(domain):
+    with _sync_queues_lock:
+        queue = _sync_queues.get(domain.slug)
+        if queue is None:
+            queue = _sync_queues[domain.slug] = SolrSyncQueue(domain,
+                                  unique_key=domain.setting("SOLR_UNIQUE_KEY", "id"),
+                                  batch_size=int(domain.setting("SOLR_SYNC_BATCH_SIZE", 500)),
+                                  max_latency=int(domain.setting("SOLR_SYNC_MAX_LATENCY_MS", 1000)) / 1000,
+                                  capacity=int(domain.setting("SOLR_SYNC_CAPACITY", 50000)),
+                                  block_timeout=int(domain.setting("SOLR_SYNC_BLOCK_MS", 100)) / 1000,
+                                  max_retries=int(domain.setting("SOLR_SYNC_MAX_RETRIES", 10)))
+            if sync_mode(domain) == "notify":
+                notify.subscribe(domain.db_channel, queue.submit_notification)
+            logger.info(f"SOLR sync of {domain.slug} enabled in {sync_mode(domain)} mode")
+    return queue
+
+def get_sync_queue(domain):
+    """
+    Return the SOLR sync queue of the domain in this process, or None when the process does not sync the domain.
+    Upsert queues are created on first use, notify queues only by start_notify_consumer.
+    """
+    queue = _sync_queues.get(domain.slug)
+    if queue is None and sync_mode(domain) == "upsert":
+        queue = _create_queue(domain)
+    return queue
+
+def start_notify_consumer(domain):
+    """
+    Start consuming the notifications on DB_CHANNEL of a domain with SOLR_SYNC=notify, and return its queue (None in
+    other modes).  Called by the solr_sync management command only, so the changes are indexed by a single process.
+    """
+    if sync_mode(domain) != "notify":
+        return None
+    return _create_queue(domain)
+
+def sync_upserted(domain, columns, rows, timeout=None):
+    """
+    Queue the rows returned by the upsert function for SOLR.  Returns the status for the X-Solr-Sync header, or None
+    when this process does not sync upserts of the domain.
+    """
+    if sync_mode(domain) != "upsert":
+        return None
+    queue = get_sync_queue(domain)
+    if queue.submit([dict(zip(columns, row)) for row in rows], timeout=timeout):
+        return "queued"
+    logger.warning(f"SOLR sync queue of {domain.slug} full, {len(rows)} upserted documents were not queued")
+    return "rejected"
@@ -1,5 +1,401 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from unittest.mock import patch, MagicMock
 from django.urls import reverse
-from rest_framework.test import APIClient
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.request import Request
+import asyncio
+import threading
+import time
+import types
+import uuid
+import pysolr
+from . import aio, solr, solr_replicas
+from .admission import Limiter, Rejected
+from .facets import _check_facets, get_facet_params
+from .lru import LruCache
+from .pagination import KeysetPagination, WatermarkPagination, keyset_query
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .solr_replicas import CircuitBreaker, SolrReplicas, SolrUnavailable
+
+# These tests run without a database (see api.test_runner.NoDbTestRunner), so they are SimpleTestCases of the
+# building blocks of the views.
+
+def get_request(query=""):
+    return Request(APIRequestFactory().get(f"/asset/db/{query}"))
+
+def fake_domain(replicas=2, **settings):
+    """Stand-in for a DomainConfig with its own replica urls, so the shared circuit breakers of other tests are not reused."""
+    return types.SimpleNamespace(slug="asset",
+                                 solr_urls=[f"http://solr{index}-{uuid.uuid4().hex}/asset" for index in range(replicas)],
+                                 setting=lambda name, default=None: settings.get(name, default),
+                                 flag=lambda name, default=False: settings.get(name, default))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        started, finish = threading.Event(), threading.Event()
+        calls = []
+
+        def leader_call():
+            calls.append("leader")
+            started.set()
+            finish.wait(5)
+            return "rows"
+
+        outcomes = {}
+        leader = threading.Thread(target=lambda: outcomes.update(leader=flight.do("asset", "key", leader_call)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: outcomes.update(follower=flight.do("asset", "key", lambda: calls.append("follower"))))
+        follower.start()
+        time.sleep(0.05)
+        finish.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(calls, ["leader"])
+        self.assertEqual(outcomes["leader"], ("rows", False))
+        self.assertEqual(outcomes["follower"], ("rows", True))
+
+    def test_error_is_shared_and_next_call_starts_fresh(self):
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do("asset", "key", lambda: (_ for _ in ()).throw(ValueError("boom")))
+        self.assertEqual(flight.do("asset", "key", lambda: "rows"), ("rows", False))
+
+    def test_waiter_runs_its_own_call_after_timeout(self):
+        flight = SingleFlight()
+        started, finish = threading.Event(), threading.Event()
+        leader = threading.Thread(target=flight.do, args=("asset", "key", lambda: started.set() or finish.wait(5)))
+        leader.start()
+        started.wait(5)
+        try:
+            self.assertEqual(flight.do("asset", "key", lambda: "own", timeout=0.01), ("own", False))
+        finally:
+            finish.set()
+            leader.join(5)
+
+    def test_forget_starts_a_new_call(self):
+        flight = SingleFlight()
+        started, finish = threading.Event(), threading.Event()
+        leader = threading.Thread(target=flight.do, args=("asset", "key", lambda: started.set() or finish.wait(5)))
+        leader.start()
+        started.wait(5)
+        try:
+            flight.forget("asset")
+            self.assertEqual(flight.do("asset", "key", lambda: "fresh"), ("fresh", False))
+        finally:
+            finish.set()
+            leader.join(5)
+
+
+class AsyncSingleFlightTests(SimpleTestCase):
+    def test_concurrent_tasks_share_one_call(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "rows"
+
+        async def run():
+            return await asyncio.gather(flight.do("asset", "key", call), flight.do("asset", "key", call))
+
+        self.assertEqual(asyncio.run(run()), [("rows", False), ("rows", True)])
+        self.assertEqual(len(calls), 1)
+
+    def test_follower_runs_its_own_call_when_leader_is_cancelled(self):
+        flight = AsyncSingleFlight()
+
+        async def slow():
+            await asyncio.sleep(5)
+
+        async def fast():
+            return "own"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do("asset", "key", slow))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do("asset", "key", fast))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(run()), ("own", False))
+
+
+class LimiterTests(SimpleTestCase):
+    def test_released_slot_goes_to_the_oldest_waiter(self):
+        limiter = Limiter("db", 1, queue_size=2, timeout=5)
+        limiter.acquire()
+        order = []
+        waiters = []
+        for name in ("first", "second"):
+            waiter = threading.Thread(target=lambda name=name: (limiter.acquire(), order.append(name)))
+            waiter.start()
+            waiters.append(waiter)
+            while len(limiter._waiters) < len(waiters):
+                time.sleep(0.001)
+
+        limiter.release()
+        waiters[0].join(5)
+        self.assertEqual(order, ["first"])
+        self.assertEqual(limiter.active, 1)
+        limiter.release()
+        waiters[1].join(5)
+        self.assertEqual(order, ["first", "second"])
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_full_queue_is_rejected(self):
+        limiter = Limiter("db", 1, queue_size=0, timeout=5)
+        limiter.acquire()
+        with self.assertRaises(Rejected):
+            limiter.acquire()
+
+    def test_waiter_gives_up_after_timeout(self):
+        limiter = Limiter("db", 1, queue_size=1, timeout=0.01)
+        limiter.acquire()
+        with self.assertRaises(Rejected):
+            limiter.acquire()
+        self.assertEqual(len(limiter._waiters), 0)
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_async_waiter_gets_the_released_slot(self):
+        limiter = Limiter("db", 1, queue_size=1, timeout=5)
+
+        async def run():
+            await limiter.acquire_async()
+            waiter = asyncio.ensure_future(limiter.acquire_async())
+            await asyncio.sleep(0)
+            limiter.release()
+            await waiter
+
+        asyncio.run(run())
+        self.assertEqual(limiter.active, 1)
+
+    def test_async_waiter_gives_up_after_timeout(self):
+        limiter = Limiter("db", 1, queue_size=1, timeout=0.01)
+        limiter.acquire()
+        with self.assertRaises(Rejected):
+            asyncio.run(limiter.acquire_async())
+        self.assertEqual(len(limiter._waiters), 0)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker("solr1", failures=2, reset=30)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 0)
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker("solr1", failures=2, reset=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        breaker = CircuitBreaker("solr1", failures=1, reset=30)
+        breaker.record_failure()
+        breaker.changed_at -= 30
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # A single trial per reset period.
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        breaker.changed_at -= 30
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class SolrReplicasTests(SimpleTestCase):
+    def solr(self, answers):
+        """get_solr stand-in, answers maps the replica index to a result, an exception or a (delay, result)."""
+        self.searched_in = []
+
+        def get_solr(domain, url):
+            answer = answers[int(url.split("//solr")[1].split("-")[0])]
+
+            def search(**solr_params):
+                self.searched_in.append(threading.current_thread())
+                if isinstance(answer, Exception):
+                    raise answer
+                if isinstance(answer, tuple):
+                    time.sleep(answer[0])
+                    return answer[1]
+                return answer
+            return types.SimpleNamespace(timeout=(5, 60), search=search)
+        return patch.object(solr, "get_solr", get_solr)
+
+    def test_slow_replica_is_hedged(self):
+        replica_set = SolrReplicas(fake_domain(SOLR_HEDGE_DELAY_MS=10))
+        replica_set.order = lambda: replica_set.replicas
+        with self.solr({0: (1, "slow"), 1: "fast"}):
+            started = time.perf_counter()
+            self.assertEqual(replica_set.search({"q": "*:*"}), "fast")
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+    def test_late_answer_counts_against_the_replica(self):
+        replica_set = SolrReplicas(fake_domain(SOLR_HEDGE_DELAY_MS=10, SOLR_HEDGE_BUDGET_MS=100, SOLR_BREAKER_FAILURES=1))
+        replica_set.order = lambda: replica_set.replicas
+        with self.solr({0: (0.3, "stalled"), 1: "fast"}):
+            self.assertEqual(replica_set.search({"q": "*:*"}), "fast")
+            time.sleep(0.5)
+        self.assertEqual(replica_set.replicas[0][1].state, CircuitBreaker.OPEN)
+        self.assertEqual(replica_set.replicas[1][1].state, CircuitBreaker.CLOSED)
+
+    def test_busy_pool_searches_in_the_request_thread(self):
+        replica_set = SolrReplicas(fake_domain())
+        with self.solr({0: "answer", 1: "answer"}), patch.object(solr_replicas, "reserve", lambda *args: False):
+            self.assertEqual(replica_set.search({"q": "*:*"}), "answer")
+        self.assertEqual(self.searched_in, [threading.current_thread()])
+
+    def test_failed_replica_is_replaced_and_counted(self):
+        replica_set = SolrReplicas(fake_domain(SOLR_HEDGE=False, SOLR_BREAKER_FAILURES=1))
+        replica_set.order = lambda: replica_set.replicas
+        with self.solr({0: ConnectionError("refused"), 1: "answer"}):
+            self.assertEqual(replica_set.search({"q": "*:*"}), "answer")
+        self.assertEqual(replica_set.replicas[0][1].state, CircuitBreaker.OPEN)
+
+    def test_query_error_is_raised_without_counting_against_the_replica(self):
+        replica_set = SolrReplicas(fake_domain(SOLR_BREAKER_FAILURES=1))
+        with self.solr({0: pysolr.SolrError("Solr responded with an error (HTTP 400): bad query"), 1: pysolr.SolrError("(HTTP 400)")}):
+            with self.assertRaises(pysolr.SolrError):
+                replica_set.search({"q": "price:["})
+        self.assertTrue(all(breaker.state == CircuitBreaker.CLOSED for url, breaker in replica_set.replicas))
+
+    def test_unavailable_when_every_replica_fails(self):
+        replica_set = SolrReplicas(fake_domain())
+        with self.solr({0: ConnectionError("refused"), 1: ConnectionError("refused")}):
+            with self.assertRaises(SolrUnavailable):
+                replica_set.search({"q": "*:*"})
+
+    def test_async_slow_replica_is_hedged(self):
+        replica_set = SolrReplicas(fake_domain(SOLR_HEDGE_DELAY_MS=10))
+        replica_set.order = lambda: replica_set.replicas
+
+        async def solr_search(domain, solr_params, url, timeout=None):
+            if url == replica_set.replicas[0][0]:
+                await asyncio.sleep(1)
+                return "slow"
+            return "fast"
+
+        with patch.object(aio, "solr_search", solr_search):
+            started = time.perf_counter()
+            self.assertEqual(asyncio.run(replica_set.asearch({"q": "*:*"})), "fast")
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+
+class LruCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LruCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+    def test_entries_expire(self):
+        cache = LruCache(2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, expires_at=time.time() - 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        self.assertEqual(len(cache), 1)
+
+
+class KeysetPaginationTests(SimpleTestCase):
+    columns = ["asset_nbr", "status"]
+
+    def test_first_page_links_to_the_next(self):
+        paginator = KeysetPagination("asset_nbr", 2)
+        request = get_request()
+        position, reverse = paginator.decode_cursor(request)
+        self.assertEqual((position, reverse), (None, False))
+
+        rows = paginator.paginate_rows(request, self.columns, [("A1", "up"), ("A2", "up"), ("A3", "down")], position, reverse)
+        self.assertEqual(rows, [("A1", "up"), ("A2", "up")])
+        self.assertIsNone(paginator.get_previous_link())
+
+        next_request = get_request("?" + paginator.get_next_link().split("?")[1])
+        self.assertEqual(paginator.decode_cursor(next_request), ("A2", False))
+
+    def test_previous_page_is_returned_in_key_order(self):
+        paginator = KeysetPagination("asset_nbr", 2)
+        rows = paginator.paginate_rows(get_request(), self.columns, [("A4", "up"), ("A3", "up"), ("A2", "up")], "A5", True)
+        self.assertEqual(rows, [("A3", "up"), ("A4", "up")])
+        self.assertEqual(paginator.next_position, "A4")
+        self.assertEqual(paginator.previous_position, "A3")
+
+    def test_invalid_cursor_is_not_found(self):
+        with self.assertRaises(NotFound):
+            KeysetPagination("asset_nbr", 2).decode_cursor(get_request("?cursor=not-a-cursor"))
+
+    def test_query_pushes_the_boundary_down(self):
+        sql, params = keyset_query("get_asset", None, "u1", "asset_nbr", "A2", True, 3)
+        self.assertEqual(sql, "SELECT * FROM get_asset(%s) AS t WHERE t.asset_nbr < %s ORDER BY t.asset_nbr DESC LIMIT %s;")
+        self.assertEqual(params, ["u1", "A2", 3])
+
+
+class WatermarkPaginationTests(SimpleTestCase):
+    columns = ["asset_nbr", "updated_at"]
+
+    def test_token_resumes_after_the_last_row(self):
+        paginator = WatermarkPagination("updated_at", "asset_nbr", 2)
+        rows = paginator.paginate_rows(get_request(), self.columns, [("A1", 1), ("A2", 2), ("A3", 2)], (None, None))
+        self.assertEqual(len(rows), 2)
+        self.assertIsNotNone(paginator.get_next_link())
+
+        token = paginator.encode_token(paginator.position)
+        self.assertEqual(paginator.decode_since(get_request(f"?since={token}")), (2, "A2"))
+
+    def test_raw_watermark_and_empty_page(self):
+        paginator = WatermarkPagination("updated_at", "asset_nbr", 2)
+        since = paginator.decode_since(get_request("?since=2024-01-01T00:00:00"))
+        self.assertEqual(since, ("2024-01-01T00:00:00", None))
+
+        self.assertEqual(paginator.paginate_rows(get_request(), self.columns, [], since), [])
+        self.assertIsNone(paginator.get_next_link())
+        self.assertEqual(paginator.decode_since(get_request(f"?since={paginator.encode_token(paginator.position)}")), since)
+
+
+class FacetTests(SimpleTestCase):
+    def test_terms_facets_are_capped(self):
+        facets = _check_facets({
+            "by_status": {"type": "terms", "field": "status", "limit": -1,
+                          "facet": {"by_type": {"type": "terms", "field": "type", "limit": 5000}}},
+            "small": {"type": "terms", "field": "status", "limit": 5},
+            "long_form": {"terms": {"field": "status"}},
+            "avg_price": "avg(price)",
+        }, 100)
+        self.assertEqual(facets["by_status"]["limit"], 100)
+        self.assertEqual(facets["by_status"]["facet"]["by_type"]["limit"], 100)
+        self.assertEqual(facets["small"]["limit"], 5)
+        self.assertNotIn("limit", facets["long_form"]["terms"])
+
+    def test_domain_may_only_narrow(self):
+        _check_facets({"open": {"type": "query", "q": "status:open", "domain": {"filter": "type:pump"}}}, 100)
+        for domain in ({"query": "*:*"}, {"excludeTags": "facility"}, {"join": {"from": "a", "to": "b"}}, "filter"):
+            with self.assertRaises(ParseError):
+                _check_facets({"by_status": {"type": "terms", "field": "status", "domain": domain}}, 100)
+        with self.assertRaises(ParseError):
+            _check_facets({"by_status": {"terms": {"field": "status", "domain": {"query": "*:*"}}}}, 100)
+
+    def test_request_keys_are_checked(self):
+        with self.assertRaises(ParseError):
+            get_facet_params({"facet": {"n": "sum(x)"}, "rows": 10}, 100)
+        solr_params = get_facet_params({"facet": {"n": "sum(x)"}}, 100)
+        self.assertEqual((solr_params["q"], solr_params["rows"]), ("*:*", 0))
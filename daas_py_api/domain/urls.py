@@ -1,15 +1,28 @@
 from django.urls import path
-from .views import api_root, DomainDb, DomainDbUpsert, DomainCache, DomainCacheQuery
-from daas_py_config import config
-import os
+from . import views
+from .conf import DOMAINS, domain_flag
 
-configs = config.get_configs()
-DOMAIN = os.getenv("DOMAIN").lower().strip().replace("'", "")
+# Under ASGI the async views keep DB and SOLR calls in flight without holding a thread per request.
+if domain_flag("API_ASYNC_VIEWS"):
+    from . import async_views as domain_views
+else:
+    domain_views = views
 
 urlpatterns = [
-    path("", api_root, name="api-root"),
-    path(f"{DOMAIN}/db/", DomainDb.as_view(), name=f"{DOMAIN}-db"),
-    path(f"{DOMAIN}/db/upsert/", DomainDbUpsert.as_view(), name=f"{DOMAIN}-db-upsert"),
-    path(f"{DOMAIN}/cache", DomainCache.as_view(), name=f"{DOMAIN}-cache"),
-    path(f"{DOMAIN}/cache/query", DomainCacheQuery.as_view(), name=f"{DOMAIN}-cache-query"),
+    path("", views.api_root, name="api-root"),
 ]
+
+# Every registered domain gets the same routes, bound to its configuration through domain_name.
+for domain in DOMAINS.values():
+    slug = domain.slug
+    urlpatterns += [
+        path(f"{slug}/db/", domain_views.DomainDb.as_view(domain_name=slug), name=f"{slug}-db"),
+        path(f"{slug}/db/changes/", domain_views.DomainDbChanges.as_view(domain_name=slug), name=f"{slug}-db-changes"),
+        path(f"{slug}/db/export/", domain_views.DomainDbExport.as_view(domain_name=slug), name=f"{slug}-db-export"),
+        path(f"{slug}/db/upsert/", domain_views.DomainDbUpsert.as_view(domain_name=slug), name=f"{slug}-db-upsert"),
+        path(f"{slug}/cache", domain_views.DomainCache.as_view(domain_name=slug), name=f"{slug}-cache"),
+        path(f"{slug}/cache/sync", views.DomainCacheSync.as_view(domain_name=slug), name=f"{slug}-cache-sync"),
+        path(f"{slug}/cache/query", domain_views.DomainCacheQuery.as_view(domain_name=slug), name=f"{slug}-cache-query"),
+        path(f"{slug}/cache/facet", domain_views.DomainCacheFacet.as_view(domain_name=slug), name=f"{slug}-cache-facet"),
+        path(f"{slug}/batch", domain_views.DomainBatch.as_view(domain_name=slug), name=f"{slug}-batch"),
+    ]
@@ -6,110 +6,280 @@ Author: Neal Routson
 Date: 2025-02-02
 Version: 0.1
 """
-import os
 from rest_framework.views import APIView
 from django.db import connection
+from django.http import StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import NotFound, ParseError
 from rest_framework.decorators import api_view
 from rest_framework.reverse import reverse
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.renderers import BrowsableAPIRenderer
 from manage import logger, config
-import pysolr
+import functools
 import json
+from .authentication import CachedJWTAuthentication, get_claims
 from .permissions import FacilityPermission
+from .response_cache import cached_response, invalidate_response_cache
+from .conditional import conditional_response
+from .admission import admitted
+from .routing import replica_read, sticky_writes
+from .conf import DOMAINS, get_domain
+from .pagination import (KeysetPagination, SolrCursorPagination, WatermarkPagination, cursor_pagination_requested,
+                         keyset_query, changes_query)
+from .renderers import RowSet, FastJSONRenderer, CompactJSONRenderer, NDJSONRenderer, CSVRenderer, COLUMNAR_RENDERERS
+from .db import execute, fetch, start_stream, stream_query
+from .projection import requested_fields, select_list, solr_field_list, field_errors
+from .facets import get_facet_params, get_facet_results
+from .batch import parse_batch, run_batch, batch_response
+from . import metrics
+from .bulk import bulk_requested, get_bulk_options, split, run_chunks, bulk_response
+from .solr import index_documents, resolve_commit_policy
+from .solr_replicas import FALLBACK_HEADER, SolrUnavailable, fallback_allowed, search
+from .solr_sync import get_sync_queue, sync_mode, sync_upserted
 
 configs = config.get_configs()
-DOMAIN = os.getenv("DOMAIN").upper().strip().replace("'", "")
-logger.debug(DOMAIN)
-SOLR_COLLECTION = getattr(configs, f"SOLR_COLLECTION_{DOMAIN}")
-SOLR_URL = f"{configs.SOLR_URL}/{SOLR_COLLECTION}"
-DB_CHANNEL = getattr(configs, f"DB_CHANNEL_{DOMAIN}")
-DB_CHANNEL_PARENT = getattr(configs, f"DB_CHANNEL_PARENT_{DOMAIN}", None)
-DB_FUNC_GET_BY_ID = getattr(configs, f"DB_FUNC_GET_BY_ID_{DOMAIN}")
-DB_FUNC_GET = getattr(configs, f"DB_FUNC_GET_{DOMAIN}")
-DB_FUNC_UPSERT = getattr(configs, f"DB_FUNC_UPSERT_{DOMAIN}")
-
-logger.info (f"SOLR_URL: {SOLR_URL}")
-logger.info (f"DB_CHANNEL_NAME: {DB_CHANNEL}")
 
 # When navigating to the /api/ endpoint, we will show what API are available.
 @api_view(["GET", "POST"])
 def api_root(request, format=None):
-    """API root view to list available endpoints."""
-    return Response({
-        f"{DOMAIN.lower()}-db": reverse(f"{DOMAIN.lower()}-db", request=request, format=format),
-        f"{DOMAIN.lower()}-db-upsert": reverse(f"{DOMAIN.lower()}-db-upsert", request=request, format=format),
-        f"{DOMAIN.lower()}-cache": reverse(f"{DOMAIN.lower()}-cache", request=request, format=format),
-        f"{DOMAIN.lower()}-cache-query": reverse(f"{DOMAIN.lower()}-cache-query", request=request, format=format),
-    })
+    """API root view to list available endpoints of every domain served by this process."""
+    endpoints = {}
+    for slug in DOMAINS:
+        for endpoint in ("db", "db-changes", "db-export", "db-upsert", "cache", "cache-sync", "cache-query", "cache-facet", "batch"):
+            endpoints[f"{slug}-{endpoint}"] = reverse(f"{slug}-{endpoint}", request=request, format=format)
+    return Response(endpoints)
 
 def get_jwt_hashed_values(request):
-    user = request.user  # Authenticated user
-    token = request.auth  # JWT token payload
-    user_id = token.get("user_id", [])
-    facilities = token.get("facility", [])
-    return user_id, user, facilities
+    claims = get_claims(request)  # Parsed once from the JWT verified during authentication
+    return claims.user_id, request.user, claims.facilities
+
+def get_cache_search_params(request):
+    """Build the default SOLR search parameters from the query string."""
+    # Extract query parameters (if any)
+    query = request.GET.get("q", "*:*")  # Default to all domain objects
+    filters = request.GET.getlist("fq")  # Filter queries if provided
+    sort = request.GET.get("sort")  # Sort order if provided
+
+    # Construct Default SOLR search parameters
+    solr_params = {
+        "q": query,
+        "fq": filters,
+        "rows": int(configs.SOLR_MAX_ROW)
+    }
+    if sort:
+        solr_params["sort"] = sort
+    return solr_params
+
+def add_facility_filter(solr_params, facilities):
+    """Add a filter query for only the facilities that the user is authorized to see."""
+    #### AUTHORIZATION - only get facilitties user has access to  ####
+    facilities_filter = f"{configs.API_AUTH_FACILITY_KEY}:({' '.join(facilities)})"
+
+    # Ensure `fq` is always a list
+    if isinstance(solr_params.get("fq"), str):
+        solr_params["fq"] = [solr_params["fq"]]  # Convert existing string to list
+
+    solr_params.setdefault('fq', []).append(facilities_filter)
+    #### AUTHORIZATION - only get facilitties user has access to  ####
+    return solr_params
+
+def add_field_list(solr_params, request, unique_key):
+    """Map ?fields= to the SOLR fl parameter, unless the SOLR parameters already carry one."""
+    fields = requested_fields(request, unique_key)
+    if fields and not solr_params.get("fl"):
+        solr_params["fl"] = solr_field_list(fields)
+    return solr_params
+
+def limit_rows(solr_params):
+    """Safeguarding large requests for data."""
+    if "rows" in solr_params:
+        input_rows = solr_params["rows"]
+        if input_rows > configs.SOLR_MAX_ROW:
+            logger.warning(f"API rows request: {input_rows} > than the limit {configs.SOLR_MAX_ROW}")
+            solr_params["rows"] = configs.SOLR_MAX_ROW
+    return solr_params
+
+def get_cache_documents(data):
+    """Return (documents, error) for a SOLR upsert body, which can be a single document or a list of them."""
+    # Create document dynamically.  This requires source/target columns to be exact.
+    # Ensure data is a list of dictionaries
+    if isinstance(data, dict):
+        documents = [data]  # Convert single dictionary to a list
+    elif isinstance(data, list):
+        documents = data  # Use as-is if it"s already a list
+    else:
+        return None, "Invalid input format. Expected a list or dictionary."
+
+    # Verify required field facility_nbr is provided.
+    missing_facility_nbr = [doc for doc in documents if configs.API_AUTH_FACILITY_KEY not in doc]
+    if len(missing_facility_nbr) > 0:
+        return None, f"Missing required field {configs.API_AUTH_FACILITY_KEY}"
+
+    return documents, None
+
+class DomainMixin:
+    """Binds a generic view to one of the registered domains, i.e. DomainDb.as_view(domain_name="asset")."""
+    domain_name = None
+
+    @property
+    def domain(self):
+        return get_domain(self.domain_name)
 
 # Class for getting all domain objects in the provided json.
-class DomainDb(APIView):
+class DomainDb(DomainMixin, APIView):
     # Require authentication and authroization.  Allow read-only access as well.
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated, FacilityPermission] 
-
+    # Rows are returned as a RowSet, ?format=compact returns them as column and row arrays, ?format=arrow|parquet
+    # as columnar data when pyarrow is installed.
+    renderer_classes = [FastJSONRenderer, CompactJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @conditional_response("db", "db")
+    @admitted("db")
+    @cached_response("db", "db")
+    @admitted("db", "db", tenant=False)
     def get(self, request):
         """Retrieve all domain objects using a stored procedure"""
 
         user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+
+        if cursor_pagination_requested(request, self.domain.setting("PAGINATION_MODE_DB", "page")):
+            return self.get_keyset_page(request, user_id, fields)
    
-        with connection.cursor() as cursor:
-            cursor.execute(f"SELECT * FROM {DB_FUNC_GET}(%s);", [user_id])
-            columns = [col[0] for col in cursor.description]  # Get column names
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]  # Convert to dictionary
+        with field_errors():
+            columns, rows = replica_read(request, functools.partial(fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;", [user_id]))
         
-        # Apply pagination
+        # Apply pagination to the raw rows, only the rows of the page are rendered
         paginator = PageNumberPagination()
-        paginator.page_size = int(configs.PAGINATION_SIZE_DB)  # Set the number of items per page
-        paginated_results = paginator.paginate_queryset(results, request)
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_DB"))  # Set the number of items per page
+        with metrics.stage("paginate"):
+            paginated_rows = paginator.paginate_queryset(rows, request)
+        metrics.record_rows(len(paginated_rows))
 
         # Return the paginated response
-        return paginator.get_paginated_response(paginated_results)
+        return paginator.get_paginated_response(RowSet(columns, paginated_rows))
+
+    def get_keyset_page(self, request, user_id, fields=None):
+        """Retrieve one page of domain objects, pushing the last seen key and the limit down to the DB."""
+        paginator = KeysetPagination(key=self.domain.db_key, page_size=int(self.domain.setting("PAGINATION_SIZE_DB")))
+        position, reverse = paginator.decode_cursor(request)
+
+        # Ask for one extra row to know if there is another page in the direction of travel.
+        sql, params = keyset_query(self.domain.db_func_get, self.domain.db_func_get_page, user_id, self.domain.db_key, position, reverse, paginator.page_size + 1, fields)
+
+        with field_errors():
+            columns, rows = replica_read(request, functools.partial(fetch, sql, params))
+        with metrics.stage("paginate"):
+            rows = paginator.paginate_rows(request, columns, rows, position, reverse)
+        metrics.record_rows(len(rows))
+
+        return paginator.get_paginated_response(RowSet(columns, rows))
     
+    @admitted("db", "db")
     def post(self, request):
         """Retrieve multiple domain objects using a stored procedure with JSON list of IDs"""
+        fields = requested_fields(request, self.domain.db_key)
         
         try:
-            user = request.user  # Authenticated user
-            token = request.auth  # JWT token payload
-            user_id = token.get("user_id", [])
+            user_id, user, facilities = get_jwt_hashed_values(request=request)
 
             json_data = json.dumps(request.data)
 
-            with connection.cursor() as cursor:
-                cursor.execute(f"SELECT * FROM {DB_FUNC_GET_BY_ID}(%s, %s);", [json_data, user_id])
-                rows = cursor.fetchall()
+            with field_errors():
+                columns, rows = replica_read(request, functools.partial(fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get_by_id}(%s, %s) AS t;", [json_data, user_id]))
+            metrics.record_rows(len(rows))
 
-                if rows:
-                    columns = [col[0] for col in cursor.description]
-                    results = [dict(zip(columns, row)) for row in rows]
-                    return Response(results)
+            if rows:
+                return Response(RowSet(columns, rows))
 
-            return Response({"error": f"No {DOMAIN.lower()} found"}, status=status.HTTP_204_NO_CONTENT)
+            return Response({"error": f"No {self.domain.slug} found"}, status=status.HTTP_204_NO_CONTENT)
 
+        except ParseError:
+            raise
         except Exception as e:
-            logger.exception(f"❌Error retrieving {DOMAIN.lower()}: {str(e)}")
+            logger.exception(f"❌Error retrieving {self.domain.slug}: {str(e)}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class DomainDbUpsert(APIView):
+# Class for incremental sync, returning only the rows changed since a watermark.
+class DomainDbChanges(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, CompactJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
+
+    @admitted("db-changes", "db")
+    def get(self, request):
+        """Retrieve one page of the domain objects changed after ?since=, with the watermark to resume from."""
+        if not self.domain.db_func_get_changes:
+            raise NotFound(f"Changes are not configured for {self.domain.slug}, set DB_FUNC_GET_CHANGES_{self.domain.name}")
+
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+        if fields and self.domain.db_watermark not in fields:
+            fields.append(self.domain.db_watermark)
+
+        paginator = WatermarkPagination(self.domain.db_watermark, self.domain.db_key, int(self.domain.setting("PAGINATION_SIZE_DB")))
+        since = paginator.decode_since(request)
+
+        # Ask for one extra row to know if more changes are waiting.
+        sql, params = changes_query(self.domain.db_func_get_changes, user_id, *since, paginator.page_size + 1, fields)
+
+        with connection.cursor() as cursor, field_errors():
+            execute(cursor, sql, params)
+            columns = [col[0] for col in cursor.description]
+            with metrics.stage("db_fetch"):
+                rows = cursor.fetchall()
+            with metrics.stage("paginate"):
+                rows = paginator.paginate_rows(request, columns, rows, since)
+        metrics.record_rows(len(rows))
+
+        return paginator.get_paginated_response(RowSet(columns, rows))
+
+# Class for streaming a full extract of the domain, as NDJSON (default) or CSV (?format=csv or Accept: text/csv), or
+# Arrow/Parquet record batches (?format=arrow|parquet or Accept: application/vnd.apache.arrow.stream).
+class DomainDbExport(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [NDJSONRenderer, CSVRenderer] + COLUMNAR_RENDERERS
+
+    @admitted("db-export", "db")
+    def get(self, request):
+        """Stream all domain objects from a server-side cursor, so the first rows go out before the query finishes."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        fields = requested_fields(request, self.domain.db_key)
+
+        renderer = request.accepted_renderer
+        sql = f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;"
+        itersize = int(self.domain.setting("DB_EXPORT_ITERSIZE", 2000))
+        with field_errors():
+            batches = replica_read(request, lambda alias: start_stream(stream_query(sql, [user_id], itersize, alias)))
+
+        content_type = f"{renderer.media_type}; charset={renderer.charset}" if renderer.charset else renderer.media_type
+        response = StreamingHttpResponse(renderer.render_stream(batches), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{self.domain.slug}.{renderer.format}"'
+        return response
+
+class DomainDbUpsert(DomainMixin, APIView):
     # Require authentication and authroization.  
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated, FacilityPermission]
 
+    @admitted("db-upsert", "db")
+    @sticky_writes
     def post(self, request):
-        """Retrieve multiple domain objects using a stored procedure with JSON list of IDs"""
+        """Upsert domain objects using a stored procedure.  Pass ?bulk=true to upsert large payloads in chunks."""
         # logger.debug(f"request: {request.data}")
+
+        if bulk_requested(request):
+            return self.post_bulk(request)
         
         json_data = json.dumps(request.data)
 
@@ -117,143 +287,229 @@ class DomainDbUpsert(APIView):
             user_id, user, facilities = get_jwt_hashed_values(request=request)
 
             with connection.cursor() as cursor:
-                cursor.execute(f"SELECT * FROM {DB_FUNC_UPSERT}(%s, %s, %s, %s);", [json_data, DB_CHANNEL, user_id, DB_CHANNEL_PARENT])
+                execute(cursor, f"SELECT * FROM {self.domain.db_func_upsert}(%s, %s, %s, %s);", [json_data, self.domain.db_channel, user_id, self.domain.db_channel_parent])
+                invalidate_response_cache(self.domain)
 
-                rows = cursor.fetchall()
+                with metrics.stage("db_fetch"):
+                    rows = cursor.fetchall()
+                metrics.record_rows(len(rows))
 
                 if rows:
                     columns = [col[0] for col in cursor.description]
-                    results = [dict(zip(columns, row)) for row in rows]
-                    return Response(results)
+                    with metrics.stage("rows"):
+                        results = [dict(zip(columns, row)) for row in rows]
+                    response = Response(results)
+
+                    # Hand the upserted rows to the write-behind SOLR sync, if enabled.
+                    sync_status = sync_upserted(self.domain, columns, rows)
+                    if sync_status:
+                        response["X-Solr-Sync"] = sync_status
+                    return response
 
-            return Response({"error": f"No {DOMAIN.lower()} found"}, status=status.HTTP_204_NO_CONTENT)
+            return Response({"error": f"No {self.domain.slug} found"}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
-            logger.exception(f"❌Error retrieving {DOMAIN.lower()}: {str(e)}")
+            logger.exception(f"❌Error retrieving {self.domain.slug}: {str(e)}")
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def post_bulk(self, request):
+        """
+        Upsert the payload in chunks of ?chunk_size= on the bounded upsert workers.  ?return=counts (default), keys
+        or rows controls how much of each chunk is echoed back.
+        """
+        try:
+            chunk_size, returning = get_bulk_options(request, self.domain)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
 
-class DomainCache(APIView):
+        def run_chunk(chunk):
+            with connection.cursor() as cursor:
+                execute(cursor, f"SELECT * FROM {self.domain.db_func_upsert}(%s, %s, %s, %s);", [json.dumps(chunk), self.domain.db_channel, user_id, self.domain.db_channel_parent])
+                if cursor.description is None:
+                    return [], []
+                columns, rows = [col[0] for col in cursor.description], cursor.fetchall()
+            sync_upserted(self.domain, columns, rows)
+            return columns, rows
+
+        results = run_chunks(split(request.data, chunk_size), run_chunk, self.domain.db_key, returning)
+        invalidate_response_cache(self.domain)
+
+        return bulk_response(results)
+
+
+# Class for the backpressure and lag metrics of the write-behind SOLR sync.
+class DomainCacheSync(DomainMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Return the state of the SOLR sync queue of this process."""
+        queue = get_sync_queue(self.domain)
+        if queue is None:
+            return Response({"mode": sync_mode(self.domain)})
+        return Response({"mode": sync_mode(self.domain), **queue.stats()})
+
+class DomainCache(DomainMixin, APIView):
     # Require authentication and authroization.  
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated, FacilityPermission] 
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
 
+    @conditional_response("cache", "solr")
+    @admitted("cache")
+    @cached_response("cache", "solr")
+    @admitted("cache", "solr", tenant=False)
     def get(self, request):
         """Retrieve ALL domain objects from SOLR."""
         user_id, user, facilities = get_jwt_hashed_values(request=request)
 
-        solr = pysolr.Solr(SOLR_URL, 
-                           auth=(config.get_secret('SOLR_USER'), 
-                                config.get_secret('SOLR_PASSWORD')), 
-                            always_commit=True, 
-                            timeout=int(configs.SOLR_TIMEOUT))
+        solr_params = get_cache_search_params(request)
+        add_facility_filter(solr_params, facilities)
+        add_field_list(solr_params, request, self.domain.setting("SOLR_UNIQUE_KEY", "id"))
 
-        # Extract query parameters (if any)
-        query = request.GET.get("q", "*:*")  # Default to all domain objects
-        filters = request.GET.getlist("fq")  # Filter queries if provided
+        if cursor_pagination_requested(request, self.domain.setting("PAGINATION_MODE_SOLR", "page")):
+            return self.get_cursor_page(request, solr_params, user_id)
+
+        logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
 
-        # add a query to filter for only the facilities that the user is authorized to see.
+        try:
+            with metrics.stage("solr"):
+                results = search(self.domain, solr_params)
+        except SolrUnavailable:
+            if not fallback_allowed(self.domain, request):
+                raise
+            return self.get_db_fallback(request, user_id)
+        with metrics.stage("rows"):
+            documents = [doc for doc in results]
 
-        # Construct Default SOLR search parameters
-        solr_params = {
-            "q": query,
-            "fq": filters,
-            "rows": int(configs.SOLR_MAX_ROW) 
-        }
+        # Apply pagination
+        paginator = PageNumberPagination()
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_SOLR"))
+        with metrics.stage("paginate"):
+            paginated_results = paginator.paginate_queryset(documents, request)
+        metrics.record_rows(len(paginated_results))
 
-        #### AUTHORIZATION - only get facilitties user has access to  ####
-        facilities_filter = f"{configs.API_AUTH_FACILITY_KEY}:({' '.join(facilities)})"
+        return paginator.get_paginated_response(paginated_results)
 
-        # Ensure `fq` is always a list
-        if isinstance(solr_params.get("fq"), str):
-            solr_params["fq"] = [solr_params["fq"]]  # Convert existing string to list
-            
-        solr_params.setdefault('fq', []).append(facilities_filter)
-        #### AUTHORIZATION - only get facilitties user has access to  ####
+    def get_cursor_page(self, request, solr_params, user_id):
+        """Retrieve one page of domain objects from SOLR, resuming from the cursorMark in the request."""
+        paginator = SolrCursorPagination(unique_key=self.domain.setting("SOLR_UNIQUE_KEY", "id"), page_size=int(self.domain.setting("PAGINATION_SIZE_SOLR")))
+        paginator.apply(request, solr_params)
 
         logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
 
-        results = solr.search(**solr_params)
-        documents = [doc for doc in results]
+        with metrics.stage("solr"):
+            results = search(self.domain, solr_params)
+        with metrics.stage("paginate"):
+            documents = paginator.paginate_results(request, solr_params, results)
+        metrics.record_rows(len(documents))
 
-        # Apply pagination
+        return paginator.get_paginated_response(documents)
+
+    def get_db_fallback(self, request, user_id):
+        """Serve the lookup from DB_FUNC_GET while no SOLR replica can answer (SOLR_DB_FALLBACK), see solr_replicas.py."""
+        logger.warning(f"Serving {self.domain.slug} cache lookup of user_id:{user_id} from the DB, SOLR is unavailable")
+        fields = requested_fields(request, self.domain.db_key)
+
+        with field_errors():
+            columns, rows = replica_read(request, functools.partial(fetch, f"SELECT {select_list(fields)} FROM {self.domain.db_func_get}(%s) AS t;", [user_id]))
+
+        # Paged like the SOLR documents, so clients keep their page numbers.
         paginator = PageNumberPagination()
-        paginator.page_size = int(configs.PAGINATION_SIZE_SOLR)
-        paginated_results = paginator.paginate_queryset(documents, request)
+        paginator.page_size = int(self.domain.setting("PAGINATION_SIZE_SOLR"))
+        with metrics.stage("paginate"):
+            paginated_rows = paginator.paginate_queryset(rows, request)
+        metrics.record_rows(len(paginated_rows))
 
-        return paginator.get_paginated_response(paginated_results)
+        response = paginator.get_paginated_response(RowSet(columns, paginated_rows))
+        response[FALLBACK_HEADER] = "db"
+        return response
 
+    @admitted("cache", "solr")
     def post(self, request):
-        """Upsert new domain objects to SOLR."""
+        """Upsert new domain objects to SOLR.  Pass ?commit=true (soft) or ?commit=explicit to make them visible on return."""
         user_id, user, facilities = get_jwt_hashed_values(request=request)
 
-        solr = pysolr.Solr(SOLR_URL, 
-                    auth=(config.get_secret('SOLR_USER'), 
-                        config.get_secret('SOLR_PASSWORD')), 
-                    always_commit=True, 
-                    timeout=int(configs.SOLR_TIMEOUT))
-        
-        data = request.data
-
-        # Create document dynamically.  This requires source/target columns to be exact.
-        # Ensure data is a list of dictionaries
-        if isinstance(data, dict):  
-            documents = [data]  # Convert single dictionary to a list
-        elif isinstance(data, list):  
-            documents = data  # Use as-is if it"s already a list
-        else:
-            return Response({"error": "Invalid input format. Expected a list or dictionary."}, status=status.HTTP_400_BAD_REQUEST)        
-
-        # Verify required field facility_nbr is provided.
-        missing_facility_nbr = [doc for doc in documents if configs.API_AUTH_FACILITY_KEY not in doc]
-        if len(missing_facility_nbr) > 0:
-            return Response({f"error": "Missing required field {configs.API_AUTH_FACILITY_KEY}"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            commit_policy = resolve_commit_policy(self.domain, request.query_params.get("commit"))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        documents, error = get_cache_documents(request.data)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
 
         #### AUTHORIZATION - remove document updates where users doesn't have access  ####
         filtered_documents = [doc for doc in documents if doc[configs.API_AUTH_FACILITY_KEY] in facilities]
 
         # Add documents to SOLR
-        solr.add(filtered_documents)
+        index_documents(self.domain, filtered_documents, commit_policy)
+        invalidate_response_cache(self.domain)
 
         return Response(documents, status=status.HTTP_201_CREATED)
     
 #  Class for getting all domain objects from SOLR.
-class DomainCacheQuery(APIView):
+class DomainCacheQuery(DomainMixin, APIView):
     # Require authentication and authroization. 
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated, FacilityPermission] 
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer] + COLUMNAR_RENDERERS
 
+    @admitted("cache-query", "solr")
     def post(self, request):
         """Post api to query SOLR with input body of request."""
         user_id, user, facilities = get_jwt_hashed_values(request=request)
 
-        solr = pysolr.Solr(SOLR_URL, 
-                           auth=(config.get_secret('SOLR_USER'), 
-                                config.get_secret('SOLR_PASSWORD')), 
-                            always_commit=True, 
-                            timeout=int(configs.SOLR_TIMEOUT))
-
         solr_params = request.data
-
-        #### AUTHORIZATION - only get facilitties user has access to  ####
-        facilities_filter = f"{configs.API_AUTH_FACILITY_KEY}:({' '.join(facilities)})"
-
-        # Ensure `fq` is always a list
-        if isinstance(solr_params.get("fq"), str):
-            solr_params["fq"] = [solr_params["fq"]]  # Convert existing string to list
-
-        solr_params.setdefault('fq', []).append(facilities_filter)
-        #### AUTHORIZATION - only get facilitties user has access to  ####
-
-        # Safeguarding large requests for data.
-        if "rows" in solr_params:
-            input_rows = solr_params["rows"]
-            if input_rows > configs.SOLR_MAX_ROW:
-                logger.warning(f"API rows request: {input_rows} > than the limit {configs.SOLR_MAX_ROW}")
-                solr_params["rows"] = configs.SOLR_MAX_ROW
+        add_facility_filter(solr_params, facilities)
+        add_field_list(solr_params, request, self.domain.setting("SOLR_UNIQUE_KEY", "id"))
+        limit_rows(solr_params)
 
         logger.debug(f"user_id:{user_id}, Querying SOLR with payload: {solr_params}")
 
-        results = solr.search(**solr_params)
+        with metrics.stage("solr"):
+            results = search(self.domain, solr_params)
+        metrics.record_rows(len(results.docs))
     
         return Response (results.raw_response, status=status.HTTP_200_OK)
     
+
+#  Class for aggregating domain objects in SOLR without returning them.
+class DomainCacheFacet(DomainMixin, APIView):
+    # Require authentication and authroization.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated, FacilityPermission]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    @admitted("cache-facet", "solr")
+    def post(self, request):
+        """Post api to aggregate SOLR documents with the JSON Facet API, i.e. {"q": ..., "fq": [...], "facet": {...}}."""
+        user_id, user, facilities = get_jwt_hashed_values(request=request)
+
+        solr_params = get_facet_params(request.data, int(self.domain.setting("SOLR_MAX_FACET_BUCKETS", 1000)))
+        add_facility_filter(solr_params, facilities)
+
+        logger.debug(f"user_id:{user_id}, Aggregating SOLR with payload: {solr_params}")
+
+        with metrics.stage("solr"):
+            results = search(self.domain, solr_params)
+
+        return Response(get_facet_results(results.raw_response), status=status.HTTP_200_OK)
+
+# Class for running several reads of the domain in one round trip.
+class DomainBatch(DomainMixin, APIView):
+    # Require authentication.  Facility authorization applies to every sub-request.
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    batch_views = {"db": DomainDb, "db-changes": DomainDbChanges, "cache": DomainCache, "cache-query": DomainCacheQuery,
+                   "cache-facet": DomainCacheFacet}
+
+    def get_view(self, endpoint):
+        return self.batch_views[endpoint].as_view(domain_name=self.domain_name)
+
+    def post(self, request):
+        """Run a list of read sub-requests concurrently and return their results in order, see batch.py."""
+        sub_requests = parse_batch(request.data, int(self.domain.setting("API_BATCH_MAX_REQUESTS", 20)))
+        return batch_response(run_batch(request, self.domain, sub_requests, self.get_view))
@@ -0,0 +1,67 @@
+"""
+File: workers.py
+Description: Thread pools of the process, shared by all domains: the bulk upsert chunks (DB_UPSERT_WORKERS), the batch
+            sub-requests (API_BATCH_WORKERS) and the hedged SOLR searches (SOLR_HEDGE_WORKERS).  Each pool is created on
+            first use, sized by its setting.  Callers that would rather do the work themselves than queue behind busy
+            threads reserve a free one first (reserve, submit_reserved).
+"""
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
+from .conf import domain_setting
+
+_executors = {}
+# name -> semaphore of the threads of the pool that are neither busy nor reserved, see reserve.
+_free_threads = {}
+_executors_lock = threading.Lock()
+
+def get_executor(name, setting, default):
+    """Pool of `setting` threads (default `default`) named daas-<name>, shared by all domains."""
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                max_workers = int(domain_setting(setting, default))
+                executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"daas-{name}")
+                _free_threads[name] = threading.BoundedSemaphore(max_workers)
+                _executors[name] = executor
+    return executor
+
+def submit(executor, function, *args):
+    """Run function on the pool in a copy of the caller's context, so sampled stage timings are kept."""
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+def reserve(name, setting, default):
+    """
+    Reserve a free thread of the pool for submit_reserved.  Returns False at once when every thread is busy or
+    reserved, nothing submitted through reservations ever waits in the queue of the pool.
+    """
+    get_executor(name, setting, default)
+    return _free_threads[name].acquire(blocking=False)
+
+def unreserve(name):
+    """Give back a reservation that was not used."""
+    _free_threads[name].release()
+
+def submit_reserved(name, function, *args):
+    """submit on a thread reserved with reserve, which is freed again when the function returns."""
+    future = submit(_executors[name], function, *args)
+    future.add_done_callback(lambda future: _free_threads[name].release())
+    return future
+
+def with_db_connections(function):
+    """
+    Wrap a function run on a worker thread that uses DB connections.  Worker threads are outside the request cycle, so
+    CONN_MAX_AGE is applied and pooled connections are returned around every call.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper